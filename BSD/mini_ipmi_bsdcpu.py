@@ -15,23 +15,87 @@ SENDER_PATH = r'zabbix_sender'
 
 TIMEOUT = '80'         # how long the script must wait between LLD and sending, increase if data received late (does not affect windows)
                        # this setting MUST be lower than 'Update interval' in discovery rule
-TJMAX = '70'
+TJMAX = '70'           # used when coretemp does not report 'tjmax'
+
+# Subtrees read by one 'sysctl' call. Missing ones (module not loaded) are ignored.
+SYSCTL_OIDS = ('dev.cpu', 'dev.amdtemp', 'hw.acpi.thermal')
+
+# Socket part of 'dev.cpu.N.%location' ACPI handle, like 'handle=\_SB_.SCK1.CP05'. CPUs without it share one package.
+SOCKET_RE = r'\.(SCK[0-9A-F]|SKT[0-9A-F])\.'
 
 ## End of configuration ##
 
 import sys
+import os
 import subprocess
 import re
-from sender_wrapper import (readConfig, processData, fail_ifNot_Py3)
+from time import time
+from json import loads
+from sender_wrapper import (readConfig, processData, fail_ifNot_Py3, Metric, stampMetrics, singleFlight, chooseDevnull)
 
 HOST = sys.argv[2]
 
+# 'dev.cpu.0.temperature: 45.0C', 'dev.amdtemp.0.core0.sensor0: 41.0C', 'hw.acpi.thermal.tz0.temperature: 27.9C'
+SYSCTL_LINE_RE = re.compile(r'^(dev\.cpu|dev\.amdtemp|hw\.acpi\.thermal)\.(\w+)\.([\w%.]+):\s*(.*)$')
+CELSIUS_RE = re.compile(r'^(-?\d+)(?:\.\d+)?C$')
+SOCKET_LOCATION_RE = re.compile(SOCKET_RE)
+
+
+def celsius(value_):
+    '''Whole degrees of '45.0C', None if not a temperature.'''
+    celsiusRe = CELSIUS_RE.match(value_)
+    if celsiusRe:
+        return celsiusRe.group(1)
+
+    return None
+
+
+def parseSysctl(lines_):
+    '''Streamed 'sysctl' lines into logical CPUs, amdtemp devices and ACPI thermal zones, all by number.'''
+    cpus = {}       # N: {'temperature', 'tjmax', '%parent', '%location'}
+    amdtemps = {}   # N: [(sensor name, degrees)]
+    zones = {}      # N: degrees
+    for line in lines_:
+        lineRe = SYSCTL_LINE_RE.match(line.rstrip('\n'))
+        if not lineRe:
+            continue   # continuation of multi-line value
+
+        tree, node, leaf, value = lineRe.groups()
+        if tree == 'dev.cpu':
+            if leaf in ('temperature', 'coretemp.tjmax'):
+                value = celsius(value)
+                if value is None:
+                    continue
+            elif leaf not in ('%parent', '%location'):
+                continue
+
+            cpus.setdefault(int(node), {})[leaf.replace('coretemp.', '')] = value
+
+        elif tree == 'dev.amdtemp':
+            degrees = celsius(value)
+            if     (degrees is not None and
+                    not leaf.startswith('%')):
+
+                amdtemps.setdefault(int(node), []).append((leaf, degrees))
+
+        elif     (leaf == 'temperature' and
+                  node.startswith('tz')):
+
+            degrees = celsius(value)
+            if degrees is not None:
+                zones[int(node[2:])] = degrees
+
+    return cpus, amdtemps, zones
 
-def getOutput(binPath_):
 
-    p = None
+def readSysctl(binPath_):
+    '''Run one 'sysctl' for all subtrees and parse its output while it is produced.'''
+    DEVNULL = chooseDevnull()
+
+    model = ({}, {}, {})
     try:
-        p = subprocess.check_output([binPath_, 'dev.cpu'], universal_newlines=True)
+        proc = subprocess.Popen([binPath_, '-i'] + list(SYSCTL_OIDS), stdout=subprocess.PIPE, stderr=DEVNULL,
+                                universal_newlines=True)
     except OSError as e:
         if e.args[0] == 2:
             error = 'OS_NOCMD'
@@ -39,73 +103,200 @@ def getOutput(binPath_):
             error = 'OS_ERROR'
             if sys.argv[1] == 'getverb':
                 raise
-    except Exception as e:
-        error = 'UNKNOWN_EXC_ERROR'
+        return error, model
 
+    try:
+        model = parseSysctl(proc.stdout)
+    except Exception:
+        error = 'UNKNOWN_EXC_ERROR'
         if sys.argv[1] == 'getverb':
             raise
-
-        try:
-            p = e.output
-        except:
-            pass
     else:
         error = 'CONFIGURED'
+    finally:
+        proc.stdout.close()
+        proc.wait()
+
+    if     (error == 'CONFIGURED' and
+            proc.returncode):
+
+        error = 'ERR_CODE_%s' % proc.returncode   # '-i' ignores missing subtrees, so this is a real failure
+        model = ({}, {}, {})
+
+    return error, model
+
+
+def buildPackages(cpus_, amdtemps_):
+    '''Physical packages as [(core temperatures [(core, degrees)], TjMax)], in order of their first CPU.
+
+    Logical CPUs are grouped by '%parent' and socket in ACPI '%location'. Without per-CPU
+    temperatures every amdtemp device is taken as one package.'''
+    packages = []
+    index = {}
+    for num in sorted(cpus_):
+        cpu = cpus_[num]
+        if 'temperature' not in cpu:
+            continue
+
+        socketRe = SOCKET_LOCATION_RE.search(cpu.get('%location', ''))
+        key = (cpu.get('%parent'), socketRe.group(1) if socketRe else None)
+        if key not in index:
+            index[key] = len(packages)
+            packages.append(([], cpu.get('tjmax', TJMAX)))
+
+        packages[index[key]][0].append((str(num), cpu['temperature']))
 
-    return error, p
+    if not packages:
+        for num in sorted(amdtemps_):
+            cores = {}   # core: hottest of its sensors
+            for name, degrees in amdtemps_[num]:
+                coreRe = re.search(r'core(\d+)', name)   # 'core0.sensor0', 'core0.sensor1', 'sensor0.core0'
+                if not coreRe:
+                    continue
 
+                core = coreRe.group(1)
+                if     (core not in cores or
+                        int(degrees) > int(cores[core])):
 
-def getCpuData(pOut_):
-    '''Can work unexpectedly with multiple CPUs.'''
+                    cores[core] = degrees
+
+            if cores:
+                packages.append((list(cores.items()), TJMAX))
+
+    return packages
+
+
+def getCpuData(packages_):
+    '''Items of every package, numbered like cpuN in order of their first logical CPU.'''
     sender = []
     json = []
 
-    tempRe = re.findall(r'dev\.cpu\.(\d+)\.temperature:\s+(\d+)', pOut_, re.I)
-    if tempRe:
-        error = None
-        json.append({'{#CPU}':'0'})
+    allTemps = []
+    for cpuNum, (cores, tjMax) in enumerate(packages_):
+        json.append({'{#CPU}':str(cpuNum)})
 
-        allTemps = []
-        for num, val in tempRe:
-            allTemps.append(val)
-            sender.append('"%s" mini.cpu.temp[cpu0,core%s] "%s"' % (HOST, num, val))
-            json.append({'{#CPUC}':'0', '{#CORE}':num})
+        temps = []
+        for coreNum, degrees in cores:
+            temps.append(int(degrees))
+            sender.append(Metric(HOST, 'mini.cpu.temp', ('cpu%s' % cpuNum, 'core%s' % coreNum), degrees))
+            json.append({'{#CPUC}':str(cpuNum), '{#CORE}':coreNum})
 
-        sender.append('"%s" mini.cpu.info[cpu0,TjMax] "%s"'   % (HOST, TJMAX))
-        sender.append('"%s" mini.cpu.temp[cpu0,MAX] "%s"'     % (HOST, max(allTemps)))
-        sender.append('"%s" mini.cpu.temp[MAX] "%s"'          % (HOST, max(allTemps)))
+        allTemps.extend(temps)
+        sender.append(Metric(HOST, 'mini.cpu.info', ('cpu%s' % cpuNum, 'TjMax'), tjMax))
+        sender.append(Metric(HOST, 'mini.cpu.temp', ('cpu%s' % cpuNum, 'MAX'), max(temps)))
 
+    if allTemps:
+        error = None
+        sender.append(Metric(HOST, 'mini.cpu.temp', ('MAX',), max(allTemps)))
     else:
         error = 'NOCPUTEMPS'
 
     return sender, json, error
 
 
+def getBoardTemps(zones_):
+    '''ACPI thermal zones as board temperatures.'''
+    sender = []
+    json = []
+
+    for num in sorted(zones_):
+        sender.append(Metric(HOST, 'mini.brd.temp', (num,), zones_[num]))
+        json.append({'{#BRDTEMPNAME}':'tz%s' % num, '{#BRDTEMPNUM}':num})
+
+    return sender, json
+
+
+def coreTemps(items_):
+    '''Per-core temperatures as {'coreN': degrees}, overall MAX and cores reported twice of [key, value] items.'''
+    cores = {}
+    maximum = None
+    twice = []
+    for key, value in items_:
+        coreRe = re.match(r'^mini\.cpu\.temp\[cpu\d+,(core\d+)\]$', key)
+        if coreRe:
+            if coreRe.group(1) in cores:
+                twice.append(coreRe.group(1))
+            cores[coreRe.group(1)] = str(value)
+        elif key == 'mini.cpu.temp[MAX]':
+            maximum = str(value)
+
+    return cores, maximum, twice
+
+
+def checkFixtures(fixturesPath_):
+    '''Compare core temperatures of captured 'sysctl -i' outputs (NAME.txt) with NAME.expected, items of the
+    'dev.cpu' regexp used before the per-package model. Cores it did not know, like amdtemp, are only
+    checked for duplicates. Number of differences.'''
+    failed = 0
+    for name in sorted(os.listdir(fixturesPath_)):
+        if not name.endswith('.expected'):
+            continue
+
+        base = os.path.join(fixturesPath_, name[:-len('.expected')])
+        with open(base + '.expected', 'r') as f:
+            expected = loads(f.read())
+        with open(base + '.txt', 'r') as f:
+            cpus, amdtemps, zones = parseSysctl(f)
+
+        items = [[i.itemKey(), i.value] for i in getCpuData(buildPackages(cpus, amdtemps))[0]]
+        oldCores, oldMax, _ = coreTemps(expected)
+        newCores, newMax, twice = coreTemps(items)
+
+        differing = ['%s: expected %s, got %s' % (core, oldCores[core], newCores.get(core))
+                     for core in sorted(oldCores) if newCores.get(core) != oldCores[core]]
+        if     (oldMax is not None and
+                newMax != oldMax):
+
+            differing.append('MAX: expected %s, got %s' % (oldMax, newMax))
+
+        keys = [i[0] for i in items]
+        if len(keys) != len(set(keys)):
+            differing.append('duplicate items: %s' % sorted(set(i for i in keys if keys.count(i) > 1)))
+        if twice:
+            differing.append('cores in more packages: %s' % sorted(set(twice)))
+
+        print('%-24s %s' % (os.path.basename(base), 'DIFFERS' if differing else 'OK (%s cores)' % len(newCores)))
+        for line in differing:
+            print('    %s' % line)
+        failed += len(differing)
+
+    return failed
+
+
 if __name__ == '__main__':
 
     fail_ifNot_Py3()
+    if sys.argv[1] == 'check':   # mini_ipmi_bsdcpu.py check fixtures
+        sys.exit(1 if checkFixtures(sys.argv[2]) else 0)
+
+    singleFlight('cpu', HOST)   # exits here if the same run is already in flight
 
     senderData = []
     jsonData = []
 
-    p_Output = getOutput(BIN_PATH)
+    p_Output = readSysctl(BIN_PATH)
     pRunStatus = p_Output[0]
-    pOut = p_Output[1]
+    cpus, amdtemps, zones = p_Output[1]
+    clock = int(time())   # all values of this run share collection time
 
     errors = None
-    if pOut:
-        getCpuData_Out = getCpuData(pOut)
+    if pRunStatus == 'CONFIGURED':
+        getBoardTemps_Out = getBoardTemps(zones)
+        senderData.extend(getBoardTemps_Out[0])
+        jsonData.extend(getBoardTemps_Out[1])
+
+        getCpuData_Out = getCpuData(buildPackages(cpus, amdtemps))
         cpuErrors = getCpuData_Out[2]
         senderData.extend(getCpuData_Out[0])
         jsonData.extend(getCpuData_Out[1])
         if cpuErrors:
             errors = 'cpu_err'
-            senderData.append('"%s" mini.cpu.info[ConfigStatus] "%s"' % (HOST, cpuErrors))
+            senderData.append(Metric(HOST, 'mini.cpu.info', ('ConfigStatus',), cpuErrors))
 
     if not errors:
-        senderData.append('"%s" mini.cpu.info[ConfigStatus] "%s"' % (HOST, pRunStatus))   # OS_NOCMD, OS_ERROR, UNKNOWN_EXC_ERROR, CONFIGURED
+        senderData.append(Metric(HOST, 'mini.cpu.info', ('ConfigStatus',), pRunStatus))   # OS_NOCMD, OS_ERROR, UNKNOWN_EXC_ERROR, CONFIGURED
 
     link = r'https://github.com/nobodysu/zabbix-mini-IPMI/issues'
     sendStatusKey = 'mini.cpu.info[SendStatus]'
-    processData(senderData, jsonData, AGENT_CONF_PATH, SENDER_WRAPPER_PATH, SENDER_PATH, TIMEOUT, HOST, link, sendStatusKey)
+    processData(stampMetrics(senderData, clock), jsonData, AGENT_CONF_PATH, SENDER_WRAPPER_PATH, SENDER_PATH, TIMEOUT, HOST, link, sendStatusKey)
 
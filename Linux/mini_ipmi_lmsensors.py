@@ -5,6 +5,15 @@
 BIN_PATH = r'sensors'   # -u
 #BIN_PATH = r'/usr/bin/sensors'   # if 'sensors' isn't in PATH
 
+# ask 'sensors' for JSON (lm-sensors 3.5 and newer), older versions fall back to '-u' text and are not asked again for a day
+isSensorsJson = True
+
+# read kernel hwmon directly instead of running 'sensors', None to always run 'sensors'
+# chips matched by a 'chip' statement of sensors.conf are still read with 'sensors', so their labels,
+# 'compute' scaling and 'ignore' lines apply; 'sensors' is also used when nothing is found in hwmon
+HWMON_PATH = r'/sys/class/hwmon'
+SENSORS_CONF_PATHS = (r'/etc/sensors3.conf', r'/etc/sensors.conf', r'/etc/sensors.d')
+
 # path to second send script
 SENDER_WRAPPER_PATH = r'/etc/zabbix/scripts/sender_wrapper.py'
 
@@ -22,6 +31,18 @@ GATHER_BOARD_FANS   = True
 GATHER_BOARD_TEMPS  = True
 GATHER_GPU_DATA     = True
 GATHER_CPU_DATA     = True
+GATHER_CPU_THROTTLE = True   # thermal throttle counters and cpufreq of cores discovered by GATHER_CPU_DATA
+GATHER_CPU_POWER    = True   # RAPL energy counters, kernels since 5.10 allow only root to read them (RAPL_NOPERM), see README
+
+CPU_SYSFS_PATH = r'/sys/devices/system/cpu'
+GPU_DRM_PATH = r'/sys/class/drm'   # GPUs with hwmon: amdgpu, nouveau, radeon; None uses 'sensors' chips only
+NVIDIA_SMI_PATH = r'nvidia-smi'    # proprietary NVIDIA driver, queried once for all GPUs; None to skip
+PCI_DEVICES_PATH = r'/sys/bus/pci/devices'   # nvidia-smi is run only when a display device of NVIDIA is here
+POWERCAP_PATH = r'/sys/class/powercap'
+# Most power one RAPL domain can draw, watts. Counters wrap every max_energy_range_uj (~262 kJ on Intel), so runs longer
+# apart than max_energy_range_uj / RAPL_MAX_POWER could hide several wraps and are skipped. Raise it for packages drawing
+# more, with 'Update interval' of discovery rule lowered to match (262 kJ / 350 W = 750 s).
+RAPL_MAX_POWER = 200
 
 VOLTAGE_REGEXPS_KEYS_AND_JSONS = (
     ('Vcore',                               'cpuVcore', '{#VCORE}'),
@@ -35,25 +56,50 @@ VOLTAGE_REGEXPS_KEYS_AND_JSONS = (
     ('\+12 Voltage',                        'p12V',     '{#p12V}'),
 )
 
-# re.I | re.M
+# re.I, searched in 'chip/label' of temperature features, like 'coretemp-isa-0000/Core 0'
+# group 1 is core number, without group temperature input number is used; last matching regexp of chip wins
 CORES_REGEXPS = (
-    ('Core(?:\s+)?(\d+):\n\s+temp\d+_input:\s+(\d+)'),
-    ('Core(\d+)\s+Temp:\n\s+temp\d+_input:\s+(\d+)'),
-    ('Tdie:\n\s+temp(\d+)_input:\s+(\d+)'),
-    ('k\d+temp-pci-\w+\nAdapter:\s+PCI\s+adapter\ntemp(\d+):\n\s+temp\d+_input:\s+(\d+)'),
+    ('Core(?:\s+)?(\d+)$'),
+    ('Core(\d+)\s+Temp$'),
+    ('Tdie$'),
+    ('k\d+temp-pci-\w+/temp(\d+)$'),
 )
 
 TIMEOUT = '80'         # how long the script must wait between LLD and sending, increase if data received late (does not affect windows)
                        # this setting MUST be lower than 'Update interval' in discovery rule
 
+# Sample temperatures every SAMPLE_INTERVAL seconds between runs in a detached process, and send
+# min/max/avg/p95 of them with the next run, like 'mini.cpu.temp[cpu0,core3,p95]'. 0 disables.
+# Chips and GPUs are found once per run, samples are read from their hwmon sysfs only: nothing is sampled
+# without hwmon, NVIDIA GPUs of nvidia-smi are not sampled and sensors.conf 'compute' does not apply to samples.
+SAMPLE_INTERVAL = 0
+RUN_INTERVAL = 1080                    # seconds, 'Update interval' of CPU discovery rule
+SAMPLE_DURATION = RUN_INTERVAL - 60    # seconds, sampling covers the interval and ends before the next run reads it
+
 ## End of configuration ##
 
 import sys
+import os
 import subprocess
 import re
-from sender_wrapper import (readConfig, processData, fail_ifNot_Py3, removeQuotes)
+from array import array
+from fnmatch import fnmatchcase
+from time import time, sleep
+from json import loads, dumps
+from sender_wrapper import (readConfig, processData, fail_ifNot_Py3, removeQuotes, Metric, stampMetrics, singleFlight,
+                            loadState, saveState, statePath, isStaleLock, sanitizeStr)
 
 HOST = sys.argv[2]
+
+INPUT_RE = re.compile(r'^([a-z]+)(\d+)_input$')
+INT_VALUE_RE = re.compile(r'^\d+')
+FLOAT_VALUE_RE = re.compile(r'^\d+\.\d+')
+CRIT_VALUE_RE = re.compile(r'^(\d+)\.\d+')
+BOARD_TEMP_NAME_RE = re.compile(r'(?:CPU|GPU|MB|M/B|AUX|Ambient|Other|SYS|Processor).+', re.I)
+GPU_CHIP_RE = re.compile(r'(?:nouveau|nvidia|radeon).+', re.I)
+CORES_RES = [re.compile(i, re.I) for i in CORES_REGEXPS]
+VOLTAGE_RES = [(re.compile(regexp, re.I), key, jsn) for regexp, key, jsn in VOLTAGE_REGEXPS_KEYS_AND_JSONS]
+VOLTAGE_KEYS_CACHE = {}
     
     
 def getOutput(binPath_):
@@ -86,72 +132,623 @@ def getOutput(binPath_):
     else:
         error = 'CONFIGURED'
 
+    chips = None
     if p:
-        p = p.strip()
-        p = p.split('\n\n')
+        chips = parseSensors(p)
+
+    return error, chips
+
+
+def getJsonOutput(binPath_):
+    '''Same as getOutput() with 'sensors -j', None if unsupported so '-u' is used.'''
+    if loadState('lmsensors_nojson', 0) > time() - 86400:
+        return None
+
+    try:
+        from subprocess import DEVNULL
+    except:
+        DEVNULL = open(os.devnull, 'w')
+
+    try:
+        p = subprocess.check_output([binPath_, '-j'], universal_newlines=True, stderr=DEVNULL)
+    except OSError:
+        return None   # let getOutput() report it
+    except subprocess.CalledProcessError as e:
+        p = e.output   # some chips failed, others may be fine
+        if not p.strip().startswith('{'):
+            saveState('lmsensors_nojson', time())   # unknown option
+            return None
+
+    chips = parseSensorsJson(p)
+    if chips is None:
+        saveState('lmsensors_nojson', time())   # some 3.5 releases print broken JSON
+        return None
+
+    return 'CONFIGURED', chips
+
+
+def parseSensorsJson(pOut_):
+    '''Decode 'sensors -j' output into the same chips as parseSensors(), None if it is not valid.'''
+    try:
+        decoded = loads(pOut_, object_pairs_hook=lambda pairs: pairs)   # keep order of chips and features
+    except ValueError:
+        return None
+
+    if not isinstance(decoded, list):
+        return None
+
+    chips = []
+    for name, chipItems in decoded:
+        if not isinstance(chipItems, list):
+            continue
+
+        chip = {'name': name, 'adapter': '', 'features': []}
+        for label, featureItems in chipItems:
+            if label == 'Adapter':
+                chip['adapter'] = featureItems
+            elif isinstance(featureItems, list):
+                subfeatures = [(sub, '%.3f' % value) for sub, value in featureItems if isinstance(value, (int, float))]
+                if subfeatures:
+                    chip['features'].append((label, subfeatures))
+
+        chips.append(indexChip(chip))
+
+    return chips
+
+
+def indexChip(chip_):
+    '''Add lookup indexes to parsed chip: its first subfeature and inputs of every feature type.'''
+    chip_['inputs'] = {}   # type: [(label, number, value)], only features starting with their input like regexps expected
+    chip_['first'] = None   # (type, number, label, value) of first feature
+    for label, subfeatures in chip_['features']:
+        inputRe = INPUT_RE.match(subfeatures[0][0])
+        if inputRe:
+            featureType, num = inputRe.groups()
+            chip_['inputs'].setdefault(featureType, []).append((label, num, subfeatures[0][1]))
+            if chip_['first'] is None:
+                chip_['first'] = (featureType, num, label, subfeatures[0][1])
+
+        elif chip_['first'] is None:
+            chip_['first'] = ('', '', label, subfeatures[0][1])
+
+    return chip_
+
+
+def parseSensors(pOut_):
+    '''Parse 'sensors -u' output in one pass into chips: {'name', 'adapter', 'features': [(label, [(subfeature, value)])]}.'''
+    chips = []
+    chip = None
+    features = None
+    subfeatures = None
+    for line in pOut_.strip().splitlines():
+        if not line.strip():
+            chip = None   # blank line ends chip
+        elif chip is None:
+            features = []
+            subfeatures = None
+            chip = {'name': line, 'adapter': '', 'features': features}
+            chips.append(chip)
+        elif line[0] in ' \t':
+            sub, sep, value = line.strip().partition(':')
+            if     (sep and
+                    subfeatures is not None):
+
+                subfeatures.append((sub, value.strip()))
+        elif     (line.startswith('Adapter: ') and
+                  not features):
+
+            chip['adapter'] = line[9:]
+        elif line.endswith(':'):
+            subfeatures = []
+            features.append((line[:-1], subfeatures))
+
+    for chip in chips:
+        chip['features'] = [i for i in chip['features'] if i[1]]
+        indexChip(chip)
+
+    return chips
+
+
+def intInputs(chip_, type_):
+    '''Inputs of type with integer part of value, skipping negative or unparsable ones.'''
+    inputs = []
+    for name, num, val in chip_['inputs'].get(type_, ()):
+        valRe = INT_VALUE_RE.match(val)
+        if valRe:
+            inputs.append((name, num, valRe.group(0)))
+
+    return inputs
+
+
+def voltageKeys(name_):
+    '''Keys and LLD macros of VOLTAGE_REGEXPS_KEYS_AND_JSONS matching voltage name, memoized.'''
+    if name_ not in VOLTAGE_KEYS_CACHE:
+        VOLTAGE_KEYS_CACHE[name_] = [(key, jsn) for regexp, key, jsn in VOLTAGE_RES if regexp.search(name_)]
+
+    return VOLTAGE_KEYS_CACHE[name_]
+
+
+# same order as 'sensors -u' prints them
+HWMON_FEATURE_TYPES = ('in', 'fan', 'temp', 'power', 'energy', 'curr', 'humidity', 'intrusion')
+HWMON_SUBFEATURES = ('input', 'average', 'min', 'max', 'max_hyst', 'min_hyst', 'lcrit', 'lcrit_hyst', 'crit', 'crit_hyst',
+                     'emergency', 'emergency_hyst', 'lowest', 'highest', 'alarm', 'min_alarm', 'max_alarm', 'lcrit_alarm',
+                     'crit_alarm', 'emergency_alarm', 'fault', 'type', 'offset', 'beep')
+HWMON_SCALES = {'in': 1000.0, 'fan': 1.0, 'temp': 1000.0, 'power': 1000000.0, 'energy': 1000000.0,
+                'curr': 1000.0, 'humidity': 1000.0, 'intrusion': 1.0}
+HWMON_ATTR_RE = re.compile(r'^(%s)(\d+)_(\w+)$' % '|'.join(HWMON_FEATURE_TYPES))
+
+
+def readSysfs(path_):
+    try:
+        with open(path_, 'r') as f:
+            return f.read().strip()
+    except (OSError, IOError):
+        return None
+
+
+def hwmonChipName(name_, hwmonDir_):
+    '''Chip name and adapter as libsensors shows them, like 'coretemp-isa-0000' and 'ISA adapter'.'''
+    device = os.path.join(hwmonDir_, 'device')
+    if not os.path.exists(device):
+        return '%s-virtual-0' % name_, 'Virtual device'
+
+    deviceName = os.path.basename(os.path.realpath(device))
+    subsystem = os.path.basename(os.path.realpath(os.path.join(device, 'subsystem')))
+    if subsystem == 'pci':
+        pciRe = re.match(r'^[\da-f]+:([\da-f]+):([\da-f]+)\.(\d+)$', deviceName, re.I)
+        if pciRe:
+            addr = (int(pciRe.group(1), 16) << 8) | (int(pciRe.group(2), 16) << 3) | int(pciRe.group(3))
+            return '%s-pci-%04x' % (name_, addr), 'PCI adapter'
+    elif subsystem in ('platform', 'of_platform', 'isa'):
+        isaRe = re.match(r'^[\w-]+\.(\d+)$', deviceName)
+        if isaRe:
+            addr = int(isaRe.group(1))
+        else:
+            addr = 0
+        return '%s-isa-%04x' % (name_, addr), 'ISA adapter'
+    elif subsystem == 'i2c':
+        i2cRe = re.match(r'^(\d+)-([\da-f]+)$', deviceName, re.I)
+        if i2cRe:
+            adapter = readSysfs(os.path.join(device, '..', 'name')) or 'I2C adapter'
+            return '%s-i2c-%s-%02x' % (name_, i2cRe.group(1), int(i2cRe.group(2), 16)), adapter
+    elif subsystem == 'acpi':
+        acpiRe = re.search(r':(\d+)$', deviceName)
+        if acpiRe:
+            return '%s-acpi-%s' % (name_, int(acpiRe.group(1))), 'ACPI interface'
+
+    return '%s-%s-0' % (name_, subsystem), '%s adapter' % subsystem.upper()
+
+
+def readHwmonChip(hwmonDir_):
+    '''Chip of one hwmon directory like parseSensors() makes it, None if empty.'''
+    attrDir = hwmonDir_
+    name = readSysfs(os.path.join(hwmonDir_, 'name'))
+    if name is None:   # old drivers keep attributes on device
+        attrDir = os.path.join(hwmonDir_, 'device')
+        name = readSysfs(os.path.join(attrDir, 'name'))
+        if name is None:
+            return None
+
+    try:
+        attrs = os.listdir(attrDir)
+    except OSError:
+        return None
+
+    features = {}   # (type index, number): {subfeature: attribute}
+    for attr in attrs:
+        attrRe = HWMON_ATTR_RE.match(attr)
+        if attrRe:
+            featureType, num, sub = attrRe.groups()
+            features.setdefault((HWMON_FEATURE_TYPES.index(featureType), int(num)), {})[sub] = attr
+
+    chipFeatures = []
+    for typeIndex, num in sorted(features):
+        featureType = HWMON_FEATURE_TYPES[typeIndex]
+        feature = '%s%s' % (featureType, num)
+        subs = features[(typeIndex, num)]
+
+        subfeatures = []
+        for sub in sorted(subs, key=lambda k: (HWMON_SUBFEATURES.index(k) if k in HWMON_SUBFEATURES else len(HWMON_SUBFEATURES), k)):
+            if sub == 'label':
+                continue
+
+            raw = readSysfs(os.path.join(attrDir, subs[sub]))
+            try:
+                value = float(raw)
+            except (TypeError, ValueError):
+                continue   # unreadable or faulty sensor
+
+            if     (sub not in ('type', 'beep') and
+                    not sub.endswith(('alarm', 'fault'))):
+
+                value = value / HWMON_SCALES[featureType]
+            subfeatures.append(('%s_%s' % (feature, sub), '%.3f' % value))   # as 'sensors -u' prints it
+
+        if subfeatures:
+            label = readSysfs(os.path.join(attrDir, subs['label'])) if 'label' in subs else None
+            chipFeatures.append((label or feature, subfeatures))
+
+    if not chipFeatures:
+        return None
+
+    chipName, adapter = hwmonChipName(name, hwmonDir_)
+
+    return indexChip({'name': chipName, 'adapter': adapter, 'features': chipFeatures, 'path': attrDir})
+
+
+def refreshChip(chip_):
+    '''Copy of chip read from hwmon with current values of its inputs, other subfeatures and unreadable inputs dropped.'''
+    features = []
+    for label, subfeatures in chip_['features']:
+        inputRe = INPUT_RE.match(subfeatures[0][0])
+        if not inputRe:
+            continue
+
+        try:
+            value = float(readSysfs(os.path.join(chip_['path'], subfeatures[0][0])))
+        except (TypeError, ValueError):
+            continue
+        features.append((label, [(subfeatures[0][0], '%.3f' % (value / HWMON_SCALES[inputRe.group(1)]))]))
+
+    return indexChip({'name': chip_['name'], 'adapter': chip_['adapter'], 'features': features, 'path': chip_['path']})
+
+
+def getHwmonOutput(hwmonPath_):
+    '''Same as getOutput() but read from hwmon sysfs, None when there is nothing to read.'''
+    try:
+        hwmons = os.listdir(hwmonPath_)
+    except OSError:
+        return None
+
+    chips = []
+    for hwmon in sorted(hwmons, key=lambda k: int(re.sub(r'\D', '', k) or 0)):
+        chip = readHwmonChip(os.path.join(hwmonPath_, hwmon))
+        if chip:
+            chips.append(chip)
+
+    if not chips:
+        return None
+
+    return 'CONFIGURED', chips
+
+
+def readConfChipPatterns(confPaths_):
+    '''Chip name patterns of all 'chip' statements in sensors.conf files, like 'it87-*'.'''
+    files = []
+    for path in confPaths_:
+        if os.path.isdir(path):
+            try:
+                files.extend(os.path.join(path, i) for i in sorted(os.listdir(path)))
+            except OSError:
+                pass
+        else:
+            files.append(path)
+
+    patterns = []
+    for path in files:
+        try:
+            with open(path, 'r', errors='replace') as f:
+                text = f.read()
+        except (OSError, IOError):
+            continue
+
+        for line in text.replace('\\\n', ' ').splitlines():   # joined continuation lines
+            line = line.split('#', 1)[0].strip()
+            if line.startswith('chip'):
+                patterns.extend(a or b for a, b in re.findall(r'"([^"]*)"|(\S+)', line[4:]))
+
+    return patterns
+
+
+def readSensorsChips():
+    '''Chips from 'sensors -j', or 'sensors -u' when JSON is unsupported.'''
+    p_Output = None
+    if isSensorsJson:
+        p_Output = getJsonOutput(BIN_PATH)
+    if not p_Output:
+        p_Output = getOutput(BIN_PATH)
+
+    return p_Output
+
+
+def readChips():
+    '''Chips from hwmon sysfs, with the ones sensors.conf configures, or all when hwmon has none, from 'sensors'.'''
+    p_Output = None
+    if HWMON_PATH:
+        p_Output = getHwmonOutput(HWMON_PATH)
+    if not p_Output:
+        return readSensorsChips()
+
+    patterns = readConfChipPatterns(SENSORS_CONF_PATHS)
+    configured = [i['name'] for i in p_Output[1] if any(fnmatchcase(i['name'], j) for j in patterns)]
+    if not configured:
+        return p_Output
+
+    sensorsChips = readSensorsChips()[1]
+    if not sensorsChips:
+        return p_Output   # 'sensors' failed, unconfigured values are better than none
+
+    byName = dict((i['name'], i) for i in sensorsChips)
+    chips = []
+    for chip in p_Output[1]:
+        if chip['name'] not in configured:
+            chips.append(chip)
+        elif chip['name'] in byName:   # dropped when the whole chip is ignored
+            chips.append(dict(byName[chip['name']], path=chip['path']))
+
+    return p_Output[0], chips
+
+
+def percentile(sorted_, percent_):
+    '''Nearest-rank percentile of sorted values.'''
+    rank = max(int(-(-len(sorted_) * percent_ // 100)), 1)
 
-    return error, p
+    return sorted_[rank - 1]
 
 
-def getVoltages(pOut_):
+def runSampler():
+    '''Read temperatures every SAMPLE_INTERVAL for SAMPLE_DURATION, keep only aggregates for next run.'''
+    name = 'samples_cpu_%s' % sanitizeStr(HOST)
+    try:
+        lockPath = statePath('sampler_cpu_%s' % sanitizeStr(HOST))
+    except OSError:
+        return   # no safe state directory, nothing to keep samples in
+
+    for attempt in range(2):
+        try:
+            fd = os.open(lockPath, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            break
+        except OSError:
+            if     (attempt or
+                    not isStaleLock(lockPath)):
+
+                return   # previous sampler still running
+            try:
+                os.remove(lockPath)
+            except OSError:
+                pass
+    os.write(fd, str(os.getpid()).encode())
+    os.close(fd)
+
+    try:
+        buffers = {}   # (key, params): array of samples
+        deadline = time() + SAMPLE_DURATION
+        baseChips = [i for i in readChips()[1] or () if i.get('path')]   # spawns 'sensors' only here
+        baseGpus = readDrmGpus(GPU_DRM_PATH, PCI_DEVICES_PATH, NVIDIA_SMI_PATH)
+        while     (time() < deadline and
+                   (baseChips or baseGpus)):
+
+            started = time()
+            chips = [refreshChip(i) for i in baseChips]
+            gpus = []
+            for gpuid, temp, fan, memTotal, memUsed, memFree, chip in baseGpus:
+                if chip:
+                    temps = intInputs(refreshChip(chip), 'temp')
+                    temp = temps[0][2] if temps else None
+                else:
+                    temp = None   # nvidia-smi
+                gpus.append((gpuid, temp, fan, memTotal, memUsed, memFree, chip))
+
+            if chips or gpus:
+                metrics = getCpuData(chips)[0] + getBoardTemps(chips)[0] + (getDrmGpuData(gpus) or getGpuData(chips))[0]
+                for metric in metrics:
+                    if     (not metric.key.endswith('.temp') or
+                            'MAX' in metric.params):
+
+                        continue
+                    buffers.setdefault((metric.key, tuple(metric.params)), array('f')).append(float(metric.value))
+
+            sleep(max(min(SAMPLE_INTERVAL - (time() - started), deadline - time()), 0))
+
+        stats = []
+        for (key, params), samples in buffers.items():
+            ordered = sorted(samples)
+            stats.append([key, list(params), ordered[0], ordered[-1], round(sum(ordered) / len(ordered), 2),
+                          percentile(ordered, 95)])
+
+        saveState(name, {'clock': int(time()), 'stats': stats})
+    finally:
+        os.remove(lockPath)
+
+
+def sampledMetrics():
+    '''Aggregates left by previous sampler as metrics, each sent only once.'''
+    name = 'samples_cpu_%s' % sanitizeStr(HOST)
+    state = loadState(name, {})
+    try:
+        os.remove(statePath(name))
+    except OSError:
+        pass
+
+    if state.get('clock', 0) < time() - RUN_INTERVAL:
+        return []   # sampler did not run during last interval
+
+    metrics = []
+    for key, params, minimum, maximum, average, p95 in state.get('stats', ()):
+        for stat, value in (('min', minimum), ('max', maximum), ('avg', average), ('p95', p95)):
+            metrics.append(Metric(HOST, key, tuple(params) + (stat,), '%g' % value, state['clock']))
+
+    return metrics
+
+
+def startSampler():
+    try:
+        from subprocess import DEVNULL
+    except:
+        DEVNULL = open(os.devnull, 'w')
+
+    try:
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), 'sample', HOST],
+                         stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL, close_fds=True, start_new_session=True)
+    except OSError:
+        pass
+
+
+def benchBackends(rounds_):
+    '''Print time per read of hwmon sysfs against running 'sensors -u', and time to parse its output.'''
+    for title, fetch in (('hwmon sysfs', lambda: getHwmonOutput(HWMON_PATH)), ('sensors -j', lambda: getJsonOutput(BIN_PATH)),
+                         ('sensors -u', lambda: getOutput(BIN_PATH))):
+        started = time()
+        for i in range(rounds_):
+            out = fetch()
+        elapsed = time() - started
+        if out and out[1]:
+            print('%-12s %8.2f ms per read, %s chips' % (title + ':', elapsed / rounds_ * 1000, len(out[1])))
+        else:
+            print('%-12s not available' % (title + ':'))
+
+    try:
+        pOut = subprocess.check_output([BIN_PATH, '-u'], universal_newlines=True)
+    except Exception:
+        return
+
+    started = time()
+    for i in range(rounds_):
+        parseSensors(pOut)
+    elapsed = time() - started
+    print('%-12s %8.2f ms per parse, %s lines' % ('parse:', elapsed / rounds_ * 1000, len(pOut.splitlines())))
+
+
+def fixtureResult(chips_):
+    '''Items as [key, value] and LLD of every collecting function, as in a '.expected' fixture.'''
+    result = {}
+    for function in (getVoltages, getBoardFans, getBoardTemps, getGpuData, getCpuData):
+        out = function(chips_)
+        result[function.__name__] = [[[i.itemKey(), str(i.value)] for i in out[0]], out[1], out[2] if len(out) > 2 else None]
+
+    return loads(dumps(result))
+
+
+def sysfsResult(root_, nvidiaSmiPath_):
+    '''Like fixtureResult() for chips of a synthetic sysfs tree, read from its class/hwmon, with cpufreq and
+    throttle counters of its devices/system/cpu, RAPL counters of class/powercap and GPUs of class/drm,
+    where NVIDIA ones are queried with stand-in nvidia-smi.'''
+    hwmon_Out = getHwmonOutput(os.path.join(root_, 'class', 'hwmon'))
+    if hwmon_Out:
+        chips = hwmon_Out[1]
+    else:
+        chips = []
+
+    result = fixtureResult(chips)
+    freqs, counters = readThrottleData(getCpuData(chips), os.path.join(root_, 'devices', 'system', 'cpu'))
+    result['readThrottleData'] = [[[i.itemKey(), str(i.value)] for i in freqs], [[list(i), j] for i, j in counters]]
+    counters, error = readRaplCounters(os.path.join(root_, 'class', 'powercap'))
+    result['readRaplCounters'] = [[[i] + list(counters[i]) for i in sorted(counters)], error]
+
+    gpus = readDrmGpus(os.path.join(root_, 'class', 'drm'), os.path.join(root_, 'bus', 'pci', 'devices'), nvidiaSmiPath_)
+    drm_Out = getDrmGpuData(gpus)
+    if drm_Out:
+        result['getDrmGpuData'] = [[[i.itemKey(), str(i.value)] for i in drm_Out[0]], drm_Out[1], drm_Out[2]]
+    else:
+        result['getDrmGpuData'] = None
+
+    return loads(dumps(result))
+
+
+def checkFixtures(fixturesPath_):
+    '''Compare items and LLD of captured 'sensors -u' (NAME.txt) and 'sensors -j' (NAME.json) outputs, and of
+    synthetic hwmon sysfs tree (NAME.sysfs) with stand-in NAME.nvidia-smi, with NAME.expected, made by the text
+    parser before chips were parsed into a tree. Keys of sysfs-only readers in it were verified by hand. Number of differences.'''
+    failed = 0
+    for name in sorted(os.listdir(fixturesPath_)):
+        if not name.endswith('.expected'):
+            continue
+
+        base = os.path.join(fixturesPath_, name[:-len('.expected')])
+        with open(base + '.expected', 'r') as f:
+            expected = loads(f.read())
+
+        for suffix, parse in (('.txt', parseSensors), ('.json', parseSensorsJson), ('.sysfs', None)):
+            if not os.path.exists(base + suffix):
+                continue
+
+            if parse:
+                with open(base + suffix, 'r') as f:
+                    result = fixtureResult(parse(f.read()))
+            else:
+                result = sysfsResult(base + suffix, base + '.nvidia-smi')
+
+            differing = [i for i in sorted(expected) if result.get(i) != expected[i]]
+            keys = [i[0] for function in result.values() if function for i in function[0]]
+            if len(keys) != len(set(keys)):
+                differing.append('duplicate items')
+
+            print('%-24s %-5s %s' % (os.path.basename(base), suffix[1:], 'DIFFERS' if differing else 'OK'))
+            for function in differing:
+                print('    %s:\n      expected %s\n      got      %s' % (function, expected.get(function), result.get(function)))
+            failed += len(differing)
+
+    return failed
+
+
+def getVoltages(chips_):
     sender = []
     json = []
 
-    for block in pOut_:
-        if 'Adapter: PCI adapter' in block:   # we dont need GPU voltages
+    for chip in chips_:
+        if chip['adapter'] == 'PCI adapter':   # we dont need GPU voltages
             continue
 
-        voltagesRe = re.findall(r'(.+):\n(?:\s+)?in(\d+)_input:\s+(\d+\.\d+)', block, re.I)
-        if voltagesRe:
-            for name, num, val in voltagesRe:
-            
-                for regexp, key, jsn in VOLTAGE_REGEXPS_KEYS_AND_JSONS:
-                    if re.search(regexp, name, re.I):
-                        sender.append('"%s" mini.brd.vlt[%s] "%s"' % (HOST, key, removeQuotes(val)))
-                        json.append({jsn:key})
- 
-                sender.append('"%s" mini.brd.vlt[%s] "%s"' % (HOST, num, removeQuotes(val)))   # static items for graph, could be duplicate
+        voltages = []
+        for name, num, val in chip['inputs'].get('in', ()):
+            valRe = FLOAT_VALUE_RE.match(val)
+            if valRe:
+                voltages.append((name, num, valRe.group(0)))
+
+        if voltages:
+            for name, num, val in voltages:
+
+                for key, jsn in voltageKeys(name):
+                    sender.append(Metric(HOST, 'mini.brd.vlt', (key,), removeQuotes(val)))
+                    json.append({jsn:key})
+
+                sender.append(Metric(HOST, 'mini.brd.vlt', (num,), removeQuotes(val)))   # static items for graph, could be duplicate
 
             break   # as safe as possible
 
     return sender, json
 
 
-def getBoardFans(pOut_):
+def getBoardFans(chips_):
 
     sender = []
     json = []
 
-    for i in pOut_:
-        if 'Adapter: PCI adapter' in i:   # we dont need GPU fans
+    for chip in chips_:
+        if chip['adapter'] == 'PCI adapter':   # we dont need GPU fans
             continue
- 
-        fans = re.findall(r'(.+):\n(?:\s+)?fan(\d+)_input:\s+(\d+)', i, re.I)
+
+        fans = intInputs(chip, 'fan')
         if fans:
             for name, num, val in fans:
                 # only create LLD when speed is not zero, BUT always send values including zero (prevents false triggering)
-                sender.append('"%s" mini.brd.fan[%s,rpm] "%s"' % (HOST, num, val))
+                sender.append(Metric(HOST, 'mini.brd.fan', (num, 'rpm'), val))
                 if val != '0':
                     json.append({'{#BRDFANNAME}':name.strip(), '{#BRDFANNUM}':num})
- 
+
             break
 
     return sender, json
 
 
-def getBoardTemps(pOut_):
+def getBoardTemps(chips_):
 
     sender = []
     json = []
 
-    for i in pOut_:
-        if 'Adapter: PCI adapter' in i:   # we dont need GPU temps
+    for chip in chips_:
+        if chip['adapter'] == 'PCI adapter':   # we dont need GPU temps
             continue
- 
-        temps = re.findall(r'((?:CPU|GPU|MB|M/B|AUX|Ambient|Other|SYS|Processor).+):\n(?:\s+)?temp(\d+)_input:\s+(\d+)', i, re.I)
+
+        temps = []
+        for name, num, val in intInputs(chip, 'temp'):
+            nameRe = BOARD_TEMP_NAME_RE.search(name)
+            if nameRe:
+                temps.append((nameRe.group(0), num, val))
+
         if temps:
             for name, num, val in temps:
-                sender.append('"%s" mini.brd.temp[%s] "%s"' % (HOST, num, val))
+                sender.append(Metric(HOST, 'mini.brd.temp', (num,), val))
                 json.append({'{#BRDTEMPNAME}':name.strip(), '{#BRDTEMPNUM}':num})
 
             break
@@ -159,32 +756,37 @@ def getBoardTemps(pOut_):
     return sender, json
 
 
-def getGpuData(pOut_):
+def getGpuData(chips_):
 
     sender = []
     json = []
 
     gpuBlocks = -1
     allTemps = []
-    for i in pOut_:
-        temp = re.search(r'(nouveau.+|nvidia.+|radeon.+)\n.+\n.+\n(?:\s+)?temp\d+_input:\s+(\d+)', i, re.I)
-        if temp:
-            gpuid = temp.group(1)
-            val = temp.group(2)
+    for chip in chips_:
+        gpuRe = GPU_CHIP_RE.search(chip['name'])
+        first = chip['first']
+        if     (gpuRe and
+                first and
+                first[0] == 'temp' and
+                INT_VALUE_RE.match(first[3])):
+
+            gpuid = gpuRe.group(0)
+            val = INT_VALUE_RE.match(first[3]).group(0)
 
             gpuBlocks += 1
             allTemps.append(int(val))
 
             json.append({'{#GPU}':gpuBlocks})
-            sender.append('"%s" mini.gpu.info[gpu%s,ID] "%s"' % (HOST, gpuBlocks, removeQuotes(gpuid)))
+            sender.append(Metric(HOST, 'mini.gpu.info', ('gpu%s' % gpuBlocks, 'ID'), removeQuotes(gpuid)))
 
             json.append({'{#GPUTEMP}':gpuBlocks})
-            sender.append('"%s" mini.gpu.temp[gpu%s] "%s"' % (HOST, gpuBlocks, val))
+            sender.append(Metric(HOST, 'mini.gpu.temp', ('gpu%s' % gpuBlocks,), val))
 
     if gpuBlocks != -1:
         if allTemps:
             error = None
-            sender.append('"%s" mini.gpu.temp[MAX] "%s"' % (HOST, max(allTemps)))
+            sender.append(Metric(HOST, 'mini.gpu.temp', ('MAX',), max(allTemps)))
         else:
             error = 'NOGPUTEMPS'   # unreachable
     else:
@@ -193,63 +795,435 @@ def getGpuData(pOut_):
     return sender, json, error
 
 
-def chooseCpuRegexp(block_):
+def readCpuTopology(cpuPath_):
+    '''Logical cpus grouped by (package, die, core) ids: [cpu directory].'''
+    try:
+        entries = os.listdir(cpuPath_)
+    except OSError:
+        return {}
+
+    cores = {}
+    for entry in entries:
+        if re.match(r'^cpu\d+$', entry):
+            cpuDir = os.path.join(cpuPath_, entry)
+            package = readSysfs(os.path.join(cpuDir, 'topology', 'physical_package_id'))
+            die = readSysfs(os.path.join(cpuDir, 'topology', 'die_id')) or '0'   # before 5.3 kernels
+            core = readSysfs(os.path.join(cpuDir, 'topology', 'core_id'))
+            if     (package is not None and
+                    core is not None):
+
+                cores.setdefault((package, die, core), []).append(cpuDir)
+
+    return cores
+
 
-    result = ''
-    for regexp in CORES_REGEXPS:
-        match = re.search(regexp, block_, re.I | re.M)
-        if match:
-            result = regexp
+def readIntSysfs(paths_):
+    '''Largest integer among files of sibling threads, None if none is readable.'''
+    values = []
+    for path in paths_:
+        value = readSysfs(path)
+        if value and value.isdigit():
+            values.append(int(value))
 
-    return result
+    if values:
+        return max(values)
 
+    return None
 
-def getCpuData(pOut_):
+
+def readThrottleData(cpuOut_, cpuPath_):
+    '''Core frequencies and throttle counters of coretemp cores in CPU LLD, as metrics and [(params, counter)].
+
+    Coretemp labels cores by core_id of topology, and its chip coretemp-isa-000N by logical die id, which the
+    kernel numbers in order of physical_package_id and die_id. Other chips, like k10temp, number temperature
+    inputs instead of cores and are skipped.'''
+    sender = []
+    counters = []
+
+    chipCpus = {}   # logical die id: cpu of LLD
+    for metric in cpuOut_[0]:
+        if     (metric.key == 'mini.cpu.info' and
+                metric.params[1] == 'ID'):
+
+            chipRe = re.match(r'^coretemp-isa-([\da-f]+)$', metric.value)
+            if chipRe:
+                chipCpus[int(chipRe.group(1), 16)] = metric.params[0]
+
+    discovered = set([('cpu%s' % i['{#CPUC}'], i['{#CORE}']) for i in cpuOut_[1] if '{#CORE}' in i])
+
+    cores = readCpuTopology(cpuPath_)
+    dies = sorted(set([(int(package), int(die)) for package, die, core in cores]))
+    packagesDone = set()
+    for (package, die, core), cpuDirs in sorted(cores.items(), key=lambda k: [int(i) for i in k[0]]):
+        cpuParam = chipCpus.get(dies.index((int(package), int(die))))
+        if (cpuParam, core) not in discovered:
+            continue
+
+        coreParam = 'core%s' % core
+        for counter, stat in (('core_throttle_count', 'count'), ('core_throttle_total_time_ms', 'time')):
+            value = readIntSysfs([os.path.join(i, 'thermal_throttle', counter) for i in cpuDirs])
+            if value is not None:
+                counters.append(((cpuParam, coreParam, stat), value))
+
+        if cpuParam not in packagesDone:
+            packagesDone.add(cpuParam)
+            for counter, stat in (('package_throttle_count', 'count'), ('package_throttle_total_time_ms', 'time')):
+                value = readIntSysfs([os.path.join(i, 'thermal_throttle', counter) for i in cpuDirs])
+                if value is not None:
+                    counters.append(((cpuParam, 'package', stat), value))
+
+        curFreq = readIntSysfs([os.path.join(i, 'cpufreq', 'scaling_cur_freq') for i in cpuDirs])
+        if curFreq is not None:
+            sender.append(Metric(HOST, 'mini.cpu.freq', (cpuParam, coreParam), curFreq * 1000))   # kHz
+
+        maxFreq = readIntSysfs([os.path.join(i, 'cpufreq', 'cpuinfo_max_freq') for i in cpuDirs])
+        if maxFreq is not None:
+            sender.append(Metric(HOST, 'mini.cpu.freq', (cpuParam, coreParam, 'max'), maxFreq * 1000))
+
+    return sender, counters
+
+
+def getThrottleData(cpuOut_):
+    '''Throttle counter deltas since previous run and core frequencies, for coretemp cores in CPU LLD.'''
+    sender, counters = readThrottleData(cpuOut_, CPU_SYSFS_PATH)
+
+    name = 'throttle_cpu_%s' % sanitizeStr(HOST)
+    previous = loadState(name, {})
+    current = {}
+    for params, value in counters:
+        key = ','.join(params)
+        current[key] = value
+        if key in previous:
+            if value >= previous[key]:
+                sender.append(Metric(HOST, 'mini.cpu.throttle', params, value - previous[key]))
+            else:
+                sender.append(Metric(HOST, 'mini.cpu.throttle', params, value))   # counters reset by reboot
+
+    if     (current or
+            previous):
+
+        saveState(name, current)
+
+    return sender
+
+
+def readRaplCounters(powercapPath_):
+    '''Energy counters of RAPL zones as {domain: (energy uJ, wrap range uJ)}, like 'package-0' and 'package-0-dram',
+    and RAPL_NOPERM error when some counter could not be read for lack of permission.'''
+    try:
+        entries = os.listdir(powercapPath_)
+    except OSError:
+        return {}, None
+
+    names = {}
+    counters = {}
+    error = None
+    for entry in sorted(entries, key=lambda k: [int(i) for i in re.findall(r'\d+', k)]):
+        zoneRe = re.match(r'^intel-rapl:(\d+)(:\d+)?$', entry)   # AMD zones are registered as intel-rapl too
+        if not zoneRe:
+            continue
+
+        zoneDir = os.path.join(powercapPath_, entry)
+        name = readSysfs(os.path.join(zoneDir, 'name'))
+        if not name:
+            continue
+
+        if zoneRe.group(2):
+            parent = names.get(zoneRe.group(1))
+            if not parent:
+                continue
+            domain = '%s-%s' % (parent, name)
+        else:
+            names[zoneRe.group(1)] = name
+            domain = name
+
+        try:
+            with open(os.path.join(zoneDir, 'energy_uj'), 'r') as f:
+                energy = f.read().strip()
+        except PermissionError:
+            error = 'RAPL_NOPERM'   # root only since 5.10
+            continue
+        except (OSError, IOError):
+            continue
+
+        wrap = readSysfs(os.path.join(zoneDir, 'max_energy_range_uj'))
+        if energy.isdigit():
+            counters[domain] = (int(energy), int(wrap) if wrap and wrap.isdigit() else 0)
+
+    return counters, error
+
+
+def readAmdEnergyCounters(chips_):
+    '''Socket energy of amd_energy hwmon chips, used when there are no RAPL zones.'''
+    counters = {}
+    for chip in chips_:
+        if not chip['name'].startswith('amd_energy-'):
+            continue
+
+        for label, num, val in chip['inputs'].get('energy', ()):
+            socketRe = re.match(r'^Esocket(\d+)$', label)
+            if socketRe:
+                counters['package-%s' % socketRe.group(1)] = (int(round(float(val) * 1000000)), 0)   # joules
+
+    return counters
+
+
+def getPowerData(chips_):
+    '''Average power of every RAPL domain over the interval since previous run. Domains that cannot be read
+    get no LLD, RAPL_NOPERM error tells why.'''
+    sender = []
+    json = []
+
+    now = time()
+    counters, error = readRaplCounters(POWERCAP_PATH)
+    if     (not counters and
+            chips_):
+
+        counters = readAmdEnergyCounters(chips_)
+
+    name = 'rapl_cpu_%s' % sanitizeStr(HOST)
+    previous = loadState(name, {})
+    current = {}
+    for domain in sorted(counters):
+        energy, wrap = counters[domain]
+        current[domain] = [energy, now]
+        json.append({'{#POWERDOMAIN}':domain})
+
+        if domain not in previous:
+            continue   # first run has nothing to compare
+
+        timeDelta = now - previous[domain][1]
+        if     (wrap and
+                timeDelta > wrap / 1000000.0 / RAPL_MAX_POWER):
+
+            continue   # counter may have wrapped more than once
+
+        energyDelta = energy - previous[domain][0]
+        if energyDelta < 0:
+            if not wrap:
+                continue   # counter reset, skip one interval
+            energyDelta += wrap
+
+        if timeDelta > 0:
+            sender.append(Metric(HOST, 'mini.cpu.power', (domain,), '%.2f' % (energyDelta / 1000000.0 / timeDelta)))
+
+    if     (current or
+            previous):
+
+        saveState(name, current)
+
+    return sender, json, error
+
+
+def getNvidiaSmiOutput(binPath_):
+    '''GPUs of proprietary driver by PCI bus id: {'0000:01:00.0': (name, temp, memTotal, memUsed, memFree)}.'''
+    try:
+        from subprocess import DEVNULL
+    except:
+        DEVNULL = open(os.devnull, 'w')
+
+    query = 'name,pci.bus_id,temperature.gpu,memory.total,memory.used,memory.free'
+    try:
+        p = subprocess.check_output([binPath_, '--query-gpu=%s' % query, '--format=csv,noheader,nounits'],
+                                    universal_newlines=True, stderr=DEVNULL)
+    except Exception:
+        return {}   # not installed, or no GPUs
+
+    gpus = {}
+    for line in p.strip().splitlines():
+        fields = [i.strip() for i in line.split(',')]
+        if len(fields) != 6:
+            continue
+
+        values = [i if i.isdigit() else None for i in fields[2:]]   # '[N/A]', '[Not Supported]'
+        busId = fields[1].lower()[-12:]   # domain is 8 digits here and 4 in sysfs
+        gpus[busId] = tuple([fields[0]] + values)
+
+    return gpus
+
+
+def hasNvidiaGpu(pciPath_):
+    '''True if there is a PCI display controller of NVIDIA (vendor 0x10de, class 0x03).'''
+    try:
+        devices = os.listdir(pciPath_)
+    except OSError:
+        return False
+
+    for device in devices:
+        if     (readSysfs(os.path.join(pciPath_, device, 'vendor')) == '0x10de' and
+                (readSysfs(os.path.join(pciPath_, device, 'class')) or '').startswith('0x03')):
+
+            return True
+
+    return False
+
+
+def readDrmGpus(drmPath_, pciPath_, nvidiaSmiPath_):
+    '''GPUs of DRM cards (hwmon) in card order, then ones only nvidia-smi knows:
+    [(id, temp, fan, memTotal, memUsed, memFree, hwmon chip or None)].'''
+    gpus = []
+    nvidia = {}
+    if     (nvidiaSmiPath_ and
+            hasNvidiaGpu(pciPath_)):
+
+        nvidia = getNvidiaSmiOutput(nvidiaSmiPath_)
+
+    try:
+        cards = [i for i in os.listdir(drmPath_) if re.match(r'^card\d+$', i)]
+    except (OSError, TypeError):
+        cards = []
+
+    for card in sorted(cards, key=lambda k: int(k[4:])):
+        device = os.path.join(drmPath_, card, 'device')
+        busId = os.path.basename(os.path.realpath(device)).lower()
+        if busId in nvidia:
+            name, temp, memTotal, memUsed, memFree = nvidia.pop(busId)
+            gpus.append((name, temp, None, memTotal, memUsed, memFree, None))   # nvidia-smi has no fan RPM, only percent
+            continue
+
+        try:
+            hwmons = os.listdir(os.path.join(device, 'hwmon'))
+        except OSError:
+            continue   # no sensors, like most integrated GPUs
+
+        for hwmon in sorted(hwmons):
+            chip = readHwmonChip(os.path.join(device, 'hwmon', hwmon))
+            if not chip:
+                continue
+
+            temps = intInputs(chip, 'temp')   # first is 'edge' on amdgpu
+            if not temps:
+                continue   # power-only hwmon, like i915
+            fans = intInputs(chip, 'fan')
+            memTotal = readSysfs(os.path.join(device, 'mem_info_vram_total'))
+            memUsed = readSysfs(os.path.join(device, 'mem_info_vram_used'))
+            if     (memTotal and memTotal.isdigit() and
+                    memUsed and memUsed.isdigit()):
+
+                memTotal = int(memTotal) // 1048576
+                memUsed = int(memUsed) // 1048576
+                memFree = memTotal - memUsed
+            else:
+                memTotal = memUsed = memFree = None
+
+            gpus.append((chip['name'],
+                         temps[0][2],
+                         fans[0][2] if fans else None,
+                         memTotal, memUsed, memFree, chip))
+            break
+
+    for busId in sorted(nvidia):   # without DRM card, nvidia-drm not loaded
+        name, temp, memTotal, memUsed, memFree = nvidia[busId]
+        gpus.append((name, temp, None, memTotal, memUsed, memFree, None))
+
+    return gpus
+
+
+def getDrmGpuData(gpus_):
+    '''Items of readDrmGpus() GPUs, like getGpuData(). None if no GPU was found.'''
+    sender = []
+    json = []
+
+    if not gpus_:
+        return None
+
+    allTemps = []
+    for num, (gpuid, temp, fan, memTotal, memUsed, memFree, chip) in enumerate(gpus_):
+        json.append({'{#GPU}':num})
+        sender.append(Metric(HOST, 'mini.gpu.info', ('gpu%s' % num, 'ID'), removeQuotes(gpuid)))
+
+        if temp is not None:
+            json.append({'{#GPUTEMP}':num})
+            allTemps.append(int(temp))
+            sender.append(Metric(HOST, 'mini.gpu.temp', ('gpu%s' % num,), temp))
+            sender.append(Metric(HOST, 'mini.gpu.info', ('gpu%s' % num, 'GPUstatus'), 'PROCESSED'))
+        else:
+            sender.append(Metric(HOST, 'mini.gpu.info', ('gpu%s' % num, 'GPUstatus'), 'NO_TEMP'))
+
+        if fan is not None:
+            sender.append(Metric(HOST, 'mini.gpu.fan', ('gpu%s' % num, 'rpm'), fan))
+            if fan != '0':
+                json.append({'{#GPUFAN}':num})
+
+        if memTotal is not None:
+            json.append({'{#GPUMEM}':num})
+            sender.append(Metric(HOST, 'mini.gpu.memory', ('gpu%s' % num, 'free'), memFree))
+            sender.append(Metric(HOST, 'mini.gpu.memory', ('gpu%s' % num, 'used'), memUsed))
+            sender.append(Metric(HOST, 'mini.gpu.memory', ('gpu%s' % num, 'total'), memTotal))
+
+    if allTemps:
+        error = None
+        sender.append(Metric(HOST, 'mini.gpu.temp', ('MAX',), max(allTemps)))
+    else:
+        error = 'NOGPUTEMPS'
+
+    return sender, json, error
+
+
+def findCores(chip_):
+    '''Core number and temperature of chip features, by the last of CORES_REGEXPS that matches any.'''
+    cores = None
+    for regexp in CORES_RES:
+        matched = []
+        for name, num, val in intInputs(chip_, 'temp'):
+            coreRe = regexp.search('%s/%s' % (chip_['name'], name))
+            if coreRe:
+                if coreRe.groups():
+                    matched.append((coreRe.group(1), val))
+                else:
+                    matched.append((num, val))
+
+        if matched:
+            cores = matched
+
+    return cores
+
+
+def getCpuData(chips_):
     '''Note: certain cores can pose as different blocks making them separate cpus in zabbix.'''
     sender = []
     json = []
 
     cpuBlocks = -1   # first cpu will be '0'
     allTemps = []
-    for block in pOut_:
-        regexp = chooseCpuRegexp(block)
+    for chip in chips_:
+        coreTemps = findCores(chip)
 
-        coreTempsRe = re.findall(regexp, block, re.I | re.M)
-
-        if (coreTempsRe and
-            regexp):
+        if coreTemps:
 
             cpuBlocks += 1   # you need to be creative to parse lmsensors
 
             json.append({'{#CPU}':cpuBlocks})
-            sender.append('"%s" mini.cpu.info[cpu%s,ID] "%s"' % (HOST, cpuBlocks, removeQuotes(block.splitlines()[0])))
+            sender.append(Metric(HOST, 'mini.cpu.info', ('cpu%s' % cpuBlocks, 'ID'), removeQuotes(chip['name'])))
 
-            tempCrit = re.search(r'_crit:\s+(\d+)\.\d+', block, re.I)
-            if tempCrit:
-                tjMax = tempCrit.group(1)
-            else:
-                tjMax = FALLBACK_TJMAX
+            tjMax = FALLBACK_TJMAX
+            for label, subfeatures in chip['features']:
+                crits = [CRIT_VALUE_RE.match(val) for sub, val in subfeatures if sub.endswith('_crit')]
+                crits = [i.group(1) for i in crits if i]
+                if crits:
+                    tjMax = crits[0]
+                    break
 
-            sender.append('"%s" mini.cpu.info[cpu%s,TjMax] "%s"' % (HOST, cpuBlocks, tjMax))
+            sender.append(Metric(HOST, 'mini.cpu.info', ('cpu%s' % cpuBlocks, 'TjMax'), tjMax))
 
             cpuTemps = []
             previousCore = None
-            for num, val in coreTempsRe:
+            for num, val in coreTemps:
                 if previousCore == num:
                     continue   # some cores have same number - ignore them
                 previousCore = num
 
                 cpuTemps.append(int(val))
                 allTemps.append(int(val))
-                sender.append('"%s" mini.cpu.temp[cpu%s,core%s] "%s"' % (HOST, cpuBlocks, num, val))
+                sender.append(Metric(HOST, 'mini.cpu.temp', ('cpu%s' % cpuBlocks, 'core%s' % num), val))
                 json.append({'{#CPUC}':cpuBlocks, '{#CORE}':num})
 
-            sender.append('"%s" mini.cpu.temp[cpu%s,MAX] "%s"' % (HOST, cpuBlocks, max(cpuTemps)))
+            sender.append(Metric(HOST, 'mini.cpu.temp', ('cpu%s' % cpuBlocks, 'MAX'), max(cpuTemps)))
 
     if cpuBlocks != -1:
         if allTemps:
             error = None
-            sender.append('"%s" mini.cpu.temp[MAX] "%s"' % (HOST, max(allTemps)))
+            sender.append(Metric(HOST, 'mini.cpu.temp', ('MAX',), max(allTemps)))
         else:
             error = 'NOCPUTEMPS'
     else:
@@ -261,14 +1235,27 @@ def getCpuData(pOut_):
 if __name__ == '__main__':
 
     fail_ifNot_Py3()
+    if sys.argv[1] == 'bench':   # mini_ipmi_lmsensors.py bench ROUNDS
+        benchBackends(int(sys.argv[2]))
+        sys.exit(0)
+
+    if sys.argv[1] == 'check':   # mini_ipmi_lmsensors.py check fixtures
+        sys.exit(1 if checkFixtures(sys.argv[2]) else 0)
+
+    if sys.argv[1] == 'sample':   # detached by 'get' run
+        runSampler()
+        sys.exit(0)
+
+    singleFlight('cpu', HOST)   # exits here if the same run is already in flight
 
     senderData = []
     jsonData = []
     statusErrors = []
 
-    p_Output = getOutput(BIN_PATH)
+    p_Output = readChips()
     pRunStatus = p_Output[0]
     pOut = p_Output[1]
+    clock = int(time())   # all values of this run share collection time
 
     if pOut:
         if GATHER_VOLTAGES:
@@ -287,7 +1274,7 @@ if __name__ == '__main__':
             jsonData.extend(getBoardTemps_Out[1])
 
         if GATHER_GPU_DATA:
-            getGpuData_Out = getGpuData(pOut)
+            getGpuData_Out = getDrmGpuData(readDrmGpus(GPU_DRM_PATH, PCI_DEVICES_PATH, NVIDIA_SMI_PATH)) or getGpuData(pOut)
             gpuErrors = getGpuData_Out[2]
             senderData.extend(getGpuData_Out[0])
             jsonData.extend(getGpuData_Out[1])
@@ -302,13 +1289,30 @@ if __name__ == '__main__':
             if cpuErrors:
                 statusErrors.append(cpuErrors)   # NOCPUS, NOCPUTEMPS
 
+            if GATHER_CPU_THROTTLE:
+                senderData.extend(getThrottleData(getCpuData_Out))
+
+    if GATHER_CPU_POWER:
+        getPowerData_Out = getPowerData(pOut)
+        powerErrors = getPowerData_Out[2]
+        senderData.extend(getPowerData_Out[0])
+        jsonData.extend(getPowerData_Out[1])
+        if powerErrors:
+            statusErrors.append(powerErrors)   # RAPL_NOPERM
+
     if statusErrors:
         errorsString = ', '.join(statusErrors).strip()
-        senderData.append('"%s" mini.cpu.info[ConfigStatus] "%s"' % (HOST, errorsString))
+        senderData.append(Metric(HOST, 'mini.cpu.info', ('ConfigStatus',), errorsString))
     else:
-        senderData.append('"%s" mini.cpu.info[ConfigStatus] "%s"' % (HOST, pRunStatus))   # OS_NOCMD, OS_ERROR, UNKNOWN_EXC_ERROR, CONFIGURED
+        senderData.append(Metric(HOST, 'mini.cpu.info', ('ConfigStatus',), pRunStatus))   # OS_NOCMD, OS_ERROR, UNKNOWN_EXC_ERROR, CONFIGURED
+
+    if     (SAMPLE_INTERVAL and
+            sys.argv[1] == 'get'):
+
+        senderData.extend(sampledMetrics())
+        startSampler()
 
     link = r'https://github.com/nobodysu/zabbix-mini-IPMI/issues'
     sendStatusKey = 'mini.cpu.info[SendStatus]'
-    processData(senderData, jsonData, AGENT_CONF_PATH, SENDER_WRAPPER_PATH, SENDER_PATH, TIMEOUT, HOST, link, sendStatusKey)
+    processData(stampMetrics(senderData, clock), jsonData, AGENT_CONF_PATH, SENDER_WRAPPER_PATH, SENDER_PATH, TIMEOUT, HOST, link, sendStatusKey)
 
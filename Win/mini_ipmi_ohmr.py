@@ -71,7 +71,8 @@ import sys
 import subprocess
 import re
 import platform
-from sender_wrapper import (readConfig, processData, fail_ifNot_Py3, removeQuotes)
+from time import time
+from sender_wrapper import (readConfig, processData, fail_ifNot_Py3, removeQuotes, Metric, stampMetrics, singleFlight)
 
 HOST = sys.argv[2]
 
@@ -134,7 +135,7 @@ def getOHMRversion(pOut_):
     else:
         version = None
         
-    sender = ['"%s" mini.info[OHMRversion] "%s"' % (HOST, removeQuotes(version))]
+    sender = [Metric(HOST, 'mini.info', ('OHMRversion',), removeQuotes(version))]
         
     return sender
     
@@ -146,7 +147,7 @@ def getBoardInfo(pOut_):
     for regexp, key in BOARD_REGEXPS_AND_KEYS:
         reMatch = re.search(regexp, pOut_, re.I | re.M)
         if reMatch:
-            sender.append('"%s" %s "%s"' % (HOST, key, removeQuotes(reMatch.group(1).strip())))
+            sender.append(Metric(HOST, key, (), removeQuotes(reMatch.group(1).strip())))
 
     return sender
 
@@ -221,35 +222,35 @@ def getCpusData(pOut_):
     allTemps = []
     for name, id in cpus:
         # Processor model
-        sender.append('"%s" mini.cpu.info[cpu%s,ID] "%s"' % (HOST, id, removeQuotes(name.strip())))
+        sender.append(Metric(HOST, 'mini.cpu.info', ('cpu%s' % id, 'ID'), removeQuotes(name.strip())))
         json.append({'{#CPU}':id})
 
         gotTjmax = getTjmax(pOut_, id, name)
         if gotTjmax:
-            sender.append('"%s" mini.cpu.info[cpu%s,TjMax] "%s"' % (HOST, id, gotTjmax))
+            sender.append(Metric(HOST, 'mini.cpu.info', ('cpu%s' % id, 'TjMax'), gotTjmax))
 
         # All core temperatures for given CPU
         coreTempsRe = re.findall(r'Core.+:\s+(\d+).+\(\/[\w-]+cpu\/%s\/temperature\/(\d+)\)' % id, pOut_, re.I)
         if coreTempsRe:
-            sender.append('"%s" mini.cpu.info[cpu%s,CPUstatus] "PROCESSED"' % (HOST, id))
+            sender.append(Metric(HOST, 'mini.cpu.info', ('cpu%s' % id, 'CPUstatus'), 'PROCESSED'))
             cpuTemps = []
             for coretemp, coreid in coreTempsRe:
                 cpuTemps.append(int(coretemp))
                 allTemps.append(int(coretemp))
-                sender.append('"%s" mini.cpu.temp[cpu%s,core%s] "%s"' % (HOST, id, coreid, coretemp))
+                sender.append(Metric(HOST, 'mini.cpu.temp', ('cpu%s' % id, 'core%s' % coreid), coretemp))
                 json.append({'{#CPUC}':id, '{#CORE}':coreid})
 
-            sender.append('"%s" mini.cpu.temp[cpu%s,MAX] "%s"' % (HOST, id, str(max(cpuTemps))))
+            sender.append(Metric(HOST, 'mini.cpu.temp', ('cpu%s' % id, 'MAX'), str(max(cpuTemps))))
 
         elif isCpuWithoutSensor(name):
-            sender.append('"%s" mini.cpu.info[cpu%s,CPUstatus] "NO_SENSOR"' % (HOST, id))
+            sender.append(Metric(HOST, 'mini.cpu.info', ('cpu%s' % id, 'CPUstatus'), 'NO_SENSOR'))
         else:
-            sender.append('"%s" mini.cpu.info[cpu%s,CPUstatus] "NO_TEMP"'   % (HOST, id))
+            sender.append(Metric(HOST, 'mini.cpu.info', ('cpu%s' % id, 'CPUstatus'), 'NO_TEMP'))
 
     if cpus:
         if allTemps:
             error = None
-            sender.append('"%s" mini.cpu.temp[MAX] "%s"' % (HOST , str(max(allTemps))))
+            sender.append(Metric(HOST, 'mini.cpu.temp', ('MAX',), str(max(allTemps))))
         else:
             error = 'NOCPUTEMPS'
     else:
@@ -269,10 +270,10 @@ def getVoltages(pOut_):
 
         for regexp, key, jsn in VOLTAGE_REGEXPS_KEYS_AND_JSONS:
             if re.search(regexp, name, re.I):
-                sender.append('"%s" mini.brd.vlt[%s] "%s"' % (HOST, key, removeQuotes(val)))
+                sender.append(Metric(HOST, 'mini.brd.vlt', (key,), removeQuotes(val)))
                 json.append({jsn:key})
 
-        sender.append('"%s" mini.brd.vlt[%s] "%s"' % (HOST, id, removeQuotes(val)))   # static items for graph, could be duplicate
+        sender.append(Metric(HOST, 'mini.brd.vlt', (id,), removeQuotes(val)))   # static items for graph, could be duplicate
 
     return sender, json
 
@@ -287,7 +288,7 @@ def getBoardFans(pOut_):
         name = name.strip()
 
         # Only create LLD when speed is not zero, BUT always send zero values (hides phantom fans)
-        sender.append('"%s" mini.brd.fan[%s,rpm] "%s"' % (HOST, num, val))
+        sender.append(Metric(HOST, 'mini.brd.fan', (num, 'rpm'), val))
         if val != '0':
             json.append({'{#BRDFANNAME}':name, '{#BRDFANNUM}':num})
 
@@ -324,11 +325,11 @@ def getBoardTemps(pOut_):
 
         allTemps.append(int(val))
 
-        sender.append('"%s" mini.brd.temp[%s] "%s"' % (HOST, id, val))
+        sender.append(Metric(HOST, 'mini.brd.temp', (id,), val))
         json.append({'{#BRDTEMPNAME}':name, '{#BRDTEMPNUM}':id})
 
     if allTemps:
-        sender.append('"%s" mini.brd.temp[MAX] "%s"' % (HOST, str(max(allTemps))))
+        sender.append(Metric(HOST, 'mini.brd.temp', ('MAX',), str(max(allTemps))))
 
     return sender, json
 
@@ -344,20 +345,20 @@ def getGpusData(pOut_):
     allTemps = []
     for name, num in gpus:
         errors = []
-        sender.append('"%s" mini.gpu.info[gpu%s,ID] "%s"' % (HOST, num, name.strip()))
+        sender.append(Metric(HOST, 'mini.gpu.info', ('gpu%s' % num, 'ID'), name.strip()))
         json.append({'{#GPU}':num})
         
         temp = re.search(r':\s+(\d+).+\(\/[\w-]+gpu\/%s\/temperature\/0\)' % num, pOut_, re.I)
         if temp:
             json.append({'{#GPUTEMP}':num})
             allTemps.append(int(temp.group(1)))
-            sender.append('"%s" mini.gpu.temp[gpu%s] "%s"' % (HOST, num, temp.group(1)))
+            sender.append(Metric(HOST, 'mini.gpu.temp', ('gpu%s' % num,), temp.group(1)))
         else:
             errors.append('NO_TEMP')
 
         fanspeed = re.search(r':\s+(\d+).+\(\/[\w-]+gpu\/%s\/fan\/0\)' % num, pOut_, re.I)
         if fanspeed:
-            sender.append('"%s" mini.gpu.fan[gpu%s,rpm] "%s"' % (HOST, num, fanspeed.group(1)))
+            sender.append(Metric(HOST, 'mini.gpu.fan', ('gpu%s' % num, 'rpm'), fanspeed.group(1)))
             if fanspeed.group(1) != '0':
                 json.append({'{#GPUFAN}':num})
         else:
@@ -368,22 +369,22 @@ def getGpusData(pOut_):
             json.append({'{#GPUMEM}':num})
             for memname, memval in memory:   # more controllable
                 if 'Free' in memname:
-                    sender.append('"%s" mini.gpu.memory[gpu%s,free] "%s"'   % (HOST, num, memval))
+                    sender.append(Metric(HOST, 'mini.gpu.memory', ('gpu%s' % num, 'free'), memval))
                 elif 'Used' in memname:
-                    sender.append('"%s" mini.gpu.memory[gpu%s,used] "%s"'   % (HOST, num, memval))
+                    sender.append(Metric(HOST, 'mini.gpu.memory', ('gpu%s' % num, 'used'), memval))
                 elif 'Total' in memname:
-                    sender.append('"%s" mini.gpu.memory[gpu%s,total] "%s"'  % (HOST, num, memval))
+                    sender.append(Metric(HOST, 'mini.gpu.memory', ('gpu%s' % num, 'total'), memval))
 
         if errors:
             for e in errors:
-                sender.append('"%s" mini.gpu.info[gpu%s,GPUstatus] "%s"'    % (HOST, num, e))   # NO_TEMP, NO_FAN
+                sender.append(Metric(HOST, 'mini.gpu.info', ('gpu%s' % num, 'GPUstatus'), e))   # NO_TEMP, NO_FAN
         else:
-            sender.append('"%s" mini.gpu.info[gpu%s,GPUstatus] "PROCESSED"' % (HOST, num))
+            sender.append(Metric(HOST, 'mini.gpu.info', ('gpu%s' % num, 'GPUstatus'), 'PROCESSED'))
 
     if gpus:
         if allTemps:
             statusError = None
-            sender.append('"%s" mini.gpu.temp[MAX] "%s"' % (HOST, str(max(allTemps))))
+            sender.append(Metric(HOST, 'mini.gpu.temp', ('MAX',), str(max(allTemps))))
         else:
             statusError = 'NOGPUTEMPS'
     else:
@@ -395,6 +396,7 @@ def getGpusData(pOut_):
 if __name__ == '__main__':
 
     fail_ifNot_Py3()
+    singleFlight('cpu', HOST)   # exits here if the same run is already in flight
 
     senderData = []
     jsonData = []
@@ -405,6 +407,7 @@ if __name__ == '__main__':
     p_Output = getOutput(cmd)
     pRunStatus = p_Output[0]
     pOut = p_Output[1]
+    clock = int(time())   # all values of this run share collection time
     
     if pOut:
         senderData.extend(getOHMRversion(pOut))
@@ -462,11 +465,11 @@ if __name__ == '__main__':
             
     if statusErrors:
         errorsString = ', '.join(statusErrors).strip()
-        senderData.append('"%s" mini.cpu.info[ConfigStatus] "%s"' % (HOST, errorsString))
+        senderData.append(Metric(HOST, 'mini.cpu.info', ('ConfigStatus',), errorsString))
     elif pRunStatus:
-        senderData.append('"%s" mini.cpu.info[ConfigStatus] "%s"' % (HOST, pRunStatus))
+        senderData.append(Metric(HOST, 'mini.cpu.info', ('ConfigStatus',), pRunStatus))
         
     link = r'https://github.com/nobodysu/zabbix-mini-IPMI/issues'
     sendStatusKey = 'mini.cpu.info[SendStatus]'
-    processData(senderData, jsonData, AGENT_CONF_PATH, SENDER_WRAPPER_PATH, SENDER_PATH, TIMEOUT, HOST, link, sendStatusKey)
+    processData(stampMetrics(senderData, clock), jsonData, AGENT_CONF_PATH, SENDER_WRAPPER_PATH, SENDER_PATH, TIMEOUT, HOST, link, sendStatusKey)
 
@@ -2,6 +2,12 @@ import importlib.util
 import subprocess
 import sys
 import re
+import os
+import struct
+import random
+from time import time
+from functools import cached_property
+from json import loads
 
 ###########################################################################
 #
@@ -11,46 +17,86 @@ import re
 #
 
 # class to simulate the objects returned by wmi.WMI()
+# the properties become plain instance attributes, so reading them
+# needs no lookup hop; __getattr__ only runs for missing ones
 class FauxStructure:
-    _dict = {}
     def __init__(self, **entries):
-        self._dict = entries
+        self.__dict__.update(entries)
     def __getattr__(self, name):
-        if name in self._dict:
-            return self._dict[name]
-        else:
-            raise AttributeError(
-                "'{}' object has no attribute "
-                "or key '{}'".format(
-                    self.__class__.__name__, name
-                )
+        raise AttributeError(
+            "'{}' object has no attribute "
+            "or key '{}'".format(
+                self.__class__.__name__, name
             )
+        )
     def setSMBiosData(self, data):
-        self._dict['SMBiosData'] = data
+        self.SMBiosData = data
+
+# run a PowerShell command line and return its output; FauxWMI.runner
+# can be replaced with a function returning recorded output for testing
+def runPowershell(cmd):
+    return subprocess.check_output(cmd, universal_newlines=True)
 
 # class to get the data returned by wmi.WMI()
 # and stuff it into FauxStructure objects
 class FauxWMI(object):
-    def __init__(self, namespace):
+    runner = staticmethod(runPowershell)
+    # records of classes loaded by prefetch(), by (namespace, class)
+    cache = {}
+    def __init__(self, namespace, runner=None):
         self.namespace = 'root\\' + namespace
-        self.cmdlet = 'Get-CimInstance'
-        self.cmd = 'powershell -c'
-    def run(self, wmiclass):
-        cmd = '%s %s -Namespace "%s" -Class %s' % (
-            self.cmd, self.cmdlet, self.namespace, wmiclass
+        if runner:
+            self.runner = runner
+    @classmethod
+    def command(cls, queries):
+        # one PowerShell process for all (namespace, class) pairs; the
+        # whole objects come back as JSON, including all of SMBiosData
+        parts = []
+        for namespace, wmiclass in queries:
+            parts.append(
+                "'%s|%s'=@(Get-CimInstance -Namespace '%s' -Class %s "
+                "-ErrorAction SilentlyContinue | "
+                "Select-Object -Property * -ExcludeProperty Cim*)" % (
+                    namespace, wmiclass, namespace, wmiclass
+                )
+            )
+        return 'powershell -NoProfile -NonInteractive -c "@{%s} | ConvertTo-Json -Compress -Depth 4"' % (
+            '; '.join(parts)
         )
-        p = subprocess.check_output(cmd, universal_newlines=True)
-        lines = p.splitlines()
-        records = []
-        thisRec = {}
-        for line in lines:
-            if thisRec and not line:
-                records.append(FauxStructure(**thisRec))
-                thisRec = {}
-            elif re.search(r'^\S+\s+:\s+', line):
-                fields = re.split(r'\s+:\s+', line)
-                thisRec[fields[0]] = fields[1]
-        return records
+    @staticmethod
+    def unwrap(value):
+        # Windows PowerShell 5.1 serializes arrays of @() with their
+        # extended Count property: {"value":[...],"Count":n}
+        if (isinstance(value, dict) and
+            sorted(value) == ['Count', 'value']):
+            return value['value']
+        return value
+    @classmethod
+    def decode(cls, output, queries):
+        # turn the JSON into lists of FauxStructure objects per query
+        document = loads(output) if output.strip() else {}
+        result = {}
+        for namespace, wmiclass in queries:
+            items = cls.unwrap(document.get('%s|%s' % (namespace, wmiclass))) or []
+            if isinstance(items, dict):   # a single object isn't always wrapped
+                items = [items]
+            result[(namespace, wmiclass)] = [
+                FauxStructure(**dict((k, cls.unwrap(v)) for k, v in item.items())) for item in items
+            ]
+        return result
+    @classmethod
+    def prefetch(cls, queries, runner=None):
+        # load several classes, even of different namespaces, at once
+        # instead of starting PowerShell for each of them
+        queries = [('root\\' + namespace, wmiclass) for namespace, wmiclass in queries]
+        output = (runner or cls.runner)(cls.command(queries))
+        cls.cache.update(cls.decode(output, queries))
+    def run(self, wmiclass):
+        query = (self.namespace, wmiclass)
+        if query in self.cache:
+            return self.cache.pop(query)   # each prefetched result is used once
+        output = self.runner(self.command([query]))
+        return self.decode(output, [query])[query]
     def Hardware(self):
         return self.run('Hardware')
     def Sensor(self):
@@ -58,18 +104,7 @@ class FauxWMI(object):
     def WMINET_Instrumentation(self):
         return self.run('WMINET_Instrumentation')
     def MSSMBios_RawSMBiosTables(self):
-        records = self.run('MSSMBios_RawSMBiosTables')
-        # run a command to get the data under SMBiosData, since the
-        # command above only gets the first four bytes SMBiosData and
-        # then elides the rest with an ellipsis.
-        cmd = '%s $x = %s -Namespace "%s" -Class %s; $x.SMBiosData' % (
-            self.cmd, self.cmdlet, self.namespace, 'MSSMBios_RawSMBiosTables'
-        )
-        p = subprocess.check_output(cmd, universal_newlines=True)
-        # turn the data into bytes and stuff it into
-        # the 'SMBiosData' accessor on the record
-        records[0].setSMBiosData([int(n) for n in p.splitlines()])
-        return records
+        return self.run('MSSMBios_RawSMBiosTables')
 
 # factory class that will look to see if the WMI module
 # is available, and, if so load it and return wmi.WMI()
@@ -78,6 +113,9 @@ class FauxWMI(object):
 # the requested namespace.
 class MyWMI(object):
     @classmethod
+    def isNative(cls):
+        return 'wmi' in sys.modules or importlib.util.find_spec('wmi') is not None
+    @classmethod
     def getObject(cls, namespace):
         if 'wmi' in sys.modules:
             # the wmi module is already loaded
@@ -91,6 +129,12 @@ class MyWMI(object):
         else:
             # simulate the wmi module
             return FauxWMI(namespace=namespace)
+    @classmethod
+    def prefetch(cls, queries):
+        # with the simulated module, query all (namespace, class)
+        # pairs in one PowerShell process; the real one needs nothing
+        if not cls.isNative():
+            FauxWMI.prefetch(queries)
 
 ###########################################################################
 #
@@ -98,20 +142,32 @@ class MyWMI(object):
 # in https://github.com/openhardwaremonitor/openhardwaremonitor
 #
 
+# type, length and handle at the start of every structure; the handle is
+# read high byte first, as in SMBIOS.cs
+STRUCTURE_HEADER = struct.Struct('>BBH')
+WORD = struct.Struct('<H')
+
+# data is a memoryview of the formatted area and strings the raw string-set
+# after it; both are slices of the table, decoded only when a field is read
 class Structure(object):
     def __init__(self, type, handle, data, strings):
         self.type = type;
         self.handle = handle;
-        self.data = data;
-        self.strings = strings;
+        self.data = data if data is not None else b'';
+        self.stringSet = strings;
+    @cached_property
+    def strings(self):
+        if not self.stringSet:
+            return []
+        return bytes(self.stringSet).decode('latin-1').split('\0')
     def GetByte(self, offset):
-        if (offset < len(self.data) and self.data[offset] >= 0):
+        if (offset < len(self.data)):
             return self.data[offset]
         else:
             return 0
     def GetWord(self, offset):
-        if (offset + 1 < len(self.data) and self.data[offset] >= 0):
-            return((self.data[offset + 1] << 8) | self.data[offset])
+        if (offset + 1 < len(self.data)):
+            return WORD.unpack_from(self.data, offset)[0]
         else:
             return 0
     def GetString(self, offset):
@@ -141,14 +197,18 @@ class Structure(object):
 
 class BIOSInformation(Structure):
     def __init__(self, p1, p2, data=None, strings=None):
-        if data and strings:
+        if data is not None:
             super().__init__(p1, p2, data, strings)
-            self.vendor  = self.GetString(0x04)
-            self.version = self.GetString(0x05)
         else:
             super().__init__(0x00, 0, None, None)
-            self.vendor  = type
-            self.version = handle
+            self.vendor  = p1
+            self.version = p2
+    @cached_property
+    def vendor(self):
+        return self.GetString(0x04)
+    @cached_property
+    def version(self):
+        return self.GetString(0x05)
     def Vendor(self):
         return self.vendor
     def Version(self):
@@ -171,11 +231,21 @@ class SystemInformation(Structure):
             self.family           = p5
         else:
             super().__init__(p1, p2, p3, p4)
-            self.manufacturerName = self.GetString(0x04)
-            self.productName      = self.GetString(0x05)
-            self.version          = self.GetString(0x06)
-            self.serialNumber     = self.GetString(0x07)
-            self.family           = self.GetString(0x1A)
+    @cached_property
+    def manufacturerName(self):
+        return self.GetString(0x04)
+    @cached_property
+    def productName(self):
+        return self.GetString(0x05)
+    @cached_property
+    def version(self):
+        return self.GetString(0x06)
+    @cached_property
+    def serialNumber(self):
+        return self.GetString(0x07)
+    @cached_property
+    def family(self):
+        return self.GetString(0x1A)
     def ManufacturerName(self):
         return self.manufacturerName
     def ProductName(self):
@@ -206,10 +276,18 @@ class BaseBoardInformation(Structure):
             self.serialNumber     = p4
         else:
             super().__init__(p1, p2, p3, p4)
-            self.manufacturerName = self.GetString(0x04).strip()
-            self.productName      = self.GetString(0x05).strip()
-            self.version          = self.GetString(0x06).strip()
-            self.serialNumber     = self.GetString(0x07).strip()
+    @cached_property
+    def manufacturerName(self):
+        return self.GetString(0x04).strip()
+    @cached_property
+    def productName(self):
+        return self.GetString(0x05).strip()
+    @cached_property
+    def version(self):
+        return self.GetString(0x06).strip()
+    @cached_property
+    def serialNumber(self):
+        return self.GetString(0x07).strip()
     def ManufacturerName(self):
         return self.manufacturerName
     def ProductName(self):
@@ -228,14 +306,32 @@ class BaseBoardInformation(Structure):
         )
 
 class ProcessorInformation(Structure):
+    COUNTS = struct.Struct('<3B')   # core count, cores enabled, thread count
     def __init__(self, p1, p2, p3, p4):
         super().__init__(p1, p2, p3, p4)
-        self.ManufacturerName = self.GetString(0x07).strip()
-        self.Version          = self.GetString(0x10).strip()
-        self.CoreCount        = self.GetByte(0x23)
-        self.CoreEnabled      = self.GetByte(0x24)
-        self.ThreadCount      = self.GetByte(0x25)
-        self.ExternalClock    = self.GetWord(0x12)
+    @cached_property
+    def ManufacturerName(self):
+        return self.GetString(0x07).strip()
+    @cached_property
+    def Version(self):
+        return self.GetString(0x10).strip()
+    @cached_property
+    def counts(self):
+        if len(self.data) >= 0x23 + self.COUNTS.size:
+            return self.COUNTS.unpack_from(self.data, 0x23)
+        return (self.GetByte(0x23), self.GetByte(0x24), self.GetByte(0x25))
+    @property
+    def CoreCount(self):
+        return self.counts[0]
+    @property
+    def CoreEnabled(self):
+        return self.counts[1]
+    @property
+    def ThreadCount(self):
+        return self.counts[2]
+    @cached_property
+    def ExternalClock(self):
+        return self.GetWord(0x12)
     def __str__(self):
         return(
             f"instance of ProcessorInformation:\n"
@@ -250,12 +346,24 @@ class ProcessorInformation(Structure):
 class MemoryDevice(Structure):
     def __init__(self, p1, p2, p3, p4):
         super().__init__(p1, p2, p3, p4)
-        self.deviceLocator    = self.GetString(0x10).strip()
-        self.bankLocator      = self.GetString(0x11).strip()
-        self.manufacturerName = self.GetString(0x17).strip()
-        self.serialNumber     = self.GetString(0x18).strip()
-        self.partNumber       = self.GetString(0x1A).strip()
-        self.speed            = self.GetWord(0x15)
+    @cached_property
+    def deviceLocator(self):
+        return self.GetString(0x10).strip()
+    @cached_property
+    def bankLocator(self):
+        return self.GetString(0x11).strip()
+    @cached_property
+    def manufacturerName(self):
+        return self.GetString(0x17).strip()
+    @cached_property
+    def serialNumber(self):
+        return self.GetString(0x18).strip()
+    @cached_property
+    def partNumber(self):
+        return self.GetString(0x1A).strip()
+    @cached_property
+    def speed(self):
+        return self.GetWord(0x15)
     def DeviceLocator(self):
         return self.deviceLocator
     def BankLocator(self):
@@ -279,46 +387,43 @@ class MemoryDevice(Structure):
             f"    Speed            = '{self.speed}'"
         )
 
+# tables are MSSMBios_RawSMBiosTables objects, queried when not given
 class SMBios(object):
-    def __init__(self):
+    def __init__(self, tables=None):
         self.table = []
         self.biosInformation = None
         self.systemInformation = None
         self.baseBoardInformation = None
         self.processorInformation = None
         self.memoryDeviceList = []
-        c = MyWMI.getObject(namespace="WMI")
-        for bios in c.MSSMBios_RawSMBiosTables():
+        if tables is None:
+            tables = MyWMI.getObject(namespace="WMI").MSSMBios_RawSMBiosTables()
+        for bios in tables:
             self.Version = (
                 str(bios.SmbiosMajorVersion) + '.' + str(bios.SmbiosMinorVersion)
             )
             self.decodeRawSMBiosData(bios)
     def decodeRawSMBiosData(self, bios):
-        raw = bios.SMBiosData
-        if not raw:
+        if not bios.SMBiosData:
             return
+        # one copy into bytes; structures get memoryview slices of it
+        raw = bytes(bios.SMBiosData)
+        view = memoryview(raw)
         offset = 0
         type = raw[offset]
         while (offset + 4 < len(raw) and type != 127):
-            type = raw[offset]
-            length = raw[offset + 1]
-            handle = ((raw[offset + 2] << 8) | raw[offset + 3])
+            type, length, handle = STRUCTURE_HEADER.unpack_from(raw, offset)
             if (offset + length > len(raw)):
                 break
-            data = raw[offset:offset+length]
+            data = view[offset:offset+length]
             offset += length
-            stringsList = []
-            # if string is null terminated
-            if (offset < len(raw) and raw[offset] == 0):
-                offset += 1
-            while (offset < len(raw) and raw[offset] != 0):
-                sb = ''
-                while (offset < len(raw) and raw[offset] != 0):
-                    sb += chr(raw[offset])
-                    offset += 1
-                offset += 1
-                stringsList.append(sb)
-            offset += 1
+            # the string-set ends with a double null, and is only a
+            # double null when the structure has no strings
+            end = raw.find(b'\0\0', offset)
+            if end == -1:
+                end = len(raw)
+            stringsList = view[offset:end]
+            offset = end + 2
 
             if (type == 0x00):
                 self.biosInformation = BIOSInformation(type, handle, data, stringsList)
@@ -346,14 +451,23 @@ class SMBios(object):
 #
 ###########################################################################
 
+def naturalKey(identifier):
+    # pad a trailing number with zeros to sort "1, 10, 100, 2" as "001, 002, 010, 100"
+    head, sep, tail = identifier.rpartition('/')
+    if sep and tail.isdecimal():
+        return head + sep + tail.zfill(3)
+    return identifier
+
 # an item of Hardware data
 class HardwareItem(object):
+    __slots__ = ('HardwareType', 'Identifier', 'InstanceId', 'Name', 'Parent', 'sortKey')
     def __init__(self, obj):
         self.HardwareType = obj.HardwareType
         self.Identifier = obj.Identifier
         self.InstanceId = obj.InstanceId
         self.Name = obj.Name
         self.Parent = obj.Parent
+        self.sortKey = naturalKey(obj.Identifier)
     def __str__(self):
         return(
             f"instance of HardwareItem:\n"
@@ -381,6 +495,8 @@ class SensorValue(object):
         'Power':       { 'Unit': 'Watts',                  'Suffix': ' W'   },
         # no guesses for units for Data, SmallData, and Throughput
     }
+    __slots__ = ('Identifier', 'Index', 'InstanceId', 'Max', 'Min', 'Name', 'Parent',
+                 'SensorType', 'Value', 'Unit', 'Suffix', 'sortKey')
     def __init__(self, obj):
         self.Identifier = obj.Identifier
         self.Index = obj.Index
@@ -397,6 +513,7 @@ class SensorValue(object):
         else:
             self.Unit   = 'unknown'
             self.Suffix = ''
+        self.sortKey = naturalKey(obj.Identifier)
     def format(self, field, precision):
         return precision.format(getattr(self, field))+self.Suffix
     def __str__(self):
@@ -431,36 +548,270 @@ class OpenHardwareMonitor(object):
         f"    Version = '{self.version}'"
     )
 
-def zfill_match(match):
-    # pad matches with zeros to three digits
-    return match.group(1).zfill(3)
-
-# base class for Hardware and Sensor data objects
+# base class for Hardware and Sensor data objects; records are the WMI
+# objects of the class, queried when not given
 class OpenHardwareMonitorData(object):
     itemClass = {
         'Hardware': 'HardwareItem',
         'Sensor':   'SensorValue'
     }
-    def __init__(self):
+    def __init__(self, records=None):
         self.table = []
         self.tree = {}
-        c = MyWMI.getObject(namespace="OpenHardwareMonitor")
         cls = self.__class__.__name__
-        # loop over c.Hardware() or c.Sensor()
-        for item in getattr(c, cls)():
+        if records is None:
+            # c.Hardware() or c.Sensor()
+            records = getattr(MyWMI.getObject(namespace="OpenHardwareMonitor"), cls)()
+        itemClass = globals()[self.itemClass[cls]]
+        for item in records:
             # instantiate either HardwareItem() or SensorValue()
-            i = globals()[self.itemClass[cls]](item)
+            i = itemClass(item)
             self.table.append(i)
             self.tree[i.Identifier] = i
+        self.reindex()
+    def reindex(self):
+        # every parent path of an identifier ('/lpc', '/lpc/nct6791d', ...)
+        # to the items below it, in table order
+        self.byPrefix = {}
+        for i in self.table:
+            path = i.Identifier
+            while (slash := path.rfind('/')) > 0:
+                path = path[:slash]
+                self.byPrefix.setdefault(path, []).append(i)
     def sort(self): # sort the table by identifier
-        # pad numbers with zeros to sort "1, 10, 100, 2" as "001, 002, 010, 100"
-        self.table = sorted(self.table, key=lambda k: re.sub(r'(?<=\/)(\d+)$', zfill_match, k.Identifier))
+        self.table.sort(key=lambda k: k.sortKey)
+        self.reindex()
         return self # so we can chain
     def keys(self):
         return [ i.Identifier for i in self.table ]
+    def under(self, identifier):
+        # items whose identifier is below the given one, like the
+        # sensors of a hardware item
+        return self.byPrefix.get(identifier, [])
 
 class Hardware(OpenHardwareMonitorData):
     pass # all the work is done in the base class
 
 class Sensor(OpenHardwareMonitorData):
     pass # all the work is done in the base class
+
+###########################################################################
+#
+# synthetic SMBIOS tables for 'check' and 'bench', shaped like the
+# MSSMBios_RawSMBiosTables objects PowerShell returns
+#
+
+# one raw structure: header, formatted area with the given byte and word
+# fields at their offsets from the header, then the string-set
+def packStructure(type, handle, length, bytes_, words, strings):
+    data = bytearray(length)
+    STRUCTURE_HEADER.pack_into(data, 0, type, length, handle)
+    for offset, value in bytes_.items():
+        data[offset] = value
+    for offset, value in words.items():
+        WORD.pack_into(data, offset, value)
+    if strings:
+        return bytes(data) + b'\0'.join(i.encode('latin-1') for i in strings) + b'\0\0'
+    return bytes(data) + b'\0\0'
+
+# a server with every structure SMBios decodes, dimms memory devices of
+# which every fourth is empty, a structure without strings, end-of-table
+# and bytes after it that must be ignored
+def syntheticSMBiosData(dimms):
+    raw = packStructure(0x00, 0, 0x18, {0x04: 1, 0x05: 2}, {}, ['American Megatrends Inc.', '3.4'])
+    raw += packStructure(0x01, 1, 0x1B, {0x04: 1, 0x05: 2, 0x06: 3, 0x07: 4, 0x1A: 5}, {},
+                         ['Supermicro', 'SYS-1029U-TRT', '0123456789', 'S40411239102857', 'Server'])
+    raw += packStructure(0x02, 2, 0x0F, {0x04: 1, 0x05: 2, 0x06: 3, 0x07: 4}, {},
+                         ['Supermicro  ', ' X11DPU', '1.10', 'ZM194S001234'])
+    raw += packStructure(0x04, 3, 0x30, {0x07: 1, 0x10: 2, 0x23: 20, 0x24: 18, 0x25: 36}, {0x12: 100},
+                         ['Intel(R) Corporation', 'Intel(R) Xeon(R) Gold 6230 CPU @ 2.10GHz'])
+    for num in range(dimms):
+        if num % 4 == 3:
+            strings = ['DIMM%s' % num, 'P0_Node0_Channel%s_Dimm1' % num, 'NO DIMM', 'NO DIMM', 'NO DIMM']
+            speed = 0
+        else:
+            strings = ['DIMM%s' % num, 'P0_Node0_Channel%s_Dimm0' % num, 'Samsung', '%08X' % (0x3A00 + num),
+                       'M393A4K40CB2-CTD    ']
+            speed = 2666
+        raw += packStructure(0x11, 0x1100 + num, 0x28, {0x10: 1, 0x11: 2, 0x17: 3, 0x18: 4, 0x1A: 5}, {0x15: speed},
+                             strings)
+    raw += packStructure(0x20, 0x2000, 0x0B, {}, {}, [])
+    raw += packStructure(0x7F, 0x7F00, 0x04, {}, {}, [])
+    return list(raw + b'\xff' * 16)
+
+# an SMBIOS 2.0 processor structure, too short for the core counts, and a
+# structure longer than the rest of the table
+def truncatedSMBiosData():
+    raw = packStructure(0x04, 0, 0x1A, {0x07: 1, 0x10: 2}, {0x12: 133}, ['AMD', 'AMD Athlon(tm) Processor'])
+    raw += packStructure(0x11, 1, 0x28, {}, {}, [])[:0x20]
+    return list(raw)
+
+# decode the synthetic tables and compare with the values they were built
+# from; returns the number of differences
+def checkSMBios():
+    bios = SMBios([FauxStructure(SmbiosMajorVersion=3, SmbiosMinorVersion=2, SMBiosData=syntheticSMBiosData(8))])
+    cpu = bios.processorInformation
+    short = SMBios([FauxStructure(SmbiosMajorVersion=2, SmbiosMinorVersion=0, SMBiosData=truncatedSMBiosData())])
+    dimms = []
+    for num in range(8):
+        if num % 4 == 3:
+            dimms.append(('DIMM%s' % num, 'P0_Node0_Channel%s_Dimm1' % num, 'NO DIMM', 'NO DIMM', 0))
+        else:
+            dimms.append(('DIMM%s' % num, 'P0_Node0_Channel%s_Dimm0' % num, 'Samsung', 'M393A4K40CB2-CTD', 2666))
+    checks = (
+        ('BIOS',
+         (bios.biosInformation.Vendor(), bios.biosInformation.Version()),
+         ('American Megatrends Inc.', '3.4')),
+        ('system',
+         (bios.systemInformation.ManufacturerName(), bios.systemInformation.ProductName(),
+          bios.systemInformation.Version(), bios.systemInformation.SerialNumber(), bios.systemInformation.Family()),
+         ('Supermicro', 'SYS-1029U-TRT', '0123456789', 'S40411239102857', 'Server')),
+        ('baseboard',
+         (bios.baseBoardInformation.ManufacturerName(), bios.baseBoardInformation.ProductName(),
+          bios.baseBoardInformation.Version(), bios.baseBoardInformation.SerialNumber()),
+         ('Supermicro', 'X11DPU', '1.10', 'ZM194S001234')),
+        ('processor',
+         (cpu.ManufacturerName, cpu.Version, cpu.CoreCount, cpu.CoreEnabled, cpu.ThreadCount, cpu.ExternalClock),
+         ('Intel(R) Corporation', 'Intel(R) Xeon(R) Gold 6230 CPU @ 2.10GHz', 20, 18, 36, 100)),
+        ('memory devices',
+         [(i.DeviceLocator(), i.BankLocator(), i.ManufacturerName(), i.PartNumber(), i.Speed())
+          for i in bios.memoryDeviceList],
+         dimms),
+        ('structure types',
+         [i.Type() for i in bios.table],
+         [0x00, 0x01, 0x02, 0x04] + [0x11] * 8 + [0x20, 0x7F]),
+        ('no strings',
+         (bios.table[-2].strings, bios.table[-2].GetString(0x04)),
+         ([], '')),
+        ('short processor',
+         (short.processorInformation.Version, short.processorInformation.CoreCount,
+          short.processorInformation.ThreadCount, short.processorInformation.ExternalClock),
+         ('AMD Athlon(tm) Processor', 0, 0, 133)),
+        ('truncated table',
+         [i.Type() for i in short.table],
+         [0x04]),
+    )
+    failed = 0
+    for title, got, expected in checks:
+        print('%-24s %s' % (title, 'OK' if got == expected else 'DIFFERS'))
+        if got != expected:
+            print('    expected %s\n    got      %s' % (expected, got))
+            failed += 1
+    return failed
+
+# a tree of 50 hardware items, '/hdd/1' next to '/hdd/10', with 100
+# sensors each, in the arbitrary order WMI returns them
+def syntheticSensorTree():
+    hardware = []
+    sensors = []
+    types = ('Voltage', 'Clock', 'Temperature', 'Load', 'Fan', 'Control', 'Power')
+    for hw in range(50):
+        if hw < 20:
+            identifier = '/hdd/%s' % hw
+        else:
+            identifier = '/lpc/nct6791d-%s' % hw
+        hardware.append(FauxStructure(HardwareType='HDD', Identifier=identifier, InstanceId=str(hw),
+                                      Name='Hardware %s' % hw, Parent=''))
+        for num in range(100):
+            sensorType = types[num % len(types)]
+            sensors.append(FauxStructure(Identifier='%s/%s/%s' % (identifier, sensorType.lower(), num), Index=num,
+                                         InstanceId='%s-%s' % (hw, num), Max=90.0, Min=10.0,
+                                         Name='%s #%s' % (sensorType, num), Parent=identifier,
+                                         SensorType=sensorType, Value=40.0 + num % 30))
+    shuffler = random.Random(0)
+    shuffler.shuffle(hardware)
+    shuffler.shuffle(sensors)
+    return hardware, sensors
+
+# sensors under() every hardware item, against a scan of the whole table
+# that stops at path components; returns the number of differences
+def checkSensorTree():
+    hardwareRecords, sensorRecords = syntheticSensorTree()
+    hardware = Hardware(hardwareRecords).sort()
+    sensor = Sensor(sensorRecords).sort()
+    failed = 0
+    for title, got, expected in (
+        ('sensor tree order',
+         [i.Identifier for i in hardware.table][:12],
+         ['/hdd/0', '/hdd/1', '/hdd/2', '/hdd/3', '/hdd/4', '/hdd/5', '/hdd/6', '/hdd/7', '/hdd/8', '/hdd/9',
+          '/hdd/10', '/hdd/11']),
+        ('sensors under hardware',
+         [[i.Identifier for i in sensor.under(hw.Identifier)] for hw in hardware.table],
+         [[i.Identifier for i in sensor.table if i.Identifier.startswith(hw.Identifier + '/')]
+          for hw in hardware.table]),
+        ('sensors per hardware',
+         set(len(sensor.under(hw.Identifier)) for hw in hardware.table),
+         {100}),
+    ):
+        print('%-24s %s' % (title, 'OK' if got == expected else 'DIFFERS'))
+        if got != expected:
+            print('    expected %s\n    got      %s' % (expected, got))
+            failed += 1
+    return failed
+
+# decode recorded PowerShell output of the prefetch command, NAME.ps51.json
+# of Windows PowerShell 5.1 and NAME.ps7.json of PowerShell 7, and compare
+# the records with NAME.expected; returns the number of differences
+def checkPowershell(fixturesPath):
+    failed = 0
+    for name in sorted(os.listdir(fixturesPath)):
+        if not name.endswith('.expected'):
+            continue
+        base = os.path.join(fixturesPath, name[:-len('.expected')])
+        with open(base + '.expected', 'r') as f:
+            expected = loads(f.read())
+        queries = [tuple(key.split('|')) for key in sorted(expected)]
+        for suffix in ('.ps51.json', '.ps7.json'):
+            if not os.path.exists(base + suffix):
+                continue
+            with open(base + suffix, 'r') as f:
+                decoded = FauxWMI.decode(f.read(), queries)
+            got = dict(('%s|%s' % query, [vars(i) for i in decoded[query]]) for query in queries)
+            differing = [key for key in sorted(expected) if got.get(key) != expected[key]]
+            print('%-24s %s' % (os.path.basename(base + suffix), 'DIFFERS' if differing else 'OK'))
+            for key in differing:
+                print('    %s:\n      expected %s\n      got      %s' % (key, expected[key], got.get(key)))
+            failed += len(differing)
+    return failed
+
+# time building, sorting and walking the synthetic tree like the report
+# does, against scanning every sensor for every hardware item
+def benchSensorTree(rounds):
+    hardwareRecords, sensorRecords = syntheticSensorTree()
+    for title, isIndexed in (('tree:', True), ('tree scan:', False)):
+        started = time()
+        for i in range(rounds):
+            hardware = Hardware(hardwareRecords).sort()
+            sensor = Sensor(sensorRecords).sort()
+            for hw in hardware.table:
+                if isIndexed:
+                    items = sensor.under(hw.Identifier)
+                else:
+                    items = [item for item in sensor.table if item.Identifier.startswith(hw.Identifier + '/')]
+                for item in items:
+                    item.format('Value', '{:.2f}')
+        elapsed = time() - started
+        print('%-12s %8.3f ms per report, %s hardware items, %s sensors' % (
+            title, elapsed / rounds * 1000, len(hardware.table), len(sensor.table)))
+
+# time decoding a synthetic table of a 64 DIMM server and reading every
+# field the report prints
+def benchSMBios(rounds):
+    tables = [FauxStructure(SmbiosMajorVersion=3, SmbiosMinorVersion=2, SMBiosData=syntheticSMBiosData(64))]
+    started = time()
+    for i in range(rounds):
+        bios = SMBios(tables)
+        for dimm in bios.memoryDeviceList:
+            (dimm.deviceLocator, dimm.manufacturerName, dimm.partNumber, dimm.speed)
+        (bios.baseBoardInformation.manufacturerName, bios.biosInformation.version,
+         bios.processorInformation.Version, bios.processorInformation.ThreadCount)
+    elapsed = time() - started
+    print('%-12s %8.3f ms per decode, %s structures, %s bytes' % (
+        'smbios:', elapsed / rounds * 1000, len(bios.table), len(tables[0].SMBiosData)))
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['check']:   # mini_ipmi_wmi.py check fixtures
+        sys.exit(1 if checkSMBios() + checkSensorTree() + checkPowershell(sys.argv[2]) else 0)
+    elif sys.argv[1:2] == ['bench']:   # mini_ipmi_wmi.py bench ROUNDS
+        benchSMBios(int(sys.argv[2]))
+        benchSensorTree(max(int(sys.argv[2]) // 100, 1))
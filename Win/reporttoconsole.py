@@ -2,15 +2,22 @@ import sys
 import re
 import platform
 from operator import itemgetter
-from mini_ipmi_wmi import SMBios, Hardware, Sensor, OpenHardwareMonitor
+from mini_ipmi_wmi import SMBios, Hardware, Sensor, OpenHardwareMonitor, MyWMI
 
 
 WMI_NAMESPACE = 'root\OpenHardwareMonitor'
 WMI_CMD = 'powershell -c Get-WmiObject'
 ACTION = 'get'
+# everything the report reads, loaded at once without the wmi module
+WMI_QUERIES = (
+    ('OpenHardwareMonitor', 'Hardware'),
+    ('OpenHardwareMonitor', 'Sensor'),
+    ('WMI',                 'MSSMBios_RawSMBiosTables'),
+)
 
 
 if __name__ == '__main__':
+    MyWMI.prefetch(WMI_QUERIES)
     hardware = Hardware().sort()
     sensor = Sensor().sort()
     bios = SMBios()
@@ -70,8 +77,7 @@ if __name__ == '__main__':
                 else:
                     print(biosrow.format(dimm.deviceLocator, dimm.manufacturerName))
         else:
-            items = [item for item in sensor.table if item.Identifier.startswith(hw.Identifier)]
-            for item in items:
+            for item in sensor.under(hw.Identifier):
                 print(sensorrow.format(
                     item.Name,
                     item.format('Min',   '{:.2f}'),
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+'''Stand-in Redfish service for 'mini_ipmi_redfish.py check'. Serves recorded resources of a mockup directory
+(redfish/v1/.../index.json, the layout of DMTF Redfish-Mockup-Server) over HTTP with Basic auth of zabbix:secret,
+$select and $expand, appending the path of every request to LOG.
+
+    python3 mockup_server.py MOCKUP PORT LOG   # PORT 0 picks a free port, printed as the first line
+'''
+
+import os
+import sys
+import json
+import base64
+import http.server
+
+
+AUTHORIZATION = 'Basic %s' % base64.b64encode(b'zabbix:secret').decode('ascii')
+
+
+def load(mockup_, path_):
+    '''Resource of path, None if the mockup has none.'''
+    try:
+        with open(os.path.join(mockup_, path_.strip('/'), 'index.json'), 'r') as f:
+            return json.loads(f.read())
+    except (OSError, IOError):
+        return None
+
+
+def expand(mockup_, document_, levels_, isLinks_):
+    '''Document with links to resources of the mockup replaced by them, levels_ deep. Links property only with isLinks_.'''
+    def walk(value, isInLinks):
+        if isinstance(value, dict):
+            if     (list(value) == ['@odata.id'] and
+                    (isLinks_ or not isInLinks)):
+
+                target = load(mockup_, value['@odata.id'])
+                if target is None:
+                    return value
+
+                return expand(mockup_, target, levels_ - 1, isLinks_)
+
+            return dict((k, walk(v, isInLinks or k == 'Links')) for k, v in value.items())
+        elif isinstance(value, list):
+            return [walk(i, isInLinks) for i in value]
+
+        return value
+
+    if levels_ < 1:
+        return document_
+
+    return dict((k, walk(v, k == 'Links')) for k, v in document_.items())
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'   # keep-alive, like BMCs
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body=b''):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        with open(sys.argv[3], 'a') as f:
+            f.write(self.path + '\n')
+
+        if self.headers.get('Authorization') != AUTHORIZATION:
+            return self.reply(401)
+
+        path, sep, query = self.path.partition('?')
+        document = load(sys.argv[1], path)
+        if document is None:
+            return self.reply(404)
+
+        if query.startswith('$expand='):
+            levels = int(query.partition('$levels=')[2].rstrip(')') or 1)
+            document = expand(sys.argv[1], document, levels, query[8:].startswith('*'))
+        elif query.startswith('$select='):
+            selected = query[8:].split(',')
+            document = dict((k, v) for k, v in document.items() if k in selected or k.startswith('@odata.'))
+
+        self.reply(200, json.dumps(document).encode('utf-8'))
+
+
+if __name__ == '__main__':
+    server = getattr(http.server, 'ThreadingHTTPServer', http.server.HTTPServer)(('127.0.0.1', int(sys.argv[2])), Handler)
+    print(server.server_address[1])
+    sys.stdout.flush()
+    server.serve_forever()
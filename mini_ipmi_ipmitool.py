@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+
+## Installation instructions: https://github.com/nobodysu/zabbix-mini-IPMI ##
+
+# Only one out of three system-specific setting is used, PATH considered.
+binPath_LINUX      = r'ipmitool'
+binPath_WIN        = r'C:\Program Files\ipmitool\ipmitool.exe'
+binPath_OTHER      = r'/usr/local/bin/ipmitool'
+
+# path to zabbix agent configuration file
+agentConf_LINUX    = r'/etc/zabbix/zabbix_agentd.conf'
+agentConf_WIN      = r'C:\zabbix_agentd.conf'
+agentConf_OTHER    = r'/usr/local/etc/zabbix3/zabbix_agentd.conf'
+
+senderPath_LINUX   = r'zabbix_sender'
+senderPath_WIN     = r'C:\zabbix-agent\bin\win32\zabbix_sender.exe'
+senderPath_OTHER   = r'/usr/local/bin/zabbix_sender'
+
+# path to second send script
+senderPyPath_LINUX = r'/etc/zabbix/scripts/sender_wrapper.py'
+senderPyPath_WIN   = r'C:\zabbix-agent\scripts\sender_wrapper.py'
+senderPyPath_OTHER = r'/usr/local/etc/zabbix/scripts/sender_wrapper.py'
+
+
+## Advanced configuration ##
+# Extra ipmitool options. Empty uses local BMC through /dev/ipmi0, which requires root.
+ipmiArgs = []
+# like this, for BMC over network:
+#ipmiArgs = ['-I', 'lanplus', '-H', 'bmc.example.com', '-U', 'zabbix', '-f', '/etc/zabbix/ipmi.pass']
+
+# Sensor records are read from BMC once and kept in state directory ('sdr dump'), every run then reads only values.
+# BMC firmware and SDR repository are checked this often; any change rebuilds the cache.
+sdrCheckInterval = 3600   # seconds
+
+bmcTimeout = 20   # single ipmitool call can not exceed this value.
+
+timeout = '80'   # How long the script must wait between LLD and sending, increase if data received late (does not affect windows).
+                 # This setting MUST be lower than 'Update interval' in discovery rule.
+
+# Reading units of 'sdr elist full': item and LLD macro
+unitTypes = (
+    ('degrees C', 'temp'),
+    ('RPM',       'fan'),
+    ('Watts',     'power'),
+    ('Volts',     'vlt'),
+    ('Amps',      'curr'),
+)
+
+## End of configuration ##
+
+
+import sys
+import os
+import subprocess
+import re
+import zlib
+import tempfile
+from json import loads, dumps
+from time import time
+from sender_wrapper import (fail_ifNot_Py3, sanitizeStr, processData, Metric, stampMetrics, singleFlight,
+                            statePath, loadState, saveState)
+
+
+READING_RE = re.compile(r'^(-?\d+(?:\.\d+)?)\s+(.+)$')
+
+# lines of 'mc info' and 'sdr info' that change with firmware update or SDR repository change
+FINGERPRINT_RE = re.compile(r'^\s*(Firmware Revision|Aux Firmware Rev Info|Manufacturer ID|Product ID|'
+                            r'Most recent Addition|Most recent Erase|Record Count)\s*:.*$', re.M)
+
+
+def runIpmitool(args_):
+    '''Output of ipmitool and error, like 'BMC_OS_NOCMD'.'''
+    err = None
+    p = ''
+    try:
+        p = subprocess.check_output([binPath] + ipmiArgs + args_, universal_newlines=True,
+                                    stderr=subprocess.STDOUT, timeout=bmcTimeout)
+
+    except OSError as e:
+        if e.args[0] == 2:
+            err = 'BMC_OS_NOCMD'
+        else:
+            err = 'BMC_OS_ERROR'
+            if sys.argv[1] == 'getverb': raise
+
+    except subprocess.CalledProcessError as e:
+        p = e.output
+        if 'Could not open device' in p:
+            err = 'NO_BMC_DEVICE'
+        else:
+            err = 'ERR_CODE_%s' % str(e.returncode)
+
+    except subprocess.TimeoutExpired:
+        err = 'TIMEOUT'
+
+    return err, p
+
+
+def bmcIdentity():
+    '''Checksum of BMC firmware and SDR repository state, and firmware revision. None if BMC did not answer.'''
+    lines = []
+    firmware = None
+    for args in (['mc', 'info'], ['sdr', 'info']):
+        err, p = runIpmitool(args)
+        if err:
+            return None, None
+
+        lines.extend(i.group(0).strip() for i in FINGERPRINT_RE.finditer(p))
+        revisionRe = re.search(r'^\s*Firmware Revision\s*:\s*(.+)$', p, re.M)
+        if revisionRe:
+            firmware = revisionRe.group(1).strip()
+
+    return zlib.crc32('\n'.join(lines).encode('utf-8')), firmware
+
+
+def prepareSdrCache(cachePath_, stateName_):
+    '''Rebuild SDR cache when it is missing or BMC changed. Error string on failure.'''
+    state = loadState(stateName_, {})
+    if     (os.path.exists(cachePath_) and
+            time() - state.get('checked', 0) < sdrCheckInterval):
+
+        return None
+
+    fingerprint, firmware = bmcIdentity()
+    if     (os.path.exists(cachePath_) and
+            fingerprint is None):
+
+        return None   # BMC did not answer, keep the cache and check again next run
+
+    if     (os.path.exists(cachePath_) and
+            fingerprint == state.get('fingerprint')):
+
+        state['checked'] = time()
+        saveState(stateName_, state)
+        return None
+
+    tmpPath = '%s.%s' % (cachePath_, os.getpid())
+    err, p = runIpmitool(['sdr', 'dump', tmpPath])
+    if err:
+        try:
+            os.remove(tmpPath)
+        except OSError:
+            pass
+
+        return err
+
+    os.replace(tmpPath, cachePath_)
+    saveState(stateName_, {'fingerprint': fingerprint, 'checked': time(), 'firmware': firmware})
+
+    return None
+
+
+def readSensors(cachePath_, stateName_):
+    '''Output of one 'sdr elist full' call from cache, rebuilt once if ipmitool refuses it.'''
+    err = prepareSdrCache(cachePath_, stateName_)
+    if err:
+        return err, ''
+
+    err, p = runIpmitool(['-S', cachePath_, 'sdr', 'elist', 'full'])
+    if err in ('BMC_OS_NOCMD', 'NO_BMC_DEVICE', 'TIMEOUT'):
+        return err, p
+
+    if err:
+        try:
+            os.remove(cachePath_)   # stale or corrupted cache
+        except OSError:
+            pass
+
+        err = prepareSdrCache(cachePath_, stateName_)
+        if err:
+            return err, ''
+
+        err, p = runIpmitool(['-S', cachePath_, 'sdr', 'elist', 'full'])
+
+    return err, p
+
+
+def parseSensors(p_):
+    '''Analog sensors of 'sdr elist full' as (name, sensor number, entity, status, value, units).'''
+    sensors = []
+    for line in p_.splitlines():
+        fields = [i.strip() for i in line.split('|')]
+        if len(fields) != 5:
+            continue
+
+        name, sensorId, status, entity, reading = fields
+        readingRe = READING_RE.match(reading)
+        if readingRe:
+            sensors.append((name, sensorId, entity, status, readingRe.group(1), readingRe.group(2)))
+        else:
+            sensors.append((name, sensorId, entity, status, None, None))   # 'no reading', 'Disabled'
+
+    return sensors
+
+
+def getBmcData(sensors_):
+    '''Metrics and LLD of BMC sensors, keyed by sanitized sensor name.'''
+    sender = []
+    json = []
+
+    names = [i[0] for i in sensors_]
+    namesEntities = [(i[0], i[2]) for i in sensors_]
+    units = dict(unitTypes)
+    for name, number, entity, status, value, unit in sensors_:
+        itemType = units.get(unit)
+        if not itemType:
+            continue   # discrete sensors and unsupported units
+
+        if namesEntities.count((name, entity)) > 1:
+            sensorId = sanitizeStr('%s %s %s' % (name, entity, number))   # same name on one entity, like 'Temp' of a board
+        elif names.count(name) > 1:
+            sensorId = sanitizeStr('%s %s' % (name, entity))   # same name on every PSU or riser
+        else:
+            sensorId = sanitizeStr(name)
+
+        macro = '{#BMC%s}' % itemType.upper()
+        json.append({macro:sensorId, '{#BMC%sNAME}' % itemType.upper():name})
+
+        if value is not None:
+            sender.append(Metric(host, 'mini.bmc.%s' % itemType, (sensorId,), value))
+        sender.append(Metric(host, 'mini.bmc.status', (sensorId,), status))
+
+    return sender, json
+
+
+def checkFixtures(fixturesPath_):
+    '''Compare items and LLD of captured 'sdr elist full' output with sdr_elist_full.expected, then run readSensors()
+    with stand-in ipmitool through SDR cache states and compare its calls. Number of differences.'''
+    failed = 0
+    with open(os.path.join(fixturesPath_, 'sdr_elist_full.txt'), 'r') as f:
+        sensors = parseSensors(f.read())
+    with open(os.path.join(fixturesPath_, 'sdr_elist_full.expected'), 'r') as f:
+        expected = loads(f.read())
+
+    out = getBmcData(sensors)
+    result = loads(dumps([[[i.itemKey(), str(i.value)] for i in out[0]], out[1]]))
+    keys = [i[0] for i in result[0]]
+    isDiffering = result != expected or len(keys) != len(set(keys))
+    print('%-24s %s' % ('sdr_elist_full', 'DIFFERS' if isDiffering else 'OK'))
+    if isDiffering:
+        print('    expected %s\n    got      %s' % (expected, result))
+        failed += 1
+
+    tmpDir = tempfile.mkdtemp()
+    cachePath = os.path.join(tmpDir, 'sdrcache')
+    logPath = os.path.join(tmpDir, 'calls')
+    stateName = 'sdr_check_%s' % os.getpid()
+    os.environ['IPMITOOL_LOG'] = logPath
+    elist = '-S CACHE sdr elist full'
+    rebuild = ['mc info', 'sdr info', 'sdr dump CACHE.PID', elist]
+    steps = (   # title, environment, damage before the run, expected calls and error
+        ('no cache',        {},                                          None,      rebuild,                        None),
+        ('cache',           {},                                          None,      [elist],                        None),
+        ('same firmware',   {},                                          'checked', ['mc info', 'sdr info', elist], None),
+        ('firmware update', {'IPMITOOL_MC_INFO': 'mc_info_updated.txt'}, 'checked', rebuild,                        None),
+        ('corrupted cache', {'IPMITOOL_MC_INFO': 'mc_info_updated.txt'}, 'cache',   [elist] + rebuild,              None),
+        ('BMC down',        {'IPMITOOL_DOWN': '1'},                      'checked', ['mc info', elist],             'NO_BMC_DEVICE'),
+    )
+    try:
+        for title, env, damage, calls, error in steps:
+            for name in ('IPMITOOL_MC_INFO', 'IPMITOOL_DOWN'):
+                os.environ.pop(name, None)
+            os.environ.update(env)
+            if damage == 'checked':
+                state = loadState(stateName, {})
+                state['checked'] = 0
+                saveState(stateName, state)
+            elif damage == 'cache':
+                with open(cachePath, 'wb') as f:
+                    f.write(b'\x00' * 16)
+            if os.path.exists(logPath):
+                os.remove(logPath)
+
+            err, p = readSensors(cachePath, stateName)
+            with open(logPath, 'r') as f:
+                log = f.read().replace('%s.%s' % (cachePath, os.getpid()), 'CACHE.PID').replace(cachePath, 'CACHE')
+
+            differing = []
+            if log.splitlines() != calls:
+                differing.append('calls: expected %s, got %s' % (calls, log.splitlines()))
+            if err != error:
+                differing.append('error: expected %s, got %s' % (error, err))
+            if     (not err and
+                    parseSensors(p) != sensors):
+
+                differing.append('sensors differ from sdr_elist_full.txt')
+            if not os.path.exists(cachePath):
+                differing.append('cache is gone')
+
+            print('%-24s %s' % (title, 'DIFFERS' if differing else 'OK'))
+            for line in differing:
+                print('    %s' % line)
+            failed += len(differing)
+    finally:
+        for path in (cachePath, logPath, statePath(stateName)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        os.rmdir(tmpDir)
+
+    return failed
+
+
+def chooseSystemSpecificPaths():
+    if sys.platform.startswith('linux'):
+        binPath_        = binPath_LINUX
+        agentConf_      = agentConf_LINUX
+        senderPath_     = senderPath_LINUX
+        senderPyPath_   = senderPyPath_LINUX
+
+    elif sys.platform == 'win32':
+        binPath_        = binPath_WIN
+        agentConf_      = agentConf_WIN
+        senderPath_     = senderPath_WIN
+        senderPyPath_   = senderPyPath_WIN
+
+    else:
+        binPath_        = binPath_OTHER
+        agentConf_      = agentConf_OTHER
+        senderPath_     = senderPath_OTHER
+        senderPyPath_   = senderPyPath_OTHER
+
+    if sys.argv[1] == 'getverb':
+        print('  Path guess: %s\n' % sys.platform)
+
+    return (binPath_, agentConf_, senderPath_, senderPyPath_)
+
+
+if __name__ == '__main__':
+    fail_ifNot_Py3()
+
+    paths_Out = chooseSystemSpecificPaths()
+    binPath = paths_Out[0]
+    agentConf = paths_Out[1]
+    senderPath = paths_Out[2]
+    senderPyPath = paths_Out[3]
+
+    if sys.argv[1] == 'check':   # mini_ipmi_ipmitool.py check fixtures/ipmitool
+        binPath = os.path.abspath(os.path.join(sys.argv[2], 'ipmitool'))
+        host = 'check'
+        sys.exit(1 if checkFixtures(sys.argv[2]) else 0)
+
+    host = sys.argv[2]
+    singleFlight('bmc', host)   # exits here if the same run is already in flight
+
+    senderData = []
+    jsonData = []
+
+    stateName = 'sdr_%s' % sanitizeStr(host)
+    try:
+        cachePath = statePath('sdrcache_%s' % sanitizeStr(host))   # private directory of root for local BMC
+    except OSError:
+        cachePath = None
+
+    if cachePath:
+        bmcError, pOut = readSensors(cachePath, stateName)
+    else:
+        bmcError, pOut = 'UNSAFE_STATEDIR', ''
+    clock = int(time())
+
+    sensors = parseSensors(pOut)
+    if not bmcError:
+        getBmcData_Out = getBmcData(sensors)
+        senderData.extend(getBmcData_Out[0])
+        jsonData.extend(getBmcData_Out[1])
+
+    firmware = loadState(stateName, {}).get('firmware')
+    if firmware:
+        senderData.append(Metric(host, 'mini.bmc.info', ('Firmware',), firmware))
+
+    if bmcError:
+        configStatus = bmcError
+    elif not jsonData:
+        configStatus = 'NOSENSORS'
+    else:
+        configStatus = 'CONFIGURED'
+    senderData.append(Metric(host, 'mini.bmc.info', ('ConfigStatus',), configStatus))
+
+    link = r'https://github.com/nobodysu/zabbix-mini-IPMI/issues'
+    sendStatusKey = 'mini.bmc.info[SendStatus]'
+    processData(stampMetrics(senderData, clock), jsonData, agentConf, senderPyPath, senderPath, timeout, host, link, sendStatusKey)
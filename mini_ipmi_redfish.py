@@ -0,0 +1,477 @@
+#!/usr/bin/env python3
+
+## Installation instructions: https://github.com/nobodysu/zabbix-mini-IPMI ##
+
+# BMC address and credentials. Read-only account is enough.
+redfishUrl         = r'https://bmc.example.com'
+redfishUser        = r'zabbix'
+redfishPassFile    = r'/etc/zabbix/redfish.pass'   # first line is the password, keep it readable by zabbix only
+
+# Only one out of three system-specific setting is used, PATH considered.
+# path to zabbix agent configuration file
+agentConf_LINUX    = r'/etc/zabbix/zabbix_agentd.conf'
+agentConf_WIN      = r'C:\zabbix_agentd.conf'
+agentConf_OTHER    = r'/usr/local/etc/zabbix3/zabbix_agentd.conf'
+
+senderPath_LINUX   = r'zabbix_sender'
+senderPath_WIN     = r'C:\zabbix-agent\bin\win32\zabbix_sender.exe'
+senderPath_OTHER   = r'/usr/local/bin/zabbix_sender'
+
+# path to second send script
+senderPyPath_LINUX = r'/etc/zabbix/scripts/sender_wrapper.py'
+senderPyPath_WIN   = r'C:\zabbix-agent\scripts\sender_wrapper.py'
+senderPyPath_OTHER = r'/usr/local/etc/zabbix/scripts/sender_wrapper.py'
+
+
+## Advanced configuration ##
+# Certificate of BMC is verified against system CAs, or against redfishCaFile, like the self-signed certificate
+# exported from BMC web interface. False skips verification: anyone on the path to BMC gets the password.
+isVerifyCert = True
+redfishCaFile = None   # r'/etc/zabbix/bmc.example.com.pem'
+
+requestTimeout = 10   # seconds, single request
+
+# Chassis list, sensor resource paths and BMC firmware are kept in state directory and read again this often.
+# Every run then fetches only readings: one request with $expand, or one per sensor resource with $select.
+inventoryRefresh = 86400   # seconds
+
+timeout = '80'   # How long the script must wait between LLD and sending, increase if data received late (does not affect windows).
+                 # This setting MUST be lower than 'Update interval' in discovery rule.
+
+## End of configuration ##
+
+
+import os
+import sys
+import ssl
+import base64
+import socket
+import http.client
+import subprocess
+import tempfile
+from time import time
+from json import loads, dumps
+from urllib.parse import urlsplit
+from sender_wrapper import (fail_ifNot_Py3, sanitizeStr, processData, Metric, stampMetrics, singleFlight,
+                            loadState, saveState)
+
+
+# Redfish Health to 'ipmitool sdr' status, so both collectors feed the same triggers
+HEALTH_STATUS = {'OK': 'ok', 'Warning': 'nc', 'Critical': 'cr'}
+
+# legacy resource: (member list, reading property, item type)
+LEGACY_READINGS = {
+    'Thermal': (('Temperatures', 'ReadingCelsius', 'temp'),
+                ('Fans', 'Reading', 'fan')),
+    'Power':   (('PowerControl', 'PowerConsumedWatts', 'power'),
+                ('Voltages', 'ReadingVolts', 'vlt'),
+                ('PowerSupplies', 'PowerInputWatts', 'power')),
+}
+
+# $select of each resource, only readings are transferred
+SELECTS = {
+    'Thermal': 'Temperatures,Fans',
+    'Power': 'PowerControl,Voltages,PowerSupplies',
+    'ThermalMetrics': 'TemperatureReadingsCelsius',
+    'EnvironmentMetrics': 'PowerWatts',
+}
+
+
+class RedfishError(Exception):
+    '''Failed request, args[0] is ConfigStatus like 'REDFISH_AUTH'.'''
+
+
+class RedfishSession(object):
+    '''One keep-alive connection to BMC, reopened once if BMC closed it between requests.'''
+
+    def __init__(self, url_, user_, password_):
+        parts = urlsplit(url_)
+        self.isHttps = parts.scheme == 'https'
+        self.netloc = parts.netloc
+        self.conn = None
+        self.requests = 0
+
+        token = base64.b64encode(('%s:%s' % (user_, password_)).encode('utf-8')).decode('ascii')
+        self.headers = {'Authorization': 'Basic %s' % token,
+                        'Accept': 'application/json',
+                        'Connection': 'keep-alive',
+                        'OData-Version': '4.0'}
+
+    def connect(self):
+        if self.isHttps:
+            context = ssl.create_default_context(cafile=redfishCaFile)
+            if not isVerifyCert:
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+
+            self.conn = http.client.HTTPSConnection(self.netloc, timeout=requestTimeout, context=context)
+        else:
+            self.conn = http.client.HTTPConnection(self.netloc, timeout=requestTimeout)
+
+    def get(self, path_):
+        '''Decoded JSON of resource.'''
+        for attempt in range(2):
+            if not self.conn:
+                self.connect()
+
+            try:
+                self.conn.request('GET', path_, headers=self.headers)
+                response = self.conn.getresponse()
+                body = response.read()   # whole body, so the connection can be reused
+                break
+            except (http.client.RemoteDisconnected, http.client.BadStatusLine, ConnectionError):
+                self.close()
+                if attempt:
+                    raise RedfishError('REDFISH_NOCONN')
+            except ssl.CertificateError:
+                self.close()
+                raise RedfishError('REDFISH_CERT')
+            except (socket.timeout, OSError, http.client.HTTPException):
+                self.close()
+                raise RedfishError('REDFISH_NOCONN')
+
+        self.requests += 1
+        if response.status in (401, 403):
+            raise RedfishError('REDFISH_AUTH')
+        elif response.status != 200:
+            raise RedfishError('REDFISH_HTTP_%s' % response.status)
+
+        try:
+            return loads(body.decode('utf-8'))
+        except ValueError:
+            raise RedfishError('REDFISH_BADJSON')
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+
+def readPassword():
+    try:
+        with open(redfishPassFile, 'r') as f:
+            return f.readline().rstrip('\r\n')
+    except (OSError, IOError):
+        return ''
+
+
+def readInventory(session_):
+    '''Sensor resources of every chassis, supported query parameters and BMC firmware.'''
+    root = session_.get('/redfish/v1/')
+    features = root.get('ProtocolFeaturesSupported', {})
+    expand = features.get('ExpandQuery', {})
+    if     (not expand.get('Levels') or
+            expand.get('MaxLevels', 1) < 2):
+
+        expandQuery = None
+    elif expand.get('NoLinks'):
+        expandQuery = '.($levels=2)'   # subordinate resources only, Thermal and Power are among them
+    elif expand.get('ExpandAll'):
+        expandQuery = '*($levels=2)'
+    else:
+        expandQuery = None
+
+    resources = []   # [chassis id, resource kind, path]
+    for member in session_.get('/redfish/v1/Chassis').get('Members', []):
+        chassis = session_.get(member['@odata.id'])
+        chassisId = chassis.get('Id', member['@odata.id'].rstrip('/').split('/')[-1])
+        if     ('Thermal' in chassis or
+                'Power' in chassis):
+
+            for kind in ('Thermal', 'Power'):
+                if kind in chassis:
+                    resources.append([chassisId, kind, chassis[kind]['@odata.id']])
+
+        elif 'ThermalSubsystem' in chassis:   # 2020.4+ schema
+            thermal = session_.get(chassis['ThermalSubsystem']['@odata.id'])
+            if 'ThermalMetrics' in thermal:
+                resources.append([chassisId, 'ThermalMetrics', thermal['ThermalMetrics']['@odata.id']])
+            if 'EnvironmentMetrics' in chassis:
+                resources.append([chassisId, 'EnvironmentMetrics', chassis['EnvironmentMetrics']['@odata.id']])
+
+    firmware = None
+    managers = session_.get('/redfish/v1/Managers').get('Members', [])
+    if managers:
+        firmware = session_.get(managers[0]['@odata.id']).get('FirmwareVersion')
+
+    return {'url': redfishUrl,
+            'checked': time(),
+            'expand': expandQuery,
+            'isSelect': bool(features.get('SelectQuery')),
+            'resources': resources,
+            'firmware': firmware}
+
+
+def findExpanded(document_, path_):
+    '''Resource with given @odata.id inside expanded document, None if BMC did not expand it.'''
+    if isinstance(document_, dict):
+        if     (document_.get('@odata.id') == path_ and
+                len(document_) > 1):
+
+            return document_
+
+        children = document_.values()
+    elif isinstance(document_, list):
+        children = document_
+    else:
+        return None
+
+    for child in children:
+        found = findExpanded(child, path_)
+        if found is not None:
+            return found
+
+    return None
+
+
+def readResources(session_, inventory_):
+    '''Documents of all sensor resources as [(chassis id, kind, document)].'''
+    expanded = None
+    if inventory_['expand']:
+        expanded = session_.get('/redfish/v1/Chassis?$expand=%s' % inventory_['expand'])
+
+    documents = []
+    for chassisId, kind, path in inventory_['resources']:
+        document = None
+        if expanded is not None:
+            document = findExpanded(expanded, path)
+
+        if document is None:
+            if inventory_['isSelect']:
+                document = session_.get('%s?$select=%s' % (path, SELECTS[kind]))
+            else:
+                document = session_.get(path)
+
+        documents.append((chassisId, kind, document))
+
+    return documents
+
+
+def memberStatus(member_):
+    '''Sensor status like 'ipmitool sdr' prints, None if sensor is absent.'''
+    status = member_.get('Status', {})
+    if status.get('State') in ('Absent', 'Disabled'):
+        return None
+    if status.get('State') == 'UnavailableOffline':
+        return 'ns'
+
+    return HEALTH_STATUS.get(status.get('Health'), 'ok')
+
+
+def collectReadings(documents_):
+    '''Readings as (chassis id, member id, name, item type, value, status).'''
+    readings = []
+    for chassisId, kind, document in documents_:
+        if kind in LEGACY_READINGS:
+            for listName, valueName, itemType in LEGACY_READINGS[kind]:
+                for num, member in enumerate(document.get(listName, [])):
+                    status = memberStatus(member)
+                    if     (not status or
+                            member.get('ReadingUnits', 'RPM') != 'RPM'):   # fans in percent, other members have no units
+
+                        continue
+
+                    memberId = member.get('MemberId') or str(num)
+                    name = member.get('Name') or member.get('FanName') or memberId
+                    readings.append((chassisId, memberId, name, itemType, member.get(valueName), status))
+
+        elif kind == 'ThermalMetrics':
+            for member in document.get('TemperatureReadingsCelsius', []):
+                memberId = member.get('DataSourceUri', '').rstrip('/').split('/')[-1]
+                name = member.get('DeviceName') or memberId
+                readings.append((chassisId, memberId, name, 'temp', member.get('Reading'), 'ok'))
+
+        elif kind == 'EnvironmentMetrics':
+            if 'PowerWatts' in document:
+                readings.append((chassisId, 'PowerWatts', 'Power', 'power', document['PowerWatts'].get('Reading'), 'ok'))
+
+    return readings
+
+
+def getBmcData(readings_):
+    '''Metrics and LLD of BMC sensors, same keys as mini_ipmi_ipmitool.py.'''
+    sender = []
+    json = []
+
+    names = [i[2] for i in readings_]   # all types, mini.bmc.status is shared by them
+    namesChassis = [(i[2], i[0]) for i in readings_]
+    for chassisId, memberId, name, itemType, value, status in readings_:
+        if namesChassis.count((name, chassisId)) > 1:
+            sensorId = sanitizeStr('%s %s %s' % (name, chassisId, memberId))   # same name in one chassis, like PSUs named by model
+        elif names.count(name) > 1:
+            sensorId = sanitizeStr('%s %s' % (name, chassisId))   # same name in every chassis
+        else:
+            sensorId = sanitizeStr(name)
+
+        json.append({'{#BMC%s}' % itemType.upper():sensorId, '{#BMC%sNAME}' % itemType.upper():name})
+
+        if value is not None:
+            sender.append(Metric(host, 'mini.bmc.%s' % itemType, (sensorId,), value))
+        sender.append(Metric(host, 'mini.bmc.status', (sensorId,), status))
+
+    return sender, json
+
+
+def checkFixtures(fixturesPath_):
+    '''Run collector against stand-in Redfish service of every mockup directory in fixtures, compare request paths,
+    items and LLD with MOCKUP.expected. Number of differences.'''
+    failed = 0
+    for name in sorted(os.listdir(fixturesPath_)):
+        if not name.endswith('.expected'):
+            continue
+
+        with open(os.path.join(fixturesPath_, name), 'r') as f:
+            expected = loads(f.read())
+
+        mockup = name[:-len('.expected')]
+        logFd, logPath = tempfile.mkstemp()
+        os.close(logFd)
+        server = subprocess.Popen([sys.executable, os.path.join(fixturesPath_, 'mockup_server.py'),
+                                   os.path.join(fixturesPath_, mockup), '0', logPath],
+                                  stdout=subprocess.PIPE, universal_newlines=True)
+
+        def takeLog():
+            with open(logPath, 'r+') as f:
+                paths = f.read().splitlines()
+                f.truncate(0)
+            return paths
+
+        result = {}
+        try:
+            url = 'http://127.0.0.1:%s' % server.stdout.readline().strip()
+            session = RedfishSession(url, 'zabbix', 'wrong')
+            try:
+                session.get('/redfish/v1/')
+                result['wrongPassword'] = None
+            except RedfishError as e:
+                result['wrongPassword'] = e.args[0]
+            session.close()
+            takeLog()
+
+            session = RedfishSession(url, 'zabbix', 'secret')
+            inventory = readInventory(session)
+            result['inventory'] = takeLog()
+            result['firmware'] = inventory['firmware']
+            documents = readResources(session, inventory)
+            result['readings'] = takeLog()
+            session.close()
+
+            out = getBmcData(collectReadings(documents))
+            result['items'] = [[i.itemKey(), str(i.value)] for i in out[0]]
+            result['lld'] = out[1]
+        except RedfishError as e:
+            result['error'] = e.args[0]
+        finally:
+            server.terminate()
+            server.wait()
+            server.stdout.close()
+            os.remove(logPath)
+
+        result = loads(dumps(result))
+        differing = [i for i in sorted(expected) if result.get(i) != expected[i]]
+        keys = [i[0] for i in result.get('items', ())]
+        if len(keys) != len(set(keys)):
+            differing.append('duplicate items')
+
+        print('%-24s %s' % (mockup, 'DIFFERS' if differing else 'OK'))
+        for key in differing:
+            print('    %s:\n      expected %s\n      got      %s' % (key, expected.get(key), result.get(key)))
+        failed += len(differing)
+
+    return failed
+
+
+def chooseSystemSpecificPaths():
+    if sys.platform.startswith('linux'):
+        agentConf_      = agentConf_LINUX
+        senderPath_     = senderPath_LINUX
+        senderPyPath_   = senderPyPath_LINUX
+
+    elif sys.platform == 'win32':
+        agentConf_      = agentConf_WIN
+        senderPath_     = senderPath_WIN
+        senderPyPath_   = senderPyPath_WIN
+
+    else:
+        agentConf_      = agentConf_OTHER
+        senderPath_     = senderPath_OTHER
+        senderPyPath_   = senderPyPath_OTHER
+
+    if sys.argv[1] == 'getverb':
+        print('  Path guess: %s\n' % sys.platform)
+
+    return (agentConf_, senderPath_, senderPyPath_)
+
+
+if __name__ == '__main__':
+    fail_ifNot_Py3()
+
+    paths_Out = chooseSystemSpecificPaths()
+    agentConf = paths_Out[0]
+    senderPath = paths_Out[1]
+    senderPyPath = paths_Out[2]
+
+    if sys.argv[1] == 'check':   # mini_ipmi_redfish.py check fixtures/redfish
+        host = 'check'
+        sys.exit(1 if checkFixtures(sys.argv[2]) else 0)
+
+    host = sys.argv[2]
+    singleFlight('redfish', host)   # exits here if the same run is already in flight
+
+    senderData = []
+    jsonData = []
+
+    stateName = 'redfish_%s' % sanitizeStr(host)
+    inventory = loadState(stateName, {})
+    session = RedfishSession(redfishUrl, redfishUser, readPassword())
+    bmcError = None
+    try:
+        if     (inventory.get('url') != redfishUrl or
+                time() - inventory.get('checked', 0) > inventoryRefresh):
+
+            inventory = readInventory(session)
+            saveState(stateName, inventory)
+
+        try:
+            documents = readResources(session, inventory)
+        except RedfishError as e:
+            if e.args[0] != 'REDFISH_HTTP_404':
+                raise
+
+            inventory = readInventory(session)   # resource moved, like after firmware update
+            saveState(stateName, inventory)
+            documents = readResources(session, inventory)
+
+        clock = int(time())
+        getBmcData_Out = getBmcData(collectReadings(documents))
+        senderData.extend(getBmcData_Out[0])
+        jsonData.extend(getBmcData_Out[1])
+
+    except RedfishError as e:
+        bmcError = e.args[0]
+        clock = int(time())
+
+    except (KeyError, IndexError, TypeError, AttributeError, ValueError):
+        bmcError = 'REDFISH_BADJSON'   # valid JSON of unexpected shape
+        clock = int(time())
+
+    finally:
+        session.close()
+
+    if sys.argv[1] == 'getverb':
+        print('  Redfish requests: %s\n' % session.requests)
+
+    if inventory.get('firmware'):
+        senderData.append(Metric(host, 'mini.bmc.info', ('Firmware',), inventory['firmware']))
+
+    if bmcError:
+        configStatus = bmcError
+    elif not jsonData:
+        configStatus = 'NOSENSORS'
+    else:
+        configStatus = 'CONFIGURED'
+    senderData.append(Metric(host, 'mini.bmc.info', ('ConfigStatus',), configStatus))
+
+    link = r'https://github.com/nobodysu/zabbix-mini-IPMI/issues'
+    sendStatusKey = 'mini.bmc.info[SendStatus]'
+    processData(stampMetrics(senderData, clock), jsonData, agentConf, senderPyPath, senderPath, timeout, host, link, sendStatusKey)
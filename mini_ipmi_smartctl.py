@@ -77,7 +77,8 @@ import sys
 import subprocess
 import re
 import shlex
-from sender_wrapper import (fail_ifNot_Py3, sanitizeStr, clearDiskTypeStr, processData)
+from time import time
+from sender_wrapper import (fail_ifNot_Py3, sanitizeStr, clearDiskTypeStr, processData, Metric, stampMetrics, singleFlight)
 
 
 def scanDisks(mode):
@@ -310,6 +311,8 @@ if __name__ == '__main__':
     senderPyPath = paths_Out[3]
 
     host = sys.argv[2]
+    singleFlight('disk', host)   # exits here if the same run is already in flight
+
     senderData = []
     jsonData = []
 
@@ -329,8 +332,10 @@ if __name__ == '__main__':
         jsonData.append({'{#DISK}':sanitizedD})
 
         disk_Out = findErrorsAndOuts(clearedD)
+        diskClock = int(time())   # every disk is stamped with its own query time
         diskError = disk_Out[0]
         diskPout = disk_Out[1]
+        diskSender = []
         if diskError:
             if 'D_OS_' in diskError:
                 diskError_NOCMD = diskError
@@ -359,29 +364,31 @@ if __name__ == '__main__':
             driveStatus = 'NOTEMP'
         else:
             driveStatus = 'PROCESSED'
-        senderData.append('"%s" mini.disk.info[%s,DriveStatus] "%s"' % (host, sanitizedD, driveStatus))
+        diskSender.append(Metric(host, 'mini.disk.info', (sanitizedD, 'DriveStatus'), driveStatus))
 
         if temp:
-            senderData.append('"%s" mini.disk.temp[%s] "%s"' % (host, sanitizedD, temp))
+            diskSender.append(Metric(host, 'mini.disk.temp', (sanitizedD,), temp))
             allTemps.append(temp)
 
-        senderData.append('"%s" mini.disk.tempMin[%s] "%s"'  % (host, sanitizedD, thresholds[0][1]))
-        senderData.append('"%s" mini.disk.tempMax[%s] "%s"'  % (host, sanitizedD, thresholds[0][2]))
-        senderData.append('"%s" mini.disk.tempCrit[%s] "%s"' % (host, sanitizedD, thresholds[0][3]))
+        diskSender.append(Metric(host, 'mini.disk.tempMin', (sanitizedD,), thresholds[0][1]))
+        diskSender.append(Metric(host, 'mini.disk.tempMax', (sanitizedD,), thresholds[0][2]))
+        diskSender.append(Metric(host, 'mini.disk.tempCrit', (sanitizedD,), thresholds[0][3]))
 
         if isHeavyDebug:
             heavyOut = repr(diskPout.strip())
             heavyOut = heavyOut.strip().strip('"').strip("'").strip()
-            heavyOut = heavyOut.replace("'", r"\'").replace('"', r'\"')
 
-            debugData = '"%s" mini.disk.HeavyDebug "%s"' % (host, heavyOut)
+            debugData = Metric(host, 'mini.disk.HeavyDebug', (), heavyOut)
             if diskError:
                 if 'ERR_CODE_' in diskError:
-                    senderData.append(debugData)
+                    diskSender.append(debugData)
             elif not temp:
                 if not isModelWithoutSensor(diskPout):
-                    senderData.append(debugData)
+                    diskSender.append(debugData)
+
+        senderData.extend(stampMetrics(diskSender, diskClock))
 
+    summarySender = []
     if scanErrorNotype:
         configStatus = scanErrorNotype
     elif diskError_NOCMD:
@@ -392,10 +399,12 @@ if __name__ == '__main__':
         configStatus = 'NODISKTEMPS'
     else:
         configStatus = 'CONFIGURED'
-    senderData.append('"%s" mini.disk.info[ConfigStatus] "%s"' % (host, configStatus))
+    summarySender.append(Metric(host, 'mini.disk.info', ('ConfigStatus',), configStatus))
 
     if allTemps:
-        senderData.append('"%s" mini.disk.temp[MAX] "%s"' % (host, str(max(allTemps))))
+        summarySender.append(Metric(host, 'mini.disk.temp', ('MAX',), str(max(allTemps))))
+
+    senderData.extend(stampMetrics(summarySender, int(time())))
 
     link = r'https://github.com/nobodysu/zabbix-mini-IPMI/issues'
     sendStatusKey = 'mini.disk.info[SendStatus]'
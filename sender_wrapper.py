@@ -1,10 +1,106 @@
 #!/usr/bin/env python3
 
+## Advanced configuration ##
+# Directory for spooled values and other state, created on first use. Every user gets a private directory in it.
+stateDir_LINUX     = r'/var/tmp/zabbix-mini-IPMI'
+stateDir_WIN       = r'C:\zabbix-agent\state'
+stateDir_OTHER     = r'/var/tmp/zabbix-mini-IPMI'
+
+# Values that could not be sent (server or proxy unreachable) are spooled and replayed on next successful send.
+isSpoolEnabled     = True
+spoolMaxSize       = 4194304   # bytes, oldest values are dropped first
+spoolMaxAge        = 86400     # seconds, older values are dropped on replay
+spoolBatchSize     = 250       # values per replayed sender call
+spoolBatchDelay    = 1         # seconds between replayed sender calls
+
+# Single resident process holds deferred data instead of one sleeping interpreter per run (not used on windows).
+# One per user, listening on a unix socket in private state directory, so it takes data only from that user's runs.
+isSchedulerEnabled = True
+schedulerIdleExit  = 3600      # seconds without new data before it exits, next run starts it again
+
+# Relay: 'sender_wrapper.py relay' collects data of many hosts (VMs, containers) and sends it upstream in large batches.
+relayAddress       = None      # 'host:port' of relay for this host's collectors, None sends directly
+relayBind          = '127.0.0.1'   # '0.0.0.0' to serve guests, with their IPs in relayAllowedHosts
+relayPort          = 10098
+relayAllowedHosts  = ()        # client IPs accepted by relay besides localhost
+relayUpstream      = None      # 'host:port' of server or proxy, None uses first ServerActive of agent config
+relayMaxBatch      = 5000      # values per upstream connection
+relayFlushInterval = 5         # seconds data may wait for batch to fill
+
+# Spread sends of many hosts over this many seconds, offset is stable per host name. 0 disables.
+# Collector 'timeout' plus this value MUST be lower than 'Update interval' in discovery rule.
+splayWindow        = 0
+
+# 'lines' sends every value as separate item. 'master' sends whole run as one JSON value to mini.cpu.json
+# or mini.disk.json, use with Template_mini-IPMI_v2_master.xml where items are dependent on it (Zabbix 5.0+).
+payloadMode        = 'lines'
+
+# Skip values unchanged since last send until heartbeat passes. Counted in mini.*.info[SuppressedValues].
+# Suppressed item gets no value for up to heartbeat plus one run interval, nodata() triggers must allow for that.
+isSendOnChange     = False
+sendOnChangeHeartbeat = 3600   # seconds, unchanged values are still sent this often
+sendOnChangeRepeats   = 3      # value is suppressed only after it was sent this many times in a row
+sendOnChangeAlways = (         # keys never suppressed, template triggers count their values
+    r'^mini\.disk\.temp\[',
+)
+
+# Temperature slope in degrees per minute, fitted locally over these windows (seconds) from values kept between runs.
+# Sent with window as extra key parameter, like mini.disk.temp[sda,slope3600]. Window must span several collector runs.
+slopeWindows       = (3600, 10800)   # empty disables
+slopeHistoryMax    = 64        # values kept per sensor
+slopeKeys = (                  # temperature items of disks, CPU packages and GPUs
+    r'^mini\.disk\.temp\[(?!MAX\])',
+    r'^mini\.cpu\.temp\[cpu\d+,MAX\]$',
+    r'^mini\.gpu\.temp\[gpu\d+\]$',
+)
+
+# Values crossing their threshold item of the same run are sent right away, without LLD wait and splay.
+# Value is sent once per crossing; it must fall 'urgentHysteresis' below threshold before next crossing counts.
+isUrgentSend       = True
+urgentHysteresis   = 3         # degrees
+urgentThresholds = (           # value item, its threshold items; \1 is taken from value item
+    (r'^mini\.disk\.temp\[([^,\]]+)\]$', (r'mini.disk.tempMax[\1]', r'mini.disk.tempCrit[\1]')),
+    (r'^mini\.cpu\.temp\[(cpu\d+),[^,\]]+\]$', (r'mini.cpu.info[\1,TjMax]',)),
+)
+
+# Overlapping runs of the same collector attach to the one in flight instead of querying devices again.
+isSingleFlight     = True
+runAttachTimeout   = 8         # seconds to wait for in-flight run, keep below agent 'Timeout'
+runLockStale       = 600       # seconds after which a lock of a vanished run is ignored
+
+## End of configuration ##
+
 import sys
+import os
 import subprocess
 import re
-from time import sleep
-from json import dumps
+import socket
+import select
+import threading
+import heapq
+import zlib
+import struct
+import stat
+from time import sleep, time
+from json import dumps, loads
+import queue
+
+
+SENDER_FAILED = 1   # zabbix_sender exit code when nothing was processed; 2 means partial success
+
+SCHEDULER_MAX_PAYLOAD = 16777216   # bytes
+SCHEDULER_READ_TIMEOUT = 5         # seconds a client may take to send its payload
+
+# "host" key clock "value", host may be quoted
+SENDER_LINE_RE = re.compile(r'^("(?:[^"\\]|\\.)*"|\S+)\s+(\S+)\s+(.*)$')
+
+# escaping inside quoted fields of sender lines
+QUOTE_TABLE = str.maketrans({'\\': '\\\\', '"': '\\"'})
+
+# single character part of sanitizeStr(), multi character replaces are done before it
+SANITIZE_TABLE = str.maketrans(dict.fromkeys('!,[~]+/\\\'`@#$%^&*(){}=:;"?<> ', '_'))
+
+QUOTES_TABLE = str.maketrans('', '', '\'"')
 
 
 def isWindows():
@@ -13,36 +109,827 @@ def isWindows():
     else:
         return False
 
-        
+
+def chooseStateDir():
+    if sys.platform.startswith('linux'):
+        stateDir_ = stateDir_LINUX
+    elif sys.platform == 'win32':
+        stateDir_ = stateDir_WIN
+    else:
+        stateDir_ = stateDir_OTHER
+
+    # shared between root (smartctl) and zabbix (sensors) runs like /tmp, files live in private directories within
+    if not os.path.isdir(stateDir_):
+        try:
+            os.makedirs(stateDir_)
+            if not isWindows():
+                os.chmod(stateDir_, 0o1777)
+        except OSError:
+            pass
+
+    return stateDir_
+
+
+def userName():
+    '''Name of effective user. Looked up by uid where possible, sudo may keep LOGNAME of the caller.'''
+    try:
+        import pwd
+        return pwd.getpwuid(os.geteuid()).pw_name
+    except (ImportError, KeyError):
+        pass
+
+    try:
+        import getpass
+        name = getpass.getuser()
+    except Exception:
+        name = 'unknown'
+
+    return name
+
+
+def isSafeDir(path_, isShared_):
+    '''Real directory owned by this user or root, where nobody else can swap files.
+
+    Shared one must have sticky bit if others may write to it, private one must be closed to others.'''
+    if isWindows():
+        return os.path.isdir(path_)
+
+    try:
+        st = os.lstat(path_)   # symlink is not followed
+    except OSError:
+        return False
+
+    if     (not stat.S_ISDIR(st.st_mode) or
+            st.st_uid not in (0, os.geteuid())):
+
+        return False
+
+    if isShared_:
+        return not st.st_mode & 0o022 or bool(st.st_mode & stat.S_ISVTX)
+    else:
+        return st.st_uid == os.geteuid() and not st.st_mode & 0o077
+
+
+def userStateDir():
+    '''Private directory of this user in state directory, created on first use. OSError if it is not safe.'''
+    stateDir_ = chooseStateDir()
+    path = os.path.join(stateDir_, userName())
+    if not os.path.isdir(path):
+        try:
+            os.mkdir(path, 0o700)
+        except OSError:
+            pass
+
+    if     (not isSafeDir(stateDir_, True) or
+            not isSafeDir(path, False)):
+
+        raise OSError('unsafe state directory: %s' % path)
+
+    return path
+
+
+def statePath(name_):
+    '''File in private state directory of this user, so root and zabbix runs neither clash nor trust each other.'''
+    return os.path.join(userStateDir(), name_)
+
+
+def loadState(name_, default_):
+    '''Read JSON state file, default on any problem.'''
+    try:
+        with open(statePath(name_), 'r') as f:
+            return loads(f.read())
+    except (OSError, IOError, ValueError):
+        return default_
+
+
+def saveState(name_, state_):
+    '''Write JSON state file atomically.'''
+    try:
+        path = statePath(name_)
+        tmpPath = '%s.%s' % (path, os.getpid())
+        with open(tmpPath, 'w') as f:
+            f.write(dumps(state_))
+        os.replace(tmpPath, path)
+    except (OSError, IOError):
+        pass
+
+
+def bumpCounter(collector_, counter_):
+    '''Increment persistent coalescing counter of the collector.'''
+    counters = loadState('counters_%s' % collector_, {})
+    counters[counter_] = counters.get(counter_, 0) + 1
+    saveState('counters_%s' % collector_, counters)
+
+
+def proposeSendState(collector_, senderDataNStr_, state_):
+    '''Keep send state of this run until its data is sent. Newer run of the collector overwrites it.'''
+    saveState('nextvalues_%s' % collector_, {'data': zlib.crc32(senderDataNStr_.encode('utf-8')), 'values': state_})
+
+
+def commitSendState(collector_, senderDataNStr_):
+    '''Make proposed send state the last one, if it belongs to the data that was just sent.
+
+    Spooled data does not count, spool may drop it on size or age limit, so its values are sent again.'''
+    if not collector_:
+        return
+
+    proposed = loadState('nextvalues_%s' % collector_, {})
+    if proposed.get('data') == zlib.crc32(senderDataNStr_.encode('utf-8')):
+        saveState('lastvalues_%s' % collector_, proposed['values'])
+
+
+class Metric(object):
+    '''One item value: host, key with its parameters, value and collection clock.'''
+    __slots__ = ('host', 'key', 'params', 'value', 'clock')
+
+    def __init__(self, host_, key_, params_=(), value_='', clock_=None):
+        self.host = host_
+        self.key = key_
+        self.params = params_
+        self.value = value_
+        self.clock = clock_
+
+    def itemKey(self):
+        if self.params:
+            return '%s[%s]' % (self.key, ','.join(map(str, self.params)))
+        else:
+            return self.key
+
+    def __repr__(self):
+        return 'Metric(%r, %r, %r, %r, %r)' % (self.host, self.key, self.params, self.value, self.clock)
+
+
+def stampMetrics(metrics_, clock_):
+    '''Set collection time of metrics that have none yet. Clock is collection time, not send time.'''
+    for metric in metrics_:
+        if metric.clock is None:
+            metric.clock = clock_
+
+    return metrics_
+
+
+def serializeMetrics(metrics_, native_=False):
+    '''Metrics as sender's '-T' lines, or as native sender protocol request when native_.'''
+    if native_:
+        data = [{'host': m.host, 'key': m.itemKey(), 'value': str(m.value), 'clock': m.clock} for m in metrics_]
+        return dumps({'request': 'sender data', 'data': data, 'clock': int(time())})
+
+    lines = []
+    hosts = {}   # all metrics of a run usually share one host
+    for m in metrics_:
+        host = hosts.get(m.host)
+        if host is None:
+            host = hosts[m.host] = '"%s"' % m.host.translate(QUOTE_TABLE)
+
+        if m.params:
+            key = '%s[%s]' % (m.key, ','.join(map(str, m.params)))
+        else:
+            key = m.key
+
+        lines.append('%s %s %s "%s"' % (host, key, m.clock, str(m.value).translate(QUOTE_TABLE)))
+
+    return lines
+
+
+def lineMetric(line_):
+    '''Metric of '-T' formatted line with item key kept whole, None if malformed.'''
+    fields = splitLine(line_)
+    if fields:
+        return Metric(unquoteValue(fields[0]), fields[1], (), unquoteValue(fields[3]), fields[2])
+
+    return None
+
+
+def splitLine(line_):
+    '''Host, key, clock and value of '-T' formatted line, None if malformed.'''
+    fields = SENDER_LINE_RE.match(line_)
+    if fields:
+        clockValue = fields.group(3).split(None, 1)
+        if     (len(clockValue) == 2 and
+                clockValue[0].isdigit()):
+
+            return fields.group(1), fields.group(2), int(clockValue[0]), clockValue[1]
+
+    return None
+
+
+def unquoteValue(value_):
+    '''Value field of sender line as plain string.'''
+    if     (len(value_) >= 2 and
+            value_.startswith('"') and
+            value_.endswith('"')):
+
+        return re.sub(r'\\(.)', r'\1', value_[1:-1])
+
+    return value_
+
+
+def quoteValue(value_):
+    '''Plain string as quoted value field of sender line.'''
+    return '"%s"' % value_.translate(QUOTE_TABLE)
+
+
+def lineClock(line_):
+    '''Clock of '-T' formatted line, zero if malformed.'''
+    fields = splitLine(line_)
+    if fields:
+        return fields[2]
+
+    return 0
+
+
+def runSender(senderPath_, agentConf_, senderArgs_, senderDataNStr_):
+    '''Feed timestamped lines to zabbix_sender and return its exit code.'''
+    cmd = [senderPath_] + senderArgs_ + ['-c', agentConf_, '-T', '-i', '-']
+    senderProc = subprocess.Popen(cmd, stdin=subprocess.PIPE, universal_newlines=True, close_fds=(not isWindows()))
+    senderProc.communicate(input=senderDataNStr_)
+
+    return senderProc.returncode
+
+
+def spoolData(lines_, spoolName_='spool'):
+    '''Append unsent lines to the spool, trimming oldest ones above size limit.'''
+    try:
+        path = statePath(spoolName_)
+        with open(path, 'a') as f:
+            f.write('\n'.join(lines_) + '\n')
+
+        if os.path.getsize(path) > spoolMaxSize:
+            with open(path, 'r') as f:
+                spooled = f.read().splitlines()
+
+            kept = []
+            size = 0
+            for line in reversed(spooled):
+                size += len(line) + 1
+                if size > spoolMaxSize:
+                    break
+                kept.append(line)
+            kept.reverse()
+
+            tmpPath = '%s.%s' % (path, os.getpid())
+            with open(tmpPath, 'w') as f:
+                f.write('\n'.join(kept) + '\n')
+            os.replace(tmpPath, path)
+
+    except (OSError, IOError):
+        pass
+
+
+def takeSpool(spoolName_):
+    '''Remove the spool and return its lines not older than spoolMaxAge, oldest first.'''
+    try:
+        path = statePath(spoolName_)
+        drainPath = '%s.%s' % (path, os.getpid())
+        os.replace(path, drainPath)   # concurrent runs append to a fresh spool meanwhile
+        with open(drainPath, 'r') as f:
+            spooled = f.read().splitlines()
+        os.remove(drainPath)
+    except (OSError, IOError):
+        return []
+
+    oldest = time() - spoolMaxAge
+    spooled = [line for line in spooled if lineClock(line) > oldest]
+    spooled.sort(key=lineClock)   # stable, keeps order within one clock
+
+    return spooled
+
+
+def drainSpool(senderPath_, agentConf_):
+    '''Replay spooled lines oldest first, in rate limited batches.'''
+    spooled = takeSpool('spool')
+    for i in range(0, len(spooled), spoolBatchSize):
+        if i:
+            sleep(spoolBatchDelay)
+
+        if runSender(senderPath_, agentConf_, [], '\n'.join(spooled[i:i + spoolBatchSize])) == SENDER_FAILED:
+            spoolData(spooled[i:])
+            break
+
+
+def sendOrSpool(senderPath_, agentConf_, senderDataNStr_):
+    '''Send data, spool it on failure. True if it was sent.'''
+    if runSender(senderPath_, agentConf_, [], senderDataNStr_) == SENDER_FAILED:
+        if isSpoolEnabled:
+            spoolData(senderDataNStr_.splitlines())
+        return False
+
+    if isSpoolEnabled:
+        drainSpool(senderPath_, agentConf_)
+
+    return True
+
+
+def parseAddress(address_, defaultPort_):
+    '''"host", "host:port" or "[v6]:port" as (host, port).'''
+    address_ = address_.strip()
+    addressRe = re.match(r'^\[(.+)\](?::(\d+))?$', address_) or re.match(r'^([^:]+)(?::(\d+))?$', address_)
+    if addressRe:
+        return addressRe.group(1), int(addressRe.group(2) or defaultPort_)
+    else:
+        return address_, defaultPort_   # bare IPv6
+
+
+def upstreamAddress():
+    '''Trapper the relay sends to: relayUpstream, or first ServerActive of agent config.'''
+    if relayUpstream:
+        return parseAddress(relayUpstream, 10051)
+
+    try:
+        with open(agentConf, 'r') as f:
+            serverActive = re.search(r'^\s*ServerActive\s*=\s*([^,\s]+)', f.read(), re.M)
+    except (OSError, IOError):
+        serverActive = None
+
+    if serverActive:
+        return parseAddress(serverActive.group(1), 10051)
+    else:
+        return '127.0.0.1', 10051
+
+
+def recvExactly(conn_, size_):
+    chunks = []
+    while size_ > 0:
+        chunk = conn_.recv(min(size_, 65536))
+        if not chunk:
+            raise socket.error('connection closed')
+        chunks.append(chunk)
+        size_ -= len(chunk)
+
+    return b''.join(chunks)
+
+
+def sendNative(address_, lines_):
+    '''Send '-T' lines over one connection with sender protocol, exit code like zabbix_sender.'''
+    metrics = [lineMetric(line) for line in lines_]
+    body = serializeMetrics([m for m in metrics if m], native_=True).encode('utf-8')
+    try:
+        conn = socket.create_connection(address_, timeout=30)
+        try:
+            conn.sendall(b'ZBXD\x01' + struct.pack('<Q', len(body)) + body)
+            header = recvExactly(conn, 13)
+            response = loads(recvExactly(conn, struct.unpack('<Q', header[5:13])[0]).decode('utf-8'))
+        finally:
+            conn.close()
+    except (OSError, socket.error, ValueError, struct.error):
+        return SENDER_FAILED
+
+    if response.get('response') != 'success':
+        return SENDER_FAILED
+
+    failedRe = re.search(r'failed:\s*(\d+)', response.get('info', ''))
+    if     (failedRe and
+            int(failedRe.group(1))):
+
+        return 2
+
+    return 0
+
+
+relayDrainLock = threading.Lock()
+
+
+def drainRelaySpool():
+    '''Replay batches the relay failed to send to upstream, never to agent config's ServerActive.'''
+    try:
+        spooled = takeSpool('relayspool')
+        for i in range(0, len(spooled), relayMaxBatch):
+            if i:
+                sleep(spoolBatchDelay)
+
+            if sendNative(upstreamAddress(), spooled[i:i + relayMaxBatch]) == SENDER_FAILED:
+                spoolData(spooled[i:], 'relayspool')
+                break
+    finally:
+        relayDrainLock.release()
+
+
+def hasState(name_):
+    '''True if state file exists.'''
+    try:
+        return os.path.exists(statePath(name_))
+    except OSError:
+        return False
+
+
+def relayFlush(lines_):
+    '''Send merged batch of many hosts upstream, spool it on failure.'''
+    if sendNative(upstreamAddress(), lines_) == SENDER_FAILED:
+        if isSpoolEnabled:
+            spoolData(lines_, 'relayspool')
+    elif     (isSpoolEnabled and
+              hasState('relayspool') and
+              relayDrainLock.acquire(False)):
+
+        # replay in own thread, dispatch of new batches goes on meanwhile
+        drainer = threading.Thread(target=drainRelaySpool)
+        drainer.daemon = True
+        drainer.start()
+
+
+def parsePayload(raw_):
+    '''Due time, data and collector of one JSON payload sent by scheduleData(), None if malformed.'''
+    try:
+        payload = loads(raw_.decode('utf-8'))
+        due = time() + float(payload['delay'])   # relative, clocks of relay clients may differ
+        data = payload['data']
+        collector = payload.get('collector')
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+    if not isinstance(data, str):
+        return None
+
+    return due, data, collector
+
+
+def dispatchWorker(dueQueue_, isRelay_):
+    '''Send due data from one thread, so slow sender or spool replay never blocks accepting.
+
+    Relay merges data of many hosts into batches up to relayMaxBatch values,
+    sent when full or relayFlushInterval after first value was queued.'''
+    batch = []
+    batchStarted = 0
+    while True:
+        wait = None
+        if batch:
+            wait = max(batchStarted + relayFlushInterval - time(), 0.01)
+
+        try:
+            data, collector = dueQueue_.get(timeout=wait)
+        except queue.Empty:
+            data = None
+
+        try:
+            if not isRelay_:
+                if sendOrSpool(senderPath, agentConf, data):
+                    commitSendState(collector, data)
+                continue
+
+            if data is not None:
+                if not batch:
+                    batchStarted = time()
+                batch.extend(data.splitlines())
+
+            while len(batch) >= relayMaxBatch:
+                relayFlush(batch[:relayMaxBatch])
+                del batch[:relayMaxBatch]
+                batchStarted = time()
+
+            if     (batch and
+                    time() - batchStarted >= relayFlushInterval):
+
+                relayFlush(batch)
+                batch = []
+        except Exception:
+            pass
+        finally:
+            if data is not None:
+                dueQueue_.task_done()
+
+
+def listenScheduler():
+    '''Unix socket of this user's scheduler in private state directory, None if another scheduler serves it.'''
+    import fcntl
+    try:
+        lockFd = os.open(statePath('scheduler.lock'), os.O_CREAT | os.O_WRONLY, 0o600)
+        fcntl.flock(lockFd, fcntl.LOCK_EX | fcntl.LOCK_NB)   # held until exit, lockFd is never closed
+
+        path = statePath('scheduler.sock')
+        if os.path.exists(path):
+            os.remove(path)   # left by scheduler that was killed
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+    except (OSError, IOError, socket.error):
+        return None
+
+    return server
+
+
+def isPeerAllowed(conn_, peer_, isRelay_):
+    '''Relay takes localhost and relayAllowedHosts, scheduler only processes of its own user.'''
+    if isRelay_:
+        return     (peer_[0] in relayAllowedHosts or
+                    peer_[0].startswith('127.'))
+
+    if hasattr(socket, 'SO_PEERCRED'):
+        credentials = conn_.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+        return struct.unpack('3i', credentials)[1] == os.geteuid()   # pid, uid, gid
+
+    return True   # private directory of the socket keeps others out
+
+
+def runScheduler(isRelay_=False):
+    '''Resident process: accept payloads with delay on a socket and send them when due.
+
+    Local scheduler serves runs of its own user and exits when idle, relay listens
+    for other hosts and sends everything upstream in large batches. Clients are read
+    without blocking, a slow or idle one is dropped after SCHEDULER_READ_TIMEOUT.'''
+    if isRelay_:
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if not isWindows():
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            server.bind((relayBind, relayPort))
+        except (OSError, socket.error):
+            server = None
+    else:
+        server = listenScheduler()
+
+    if not server:
+        sys.exit(0)   # another scheduler is already running
+    server.listen(64)
+    server.setblocking(False)
+
+    dueQueue = queue.Queue()
+    worker = threading.Thread(target=dispatchWorker, args=(dueQueue, isRelay_))
+    worker.daemon = True
+    worker.start()
+
+    pending = []   # heap of (due, sequence, data, collector)
+    newest = {}    # collector: sequence of its only payload that will be sent
+    clients = {}   # connection: [received chunks, their size, deadline]
+    sequence = 0
+    lastActivity = time()
+    while True:
+        if pending:
+            wait = pending[0][0] - time()
+        elif     (isRelay_ or
+                  clients):
+
+            wait = None
+        else:
+            wait = lastActivity + schedulerIdleExit - time()
+            if wait <= 0:
+                break
+
+        if clients:
+            untilDrop = min(i[2] for i in clients.values()) - time()
+            if     (wait is None or
+                    untilDrop < wait):
+
+                wait = untilDrop
+
+        if wait is not None:
+            wait = max(wait, 0)
+
+        readable = select.select([server] + list(clients), [], [], wait)[0]
+        for conn in readable:
+            if conn is server:
+                try:
+                    conn, peer = server.accept()
+                except (OSError, socket.error):
+                    continue
+
+                try:
+                    if isPeerAllowed(conn, peer, isRelay_):
+                        conn.setblocking(False)
+                        clients[conn] = [[], 0, time() + SCHEDULER_READ_TIMEOUT]
+                        continue
+                except (OSError, socket.error):
+                    pass
+                conn.close()
+                continue
+
+            received = clients[conn]
+            try:
+                chunk = conn.recv(65536)
+            except BlockingIOError:
+                continue
+            except (OSError, socket.error):
+                chunk = None
+
+            if chunk:
+                received[0].append(chunk)
+                received[1] += len(chunk)
+                if received[1] <= SCHEDULER_MAX_PAYLOAD:
+                    continue
+                chunk = None   # too large
+
+            del clients[conn]
+            try:
+                payload = None
+                if chunk is not None:   # client finished sending
+                    payload = parsePayload(b''.join(received[0]))
+
+                if payload:
+                    due, data, collector = payload
+                    sequence += 1
+                    heapq.heappush(pending, (due, sequence, data, collector))
+                    lastActivity = time()
+
+                    # newer data of the same collector supersedes not yet sent one
+                    conn.settimeout(1)
+                    if collector in newest:
+                        conn.sendall(b'REPLACED')
+                    else:
+                        conn.sendall(b'OK')
+
+                    if collector:
+                        newest[collector] = sequence
+            except (OSError, socket.error):
+                pass
+            finally:
+                conn.close()
+
+        for conn in [i for i in clients if clients[i][2] <= time()]:
+            del clients[conn]   # idle client must not hold up others
+            conn.close()
+
+        while pending and pending[0][0] <= time():
+            due, seq, data, collector = heapq.heappop(pending)
+            if collector:
+                if newest.get(collector) != seq:
+                    continue   # replaced
+                del newest[collector]
+
+            dueQueue.put((data, collector))
+
+    if not isRelay_:
+        try:
+            os.remove(statePath('scheduler.sock'))
+        except OSError:
+            pass
+    server.close()
+    dueQueue.join()   # finish sending before exit
+
+
+def benchSerializer(itemsCount_):
+    '''Print time to build sender data for many items: ad-hoc formatting with stamping by regex, against records.'''
+    clock = int(time())
+    rows = [('Example host', 'cpu%s' % (i // 64), 'core%s' % (i % 64), str(40 + i % 30)) for i in range(itemsCount_)]
+
+    started = time()
+    lines = ['"%s" mini.cpu.temp[%s,%s] "%s"' % row for row in rows]
+    stamped = []
+    for line in lines:   # previous per-line stamping
+        lineRe = SENDER_LINE_RE.match(line)
+        stamped.append('%s %s %s %s' % (lineRe.group(1), lineRe.group(2), clock, lineRe.group(3)))
+    legacy = time() - started
+
+    started = time()
+    metrics = stampMetrics([Metric(host, 'mini.cpu.temp', (cpu, core), value) for host, cpu, core, value in rows], clock)
+    records = time() - started
+
+    started = time()
+    serializeMetrics(metrics)
+    text = time() - started
+
+    started = time()
+    serializeMetrics(metrics, native_=True)
+    native = time() - started
+
+    print('Items: %s' % itemsCount_)
+    print('%-34s %7.3f s' % ('Format and stamp lines:', legacy))
+    print('%-34s %7.3f s' % ('Records:', records))
+    print('%-34s %7.3f s' % ('Records to sender lines:', text))
+    print('%-34s %7.3f s' % ('Records to native JSON:', native))
+
+
+def benchRelay(valuesCount_, hostsCount_):
+    '''Print throughput of relay batching against a local fake trapper, compared to one connection per host.'''
+    received = [0, 0]   # values, connections
+
+    def fakeTrapper(server_):
+        while True:
+            conn = server_.accept()[0]
+            try:
+                header = recvExactly(conn, 13)
+                request = loads(recvExactly(conn, struct.unpack('<Q', header[5:13])[0]).decode('utf-8'))
+                received[0] += len(request['data'])
+                received[1] += 1
+                body = dumps({'response': 'success', 'info': 'processed: %s; failed: 0' % len(request['data'])}).encode()
+                conn.sendall(b'ZBXD\x01' + struct.pack('<Q', len(body)) + body)
+            finally:
+                conn.close()
+
+    trapper = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    trapper.bind(('127.0.0.1', 0))
+    trapper.listen(64)
+    thread = threading.Thread(target=fakeTrapper, args=(trapper,))
+    thread.daemon = True
+    thread.start()
+    address = trapper.getsockname()
+
+    perHost = max(valuesCount_ // hostsCount_, 1)
+    payloads = []
+    for h in range(hostsCount_):
+        metrics = [Metric('guest-%04d' % h, 'mini.cpu.temp', ('cpu0', 'core%s' % i), 40 + i % 30) for i in range(perHost)]
+        payloads.append(serializeMetrics(stampMetrics(metrics, int(time()))))
+    total = perHost * hostsCount_
+
+    print('Values: %s from %s hosts, relayMaxBatch: %s' % (total, hostsCount_, relayMaxBatch))
+    merged = [line for lines in payloads for line in lines]
+    for title, batches in (
+            ('One connection per host', payloads),
+            ('Relay batches', [merged[i:i + relayMaxBatch] for i in range(0, total, relayMaxBatch)])):
+
+        received[0] = received[1] = 0
+        started = time()
+        for batch in batches:
+            sendNative(address, batch)
+        elapsed = max(time() - started, 1e-6)
+        print('%-24s %8d values/s, %5d connections' % (title + ':', received[0] / elapsed, received[1]))
+
+
+def splayOffset(host_, window_):
+    '''Deterministic per-host delay within window, same on every run and every interpreter.'''
+    if window_ <= 0:
+        return 0
+
+    millis = zlib.crc32(host_.encode('utf-8')) % int(window_ * 1000)
+
+    return millis / 1000.0
+
+
+def simulateSplay(hostsCount_, window_):
+    '''Print how sends of N hosts with equal schedule arrive per second, with and without splay.'''
+    perSecond = {}
+    for i in range(hostsCount_):
+        second = int(splayOffset('host-%05d.example.com' % i, window_))
+        perSecond[second] = perSecond.get(second, 0) + 1
+
+    counts = [perSecond.get(i, 0) for i in range(max(int(window_), 1))]
+    print('Hosts: %s, splay window: %s s' % (hostsCount_, window_))
+    print('Without splay: %s arrivals in one second' % hostsCount_)
+    print('With splay: max %s, min %s, mean %.1f arrivals per second' % (
+        max(counts), min(counts), float(hostsCount_) / len(counts)))
+
+    scale = max(counts) / 50.0 or 1
+    for second, count in enumerate(counts):
+        print('%4d s  %5d  %s' % (second, count, '#' * int(round(count / scale))))
+
+
 def send():
 
     if fetchMode == 'get':
+        if collector:
+            # newer run of the same collector supersedes this one while sleeping
+            saveState('pending_%s' % collector, os.getpid())
+
         sleep(timeout)   # wait for LLD to be processed by server
-        senderProc = subprocess.Popen([senderPath, '-c', agentConf, '-i', '-'],
-                                      stdin=subprocess.PIPE, universal_newlines=True, close_fds=(not isWindows()))
+
+        if collector:
+            if loadState('pending_%s' % collector, None) != os.getpid():
+                bumpCounter(collector, 'ReplacedSends')
+                return
+
+        if sendOrSpool(senderPath, agentConf, senderDataNStr):
+            commitSendState(collector, senderDataNStr)
 
     elif fetchMode == 'getverb':
         print('\n  Note: the sender will fail if server did not gather LLD previously.')
         print('\n  Data sent to zabbix sender:')
         print('\n')
         print(senderDataNStr)
-        senderProc = subprocess.Popen([senderPath, '-vv', '-c', agentConf, '-i', '-'],
-                                      stdin=subprocess.PIPE, universal_newlines=True, close_fds=(not isWindows()))
+        runSender(senderPath, agentConf, ['-vv'], senderDataNStr)
 
     else:
         print(sys.argv[0] + " : Not supported. Use 'get' or 'getverb'.")
         sys.exit(1)
 
-    senderProc.communicate(input=senderDataNStr)
-
 
 if __name__ == '__main__':
     fetchMode = sys.argv[1]
 
+    if fetchMode == 'splaysim':   # sender_wrapper.py splaysim HOSTS [WINDOW]
+        if len(sys.argv) > 3:
+            simulateSplay(int(sys.argv[2]), float(sys.argv[3]))
+        else:
+            simulateSplay(int(sys.argv[2]), splayWindow or 60)
+        sys.exit(0)
+
+    if fetchMode == 'serialbench':   # sender_wrapper.py serialbench [ITEMS]
+        if len(sys.argv) > 2:
+            benchSerializer(int(sys.argv[2]))
+        else:
+            benchSerializer(100000)
+        sys.exit(0)
+
+    if fetchMode == 'relaybench':   # sender_wrapper.py relaybench VALUES [HOSTS]
+        if len(sys.argv) > 3:
+            benchRelay(int(sys.argv[2]), int(sys.argv[3]))
+        else:
+            benchRelay(int(sys.argv[2]), 100)
+        sys.exit(0)
+
     agentConf = sys.argv[2]
     senderPath = sys.argv[3]
-    timeout = int(sys.argv[4])
+
+    if fetchMode == 'scheduler':
+        runScheduler()
+        sys.exit(0)
+    elif fetchMode == 'relay':   # sender_wrapper.py relay AGENTCONF SENDERPATH
+        runScheduler(isRelay_=True)
+        sys.exit(0)
+
+    timeout = float(sys.argv[4])
     senderDataNStr = sys.argv[5]
+    if len(sys.argv) > 6:
+        collector = sys.argv[6]
+    else:
+        collector = None
 
     if isWindows():
         timeout = 0
@@ -124,32 +1011,478 @@ def chooseDevnull():
     return DEVNULL
 
 
-def processData(senderData_, jsonData_, agentConf_, senderPyPath_, senderPath_,
-                timeout_, host_, issuesLink_, sendStatusKey_='UNKNOWN'):
-    '''Compose data and try to send it.'''
+runCollector = None   # set by singleFlight()
+runLockPath = None
+
+
+def isStaleLock(path_):
+    '''Lock left by a run that died or hangs too long.'''
+    try:
+        if time() - os.path.getmtime(path_) > runLockStale:
+            return True
+
+        with open(path_, 'r') as f:
+            pid = int(f.read().strip())
+    except (OSError, IOError, ValueError):
+        return True
+
+    if not isWindows():
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        except OSError:
+            pass   # alive, but owned by someone else
+
+    return False
+
+
+def singleFlight(name_, host_):
+    '''Attach to in-flight run of the same collector: print its LLD and exit instead of collecting again.'''
+    global runCollector, runLockPath
+    runCollector = sanitizeStr('%s_%s' % (name_, host_))
+
+    if     (not isSingleFlight or
+            sys.argv[1] != 'get'):
+
+        return
+
+    try:
+        path = statePath('run_%s' % runCollector)
+    except OSError:
+        return   # no safe place for the lock, collect as usual
+
+    for attempt in range(2):
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            os.write(fd, str(os.getpid()).encode())
+            os.close(fd)
+            runLockPath = path
+            return   # this run is the leader
+        except OSError:
+            if isStaleLock(path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            else:
+                break
+
+    try:
+        since = os.path.getmtime(path)   # result of the run in flight is newer than its lock
+    except OSError:
+        since = time() - runAttachTimeout   # it finished meanwhile
+
+    deadline = time() + runAttachTimeout
+    while     (os.path.exists(path) and
+               time() < deadline):
+
+        sleep(0.2)
+
+    if os.path.exists(path):
+        # result of an earlier run could hold LLD that is no longer true
+        print(sys.argv[0] + ': In-flight run did not finish within %s seconds. (ATTACH_TIMEOUT)' % runAttachTimeout)
+        sys.exit(1)
+
+    try:
+        resultPath = statePath('result_%s' % runCollector)
+        if os.path.getmtime(resultPath) < since:
+            return   # run in flight published nothing, collect as usual
+
+        with open(resultPath, 'r') as f:
+            result = f.read()
+    except (OSError, IOError):
+        return   # nothing to attach to, collect as usual
+
+    bumpCounter(runCollector, 'CoalescedRuns')
+    print(result)
+    sys.exit(0)
+
+
+def releaseRunLock(result_):
+    '''Publish LLD for attached runs and let next run start.'''
+    global runLockPath
+    if not runLockPath:
+        return
+
+    try:
+        path = statePath('result_%s' % runCollector)
+        tmpPath = '%s.%s' % (path, os.getpid())
+        with open(tmpPath, 'w') as f:
+            f.write(result_)
+        os.replace(tmpPath, path)
+        os.remove(runLockPath)
+    except (OSError, IOError):
+        pass
+
+    runLockPath = None
+
+
+def isLldKnown(lldStr_, host_, timeout_):
+    '''True if server already had time to process the same LLD, so values need no wait.'''
+    if runCollector:
+        name = 'lld_%s' % runCollector
+    else:
+        name = 'lld_%s' % sanitizeStr(host_)
+
+    fingerprint = zlib.crc32(lldStr_.encode('utf-8'))
+    state = loadState(name, {})
+    if state.get('fingerprint') != fingerprint:
+        saveState(name, {'fingerprint': fingerprint, 'since': time()})
+        return False
+
+    # first seen within timeout: previous response could still be in processing or lost
+    return state.get('since', time()) + float(timeout_) <= time()
+
+
+def coalesceCounters(host_, sendStatusKey_):
+    '''Metrics with cumulative coalescing counters, like 'mini.disk.info[CoalescedRuns]'.'''
+    if not runCollector:
+        return []
+
+    prefix = sendStatusKey_.split('[')[0]
+    counters = loadState('counters_%s' % runCollector, {})
+    clock = int(time())
+
+    return [Metric(host_, prefix, (counter,), counters.get(counter, 0), clock) for counter in ('CoalescedRuns', 'ReplacedSends')]
+
+
+def fitSlope(history_):
+    '''Least squares slope of [clock, value] pairs, per minute.'''
+    count = len(history_)
+    meanClock = sum(i[0] for i in history_) / float(count)
+    meanValue = sum(i[1] for i in history_) / float(count)
+    covariance = sum((i[0] - meanClock) * (i[1] - meanValue) for i in history_)
+    variance = sum((i[0] - meanClock) ** 2 for i in history_)
+    if not variance:
+        return None
+
+    return covariance / variance * 60
+
+
+def slopeMetrics(metrics_, host_):
+    '''Add temperatures of this run to persisted history, slope metrics for every window that has enough of it.'''
+    if not slopeWindows:
+        return []
+
+    if runCollector:
+        name = 'slope_%s' % runCollector
+    else:
+        name = 'slope_%s' % sanitizeStr(host_)
+
+    keysRe = [re.compile(i) for i in slopeKeys]
+    oldest = int(time()) - max(slopeWindows)
+    previous = loadState(name, {})
+    current = {}   # sensors not seen for longest window are forgotten
+    slopes = []
+    for metric in metrics_:
+        itemKey = metric.itemKey()
+        if not any(r.search(itemKey) for r in keysRe):
+            continue
+
+        try:
+            value = float(metric.value)
+        except ValueError:
+            continue
+
+        history = [i for i in previous.pop(itemKey, []) if oldest <= i[0] < metric.clock]
+        history.append([metric.clock, value])
+        current[itemKey] = history[-slopeHistoryMax:]
+
+        for window in slopeWindows:
+            points = [i for i in history if i[0] >= metric.clock - window]
+            if     (len(points) < 2 or
+                    metric.clock - points[0][0] < window / 2):
+
+                continue   # too short to tell a trend from noise
+
+            slope = fitSlope(points)
+            if slope is not None:
+                slopes.append(Metric(host_, metric.key, tuple(metric.params) + ('slope%s' % window,), round(slope, 3), metric.clock))
+
+    for itemKey, history in previous.items():
+        if history[-1][0] >= oldest:
+            current[itemKey] = history
+
+    saveState(name, current)
+
+    return slopes
+
+
+def thresholdCrossings(metrics_, host_):
+    '''Metrics that went over one of their thresholds since last run.'''
+    if not isUrgentSend:
+        return []
+
+    if runCollector:
+        name = 'crossed_%s' % runCollector
+    else:
+        name = 'crossed_%s' % sanitizeStr(host_)
+
+    values = {}
+    for metric in metrics_:
+        values[metric.itemKey()] = metric
+
+    thresholdsRe = [(re.compile(i), j) for i, j in urgentThresholds]
+    previous = loadState(name, {})   # value item: thresholds it is over
+    current = {}
+    crossings = []
+    for itemKey, metric in values.items():
+        for valueRe, limitKeys in thresholdsRe:
+            match = valueRe.search(itemKey)
+            if match:
+                break
+        else:
+            continue
+
+        try:
+            value = float(metric.value)
+        except ValueError:
+            continue
+
+        isCrossed = False
+        over = []
+        for limitKey in limitKeys:
+            limitMetric = values.get(match.expand(limitKey))
+            try:
+                limit = float(limitMetric.value)
+            except (AttributeError, ValueError):
+                continue
+
+            wasOver = limitKey in previous.get(itemKey, ())
+            if value >= limit:
+                over.append(limitKey)
+                if     (not wasOver and
+                        itemKey in previous):   # new sensor may be unknown to server yet
+
+                    isCrossed = True
+            elif     (wasOver and
+                      value > limit - urgentHysteresis):
+
+                over.append(limitKey)   # still within hysteresis
+
+        current[itemKey] = over
+        if isCrossed:
+            crossings.append(metric)
+
+    saveState(name, current)
+
+    return crossings
+
+
+def sendOnChange(senderData_, host_, sendStatusKey_):
+    '''Drop values unchanged since last send unless heartbeat passed, add count of dropped ones.
+
+    Returns kept lines and send state they would make, committed by commitSendState() once they are sent.'''
+    if     (not isSendOnChange or
+            not runCollector):
+
+        return senderData_, None
+
+    alwaysRe = [re.compile(i) for i in sendOnChangeAlways]
+    previous = loadState('lastvalues_%s' % runCollector, {})
+    current = {}   # keys gone from this run are forgotten
+    kept = []
+    suppressed = 0
+    for line in senderData_:
+        fields = splitLine(line)
+        if not fields:
+            kept.append(line)
+            continue
+
+        key, clock, value = fields[1:]
+        last = previous.get(key)   # [value, clock of last send, times sent in a row]
+        if     (last and
+                last[0] == value and
+                last[2] >= sendOnChangeRepeats and
+                clock - last[1] < sendOnChangeHeartbeat and
+                not any(r.search(key) for r in alwaysRe)):
+
+            current[key] = last
+            suppressed += 1
+            continue
+
+        if     (last and
+                last[0] == value):
+
+            current[key] = [value, clock, last[2] + 1]
+        else:
+            current[key] = [value, clock, 1]
+        kept.append(line)
+
+    prefix = sendStatusKey_.split('[')[0]
+    kept.extend(serializeMetrics([Metric(host_, prefix, ('SuppressedValues',), suppressed, int(time()))]))
+
+    return kept, current
+
+
+def masterPayload(senderData_, host_, sendStatusKey_):
+    '''Fold sender lines into one JSON document keyed by item key, sent to 'mini.cpu.json' or 'mini.disk.json'.'''
+    document = {}
+    clock = 0
+    for line in senderData_:
+        fields = splitLine(line)
+        if fields:
+            document[fields[1]] = unquoteValue(fields[3])
+            clock = max(clock, fields[2])   # newest collection time of the run
+
+    if not document:
+        return []
+
+    masterKey = sendStatusKey_.split('.info[')[0] + '.json'
+    jsonStr = dumps(document, separators=(',', ':'))
+
+    return serializeMetrics([Metric(host_, masterKey, (), jsonStr, clock)])
+
+
+def connectTo(address_, timeout_):
+    '''Connected socket to path of unix socket, or to (host, port).'''
+    if not isinstance(address_, str):
+        return socket.create_connection(address_, timeout=timeout_)
+
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(timeout_)
+    try:
+        conn.connect(address_)
+    except (OSError, socket.error):
+        conn.close()
+        raise
+
+    return conn
+
+
+def submitToScheduler(payload_, address_):
+    '''Hand payload over to resident scheduler or relay, reply or None if it was not accepted.'''
+    try:
+        conn = connectTo(address_, 5)
+        try:
+            conn.sendall(dumps(payload_).encode('utf-8'))
+            conn.shutdown(socket.SHUT_WR)
+            reply = conn.recv(16)
+        finally:
+            conn.close()
+    except (OSError, socket.error):
+        return None
+
+    if reply in (b'OK', b'REPLACED'):
+        return reply
+    else:
+        return None
+
+
+def acceptedByScheduler(payload_, address_=None):
+    if not address_:
+        try:
+            address_ = statePath('scheduler.sock')
+        except OSError:
+            return False
+
+    reply = submitToScheduler(payload_, address_)
+    if reply == b'REPLACED':
+        bumpCounter(runCollector, 'ReplacedSends')
+
+    return reply is not None
+
+
+def scheduleData(senderDataNStr_, agentConf_, senderPyPath_, senderPath_, timeout_, collector_):
+    '''Defer sending to relay or resident scheduler, starting the latter on first use. False means fall back to own process.'''
+    payload = {'delay': float(timeout_), 'data': senderDataNStr_, 'collector': collector_}
+    if     (relayAddress and
+            acceptedByScheduler(payload, parseAddress(relayAddress, 10098))):
+
+        commitSendState(collector_, senderDataNStr_)   # relay sends or spools it, nothing more is known here
+        return True
+
+    if     (not isSchedulerEnabled or
+            isWindows()):
+
+        return False
+
+    if acceptedByScheduler(payload):
+        return True
+
+    DEVNULL = chooseDevnull()
+    try:
+        # own session, so agent killing the check's process group on timeout does not take it down
+        subprocess.Popen([sys.executable, senderPyPath_, 'scheduler', agentConf_, senderPath_],
+                         stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL, close_fds=True, start_new_session=True)
+    except OSError:
+        return False
+
+    for i in range(20):
+        sleep(0.1)
+        if acceptedByScheduler(payload):
+            return True
+
+    return False
+
+
+def dispatchData(senderDataNStr_, agentConf_, senderPyPath_, senderPath_, host_, sendStatusKey_, delay_, collector_):
+    '''Hand data to scheduler, or to detached sender_wrapper.py process which sends it after delay.'''
     DEVNULL = chooseDevnull()
 
+    if scheduleData(senderDataNStr_, agentConf_, senderPyPath_, senderPath_, delay_, collector_):
+        return
+
+    # spawn new process and regain shell control immediately (on Win 'sender_wrapper.py' will not wait)
+    try:
+        cmd = [sys.executable, senderPyPath_, 'get', agentConf_, senderPath_, delay_, senderDataNStr_]
+        if collector_:
+            cmd.append(collector_)
+
+        subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=DEVNULL, stderr=DEVNULL, close_fds=(not isWindows()))
+
+    except OSError as e:
+        if e.args[0] == 7:
+            subprocess.call([senderPath_, '-c', agentConf_, '-s', host_, '-k', sendStatusKey_, '-o', 'HUGEDATA'])
+        else:
+            subprocess.call([senderPath_, '-c', agentConf_, '-s', host_, '-k', sendStatusKey_, '-o', 'SEND_OS_ERROR'])
+
+    except:
+        subprocess.call(    [senderPath_, '-c', agentConf_, '-s', host_, '-k', sendStatusKey_, '-o', 'UNKNOWN_SEND_ERROR'])
+
+
+def processData(senderData_, jsonData_, agentConf_, senderPyPath_, senderPath_,
+                timeout_, host_, issuesLink_, sendStatusKey_='UNKNOWN'):
+    '''Compose data and try to send it. Metrics must be already stamped with stampMetrics().'''
     fetchMode_ = sys.argv[1]
+    urgent = []
+    if fetchMode_ == 'get':
+        urgent = thresholdCrossings(senderData_, host_)
+    senderData_ = senderData_ + slopeMetrics(senderData_, host_) + coalesceCounters(host_, sendStatusKey_)
+    if urgent:
+        urgentIds = set(map(id, urgent))
+        senderData_ = [m for m in senderData_ if id(m) not in urgentIds]   # sent once, right away
+
+        urgentData = serializeMetrics(urgent)
+        if payloadMode == 'master':
+            urgentData = masterPayload(urgentData, host_, sendStatusKey_)
+        dispatchData('\n'.join(urgentData), agentConf_, senderPyPath_, senderPath_, host_, sendStatusKey_, '0', None)
+
+    senderData_ = serializeMetrics(senderData_)
+    sendState = None
+    if fetchMode_ == 'get':
+        senderData_, sendState = sendOnChange(senderData_, host_, sendStatusKey_)
+    if payloadMode == 'master':
+        senderData_ = masterPayload(senderData_, host_, sendStatusKey_)
     senderDataNStr = '\n'.join(senderData_)   # items for zabbix sender separated by newlines
+    if sendState is not None:
+        proposeSendState(runCollector, senderDataNStr, sendState)
 
     # pass senderDataNStr to sender_wrapper.py:
     if fetchMode_ == 'get':
-        print(dumps({"data": jsonData_}, indent=4))   # print data gathered for LLD
+        lldStr = dumps({"data": jsonData_}, separators=(',', ':'))
+        print(lldStr)   # print data gathered for LLD
+        sys.stdout.flush()
+        releaseRunLock(lldStr)
 
-        # spawn new process and regain shell control immediately (on Win 'sender_wrapper.py' will not wait)
-        try:
-            cmd = [sys.executable, senderPyPath_, fetchMode_, agentConf_, senderPath_, timeout_, senderDataNStr]
-        
-            subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=DEVNULL, stderr=DEVNULL, close_fds=(not isWindows()))
-
-        except OSError as e:
-            if e.args[0] == 7:
-                subprocess.call([senderPath_, '-c', agentConf_, '-s', host_, '-k', sendStatusKey_, '-o', 'HUGEDATA'])
-            else:
-                subprocess.call([senderPath_, '-c', agentConf_, '-s', host_, '-k', sendStatusKey_, '-o', 'SEND_OS_ERROR'])
+        # LLD wait only when new entities appeared, splay adds to it
+        if isLldKnown(lldStr, host_, timeout_):
+            delay = str(splayOffset(host_, splayWindow))
+        else:
+            delay = str(int(timeout_) + splayOffset(host_, splayWindow))
 
-        except:
-            subprocess.call(    [senderPath_, '-c', agentConf_, '-s', host_, '-k', sendStatusKey_, '-o', 'UNKNOWN_SEND_ERROR'])
+        dispatchData(senderDataNStr, agentConf_, senderPyPath_, senderPath_, host_, sendStatusKey_, delay, runCollector)
 
     elif fetchMode_ == 'getverb':
         displayVersions(agentConf_, senderPath_)
@@ -196,28 +1529,14 @@ def clearDiskTypeStr(s):
 
 
 def removeQuotes(s):
-    quotes = ('\'', '"')
-
-    for i in quotes:
-        s = s.replace(i, '')
-
-    return s
+    return s.translate(QUOTES_TABLE)
 
 
 def sanitizeStr(s):
     '''Sanitizes provided string in sequential order.'''
-    stopChars = (
-        ('/dev/', ''), (' -d', ''),
-        ('!', '_'), (',', '_'), ('[', '_'), ('~', '_'), ('  ', '_'),
-        (']', '_'), ('+', '_'), ('/', '_'), ('\\', '_'), ('\'', '_'),
-        ('`', '_'), ('@', '_'), ('#', '_'), ('$', '_'), ('%', '_'),
-        ('^', '_'), ('&', '_'), ('*', '_'), ('(', '_'), (')', '_'),
-        ('{', '_'), ('}', '_'), ('=', '_'), (':', '_'), (';', '_'),
-        ('"', '_'), ('?', '_'), ('<', '_'), ('>', '_'), (' ', '_'),
-    )
-
-    for i, j in stopChars:
-        s = s.replace(i, j)
+    # double space becomes one '_' before single characters are translated
+    s = s.replace('/dev/', '').replace(' -d', '').replace('  ', '_')
+    s = s.translate(SANITIZE_TABLE)
 
     s = s.strip()
 